@@ -0,0 +1,295 @@
+# Change-data-capture feed of the products database.
+#
+# With CHANGELOG_DIR set, SQLiteWriter appends one JSON line per product it
+# inserts or whose stored fields change, holding only the changed fields, and
+# at the end of a finished crawl every query gets a line per product it
+# started or stopped listing:
+#
+#   {"seq": 41, "op": "insert", "id": "1005...", "at": "...", "fields": {...}}
+#   {"seq": 42, "op": "update", "id": "1005...", "at": "...", "changes": {"sale_price": [12.5, 9.99]}}
+#   {"seq": 43, "op": "listed", "id": "1005...", "at": "...", "query": "3f2a..."}
+#   {"seq": 44, "op": "delisted", "id": "1005...", "at": "...", "query": "3f2a..."}
+#
+# seq increases by one per line across crawls. Lines go to changes-<first
+# seq>.jsonl, which is gzipped to changes-<first>-<last>.jsonl.gz once it
+# reaches CHANGELOG_SEGMENT_SIZE bytes and when the crawl closes, so a consumer
+# remembers the last seq it processed and reads on from there:
+#
+#   python -m aliexpress.changelog changes/ --after 41
+
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import weakref
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+SEGMENT_RE = re.compile(r"^changes-(\d+)(?:-(\d+))?\.jsonl(\.gz)?$")
+
+MEMBERSHIP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS query_products (
+    query TEXT NOT NULL,
+    product_id TEXT NOT NULL,
+    PRIMARY KEY (query, product_id)
+) WITHOUT ROWID
+"""
+
+# stats collector -> ChangeFeed of the crawl it belongs to
+_feeds: "weakref.WeakKeyDictionary[Any, ChangeFeed]" = weakref.WeakKeyDictionary()
+
+
+def segments(directory: str) -> List[Tuple[int, Optional[int], str]]:
+    # (first seq, last seq or None while open, file name), oldest first
+    found = []
+    for name in os.listdir(directory) if os.path.isdir(directory) else ():
+        match = SEGMENT_RE.match(name)
+        if match:
+            last = int(match.group(2)) if match.group(2) else None
+            found.append((int(match.group(1)), last, name))
+    return sorted(found)
+
+
+class ChangeLog:
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.segment_size = segment_size
+        self.seq = 0
+        self.first_seq: Optional[int] = None
+        self.file = None
+        # Appends come from the writer thread and the reactor thread
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def from_settings(cls, settings) -> Optional["ChangeLog"]:
+        directory = settings.get('CHANGELOG_DIR')
+        if not directory:
+            return None
+        return cls(directory, segment_size=settings.getint('CHANGELOG_SEGMENT_SIZE', 64 * 1024 * 1024))
+
+    def open(self) -> "ChangeLog":
+        os.makedirs(self.directory, exist_ok=True)
+        for first, last, name in segments(self.directory):
+            if last is not None:
+                self.seq = max(self.seq, last)
+            else:
+                # Left open by a crawl that did not close; picked up again
+                self.first_seq = first
+                self.seq = max(self.seq, self._recover(os.path.join(self.directory, name), first))
+        return self
+
+    def _recover(self, path: str, first: int) -> int:
+        # Drops a partial last line and returns the last seq in the segment
+        last = first - 1
+        offset = 0
+        with open(path, "rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                last = json.loads(line)["seq"]
+                offset += len(line)
+        if offset < os.path.getsize(path):
+            with open(path, "r+b") as file:
+                file.truncate(offset)
+        return last
+
+    def append(self, records: List[Dict[str, Any]]) -> None:
+        if not records:
+            return
+        with self.lock:
+            if self.file is None:
+                if self.first_seq is None:
+                    self.first_seq = self.seq + 1
+                self.file = open(self._active_path(), "ab")
+            for record in records:
+                self.seq += 1
+                line = json.dumps({"seq": self.seq, **record}, ensure_ascii=False, separators=(",", ":"))
+                self.file.write(line.encode("utf-8") + b"\n")
+            self.file.flush()
+            if self.file.tell() >= self.segment_size:
+                self._rotate()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is None and self.first_seq is not None:
+                self.file = open(self._active_path(), "ab")
+            if self.file is not None:
+                self._rotate()
+
+    def _active_path(self) -> str:
+        return os.path.join(self.directory, f"changes-{self.first_seq:012d}.jsonl")
+
+    def _rotate(self) -> None:
+        # Compresses the active segment under its seq range
+        self.file.close()
+        self.file = None
+        source = self._active_path()
+        if self.seq < self.first_seq:
+            os.remove(source)
+        else:
+            target = os.path.join(self.directory, f"changes-{self.first_seq:012d}-{self.seq:012d}.jsonl.gz")
+            with open(source, "rb") as raw, gzip.open(f"{target}.tmp", "wb") as compressed:
+                shutil.copyfileobj(raw, compressed)
+            os.replace(f"{target}.tmp", target)
+            os.remove(source)
+            self.logger.info(f"Closed change log segment {target}")
+        self.first_seq = None
+
+
+def read_changes(directory: str, after: int = 0) -> Iterator[Dict[str, Any]]:
+    # Every record with a seq above `after`, in order; segments that end at
+    # or before it are not opened
+    for first, last, name in segments(directory):
+        if last is not None and last <= after:
+            continue
+        path = os.path.join(directory, name)
+        try:
+            file = gzip.open(path, "rb") if name.endswith(".gz") else open(path, "rb")
+        except FileNotFoundError:
+            # Compressed since the listing; read on from the new segment
+            yield from read_changes(directory, after)
+            return
+        with file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # Still being written
+                    return
+                record = json.loads(line)
+                if record["seq"] > after:
+                    after = record["seq"]
+                    yield record
+
+
+class ChangeFeed:
+    # Scrapy extension owning the crawl's ChangeLog. SQLiteWriter emits the
+    # product diffs; the spider reports which products each query listed, and
+    # the crawl hands that to emit_listings when it closes.
+
+    def __init__(self, crawler) -> None:
+        self.changelog = ChangeLog.from_settings(crawler.settings)
+        if self.changelog is None:
+            raise NotConfigured
+        self.stats = crawler.stats
+        # query key -> product ids listed in this crawl
+        self.listings: Dict[str, Set[str]] = {}
+        # Set for crawls that resumed part way, and the queries with a page
+        # that failed, came back empty or was beyond the page limit
+        self.partial = False
+        self.incomplete: Set[str] = set()
+        self.logger = logging.getLogger(__name__)
+        _feeds[self.stats] = self
+
+    @classmethod
+    def from_crawler(cls, crawler) -> "ChangeFeed":
+        extension = cls(crawler)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider) -> None:
+        self.changelog.open()
+        self.logger.info(f"Change log in {self.changelog.directory}, continuing after seq {self.changelog.seq}")
+
+    def spider_closed(self, spider, reason) -> None:
+        # Runs after the pipelines have closed, so every diff is already in
+        if self.listings:
+            listed, delisted = emit_listings(
+                self.changelog, self.listings, self.incomplete, complete=reason == "finished" and not self.partial
+            )
+            self.stats.inc_value("changelog/listed", listed)
+            self.stats.inc_value("changelog/delisted", delisted)
+        self.changelog.close()
+        self.stats.set_value("changelog/last_seq", self.changelog.seq)
+
+
+def emit_listings(change_log: ChangeLog, listings: Dict[str, Set[str]], incomplete: Set[str],
+                  complete: bool) -> Tuple[int, int]:
+    # Compares what each query listed with its previous listing, kept in
+    # CHANGELOG_DIR/queries.db. New listings are always reported; products
+    # missing from a query only when the crawl parsed all of the query's
+    # pages. Returns how many listed and delisted records were appended.
+    at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    total_listed = total_delisted = 0
+    conn = sqlite3.connect(os.path.join(change_log.directory, "queries.db"))
+    try:
+        with conn:
+            conn.execute(MEMBERSHIP_SCHEMA)
+            for query, listed in listings.items():
+                previous = {
+                    product_id for product_id, in
+                    conn.execute("SELECT product_id FROM query_products WHERE query = ?", (query,))
+                }
+                records = [
+                    {"op": "listed", "id": product_id, "at": at, "query": query}
+                    for product_id in sorted(listed - previous)
+                ]
+                total_listed += len(records)
+                if complete and query not in incomplete:
+                    delisted = sorted(previous - listed)
+                    records += [
+                        {"op": "delisted", "id": product_id, "at": at, "query": query}
+                        for product_id in delisted
+                    ]
+                    total_delisted += len(delisted)
+                    conn.execute("DELETE FROM query_products WHERE query = ?", (query,))
+                conn.executemany(
+                    "INSERT OR IGNORE INTO query_products VALUES (?, ?)",
+                    ((query, product_id) for product_id in listed),
+                )
+                change_log.append(records)
+    finally:
+        conn.close()
+    return total_listed, total_delisted
+
+
+def feed_for(stats) -> Optional[ChangeFeed]:
+    return _feeds.get(stats) if stats is not None else None
+
+
+def product_listed(stats, query: Optional[str], product_id: str) -> None:
+    # Records that `query` listed the product in this crawl; a no-op without
+    # a change feed
+    feed = feed_for(stats)
+    if feed is not None and query:
+        feed.listings.setdefault(query, set()).add(product_id)
+
+
+def mark_partial(stats) -> None:
+    # The crawl resumed part way, so missing products say nothing
+    feed = feed_for(stats)
+    if feed is not None:
+        feed.partial = True
+
+
+def query_incomplete(stats, query: Optional[str]) -> None:
+    # Some of the query's listing was not seen, so its missing products say nothing
+    feed = feed_for(stats)
+    if feed is not None and query:
+        feed.incomplete.add(query)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Print change log records after a sequence number as JSONL")
+    parser.add_argument("directory")
+    parser.add_argument("--after", type=int, default=0, help="last seq already processed")
+    args = parser.parse_args(argv)
+    last = args.after
+    for record in read_changes(args.directory, args.after):
+        sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+        last = record["seq"]
+    print(f"last seq {last}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+from itemadapter import ItemAdapter
+
+# Page request meta that is needed to rebuild the request after a restart
+PAGE_META_KEYS = ("query_key", "fanned_out", "price_range")
+
+
+def checkpoint_path(directory: str, spider_name: str, queries: Iterable[str]) -> str:
+    # One checkpoint per spider and set of queries, so a restart with the
+    # same queries finds the frontier it left behind
+    digest = hashlib.sha1("\n".join(queries).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(directory, f"{spider_name}-{digest}.jsonl")
+
+
+class CrawlCheckpoint:
+    # The crawl frontier: result pages scheduled but not parsed yet, pages
+    # already parsed, products waiting for their review request or for the
+    # writers, and products the writers have committed. Pages and review
+    # requests that failed for good are kept apart, so they do not make the
+    # crawl look interrupted.
+    #
+    # On disk it is a journal of [op, ...] lines. save() only appends what
+    # changed since the last save, so its cost does not grow with the crawl;
+    # load() replays the journal and rewrites it compacted.
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.pending_pages: Dict[str, Dict[str, Any]] = {}
+        self.done_pages = set()
+        self.pending_products: Dict[str, Dict[str, Any]] = {}
+        # Pending products that have their reviews and only wait for the writers
+        self.ready_products = set()
+        self.done_products = set()
+        self.failed_pages = set()
+        self.failed_products = set()
+        # Journal lines not saved yet. A checkpoint that was not loaded
+        # replaces whatever file a previous crawl left behind.
+        self.unsaved: List[list] = []
+        self.mode = "w"
+        self.logger = logging.getLogger(__name__)
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn line of a save cut short; a later save repeats it
+                        self.logger.warning(f"Ignoring a truncated line in checkpoint {self.path}")
+                        continue
+                    self._apply(entry)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.error(f"Ignoring unreadable checkpoint {self.path}: {e}")
+            return False
+        if self.empty:
+            # Left behind with nothing in flight; there is nothing to resume
+            return False
+        self.mode = "a"
+        self._compact()
+        self.logger.info(
+            f"Resuming from {self.path}: {len(self.pending_pages)} pages and "
+            f"{len(self.pending_products) - len(self.ready_products)} reviews pending, "
+            f"{len(self.ready_products)} products not written, {len(self.done_pages)} pages done, "
+            f"{len(self.failed_pages)} pages and {len(self.failed_products)} reviews failed"
+        )
+        return True
+
+    def save(self) -> None:
+        if not self.unsaved:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.path, self.mode, encoding="utf-8") as file:
+                file.write(self._lines(self.unsaved))
+            self.unsaved = []
+            self.mode = "a"
+        except OSError as e:
+            self.logger.error(f"Error saving checkpoint {self.path}: {e}")
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @property
+    def empty(self) -> bool:
+        return not self.pending_pages and not self.pending_products
+
+    def page_scheduled(self, url: str, meta: Dict[str, Any], priority: int = 0) -> None:
+        meta = {key: meta[key] for key in PAGE_META_KEYS if meta.get(key) is not None}
+        self._record(["page", url, meta, priority])
+
+    def page_done(self, url: str) -> None:
+        self._record(["page_done", url])
+
+    def page_failed(self, url: str) -> None:
+        self._record(["page_failed", url])
+
+    def product_pending(self, product: Any) -> None:
+        self._record(["product", ItemAdapter(product).asdict()])
+
+    def product_ready(self, product: Any) -> None:
+        self._record(["product_ready", ItemAdapter(product).asdict()])
+
+    def product_done(self, product_id: str) -> None:
+        self._record(["product_done", product_id])
+
+    def product_failed(self, product_id: str) -> None:
+        self._record(["product_failed", product_id])
+
+    def is_page_done(self, url: Optional[str]) -> bool:
+        return url in self.done_pages
+
+    def _record(self, entry: list) -> None:
+        self._apply(entry)
+        self.unsaved.append(entry)
+
+    def _apply(self, entry: list) -> None:
+        op = entry[0]
+        if op == "page":
+            _, url, meta, priority = entry
+            if meta.get("price_range") is not None:
+                meta["price_range"] = tuple(meta["price_range"])
+            self.pending_pages[url] = {"meta": meta, "priority": priority}
+        elif op in ("page_done", "page_failed"):
+            self.pending_pages.pop(entry[1], None)
+            (self.done_pages if op == "page_done" else self.failed_pages).add(entry[1])
+        elif op in ("product", "product_ready"):
+            data = entry[1]
+            self.pending_products[data["id"]] = data
+            if op == "product_ready":
+                self.ready_products.add(data["id"])
+        elif op in ("product_done", "product_failed"):
+            self.pending_products.pop(entry[1], None)
+            self.ready_products.discard(entry[1])
+            (self.done_products if op == "product_done" else self.failed_products).add(entry[1])
+        else:
+            raise ValueError(f"unknown checkpoint entry {op!r}")
+
+    def _entries(self):
+        # The current state as journal lines
+        for url, page in self.pending_pages.items():
+            yield ["page", url, page["meta"], page["priority"]]
+        for url in self.done_pages:
+            yield ["page_done", url]
+        for url in self.failed_pages:
+            yield ["page_failed", url]
+        for product_id, data in self.pending_products.items():
+            yield ["product_ready" if product_id in self.ready_products else "product", data]
+        for product_id in self.done_products:
+            yield ["product_done", product_id]
+        for product_id in self.failed_products:
+            yield ["product_failed", product_id]
+
+    def _compact(self) -> None:
+        # Drops superseded lines, so resuming over and over does not grow the file
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                file.write(self._lines(self._entries()))
+            # Atomic swap so a crash mid-rewrite keeps the previous journal
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.logger.error(f"Error compacting checkpoint {self.path}: {e}")
+
+    @staticmethod
+    def _lines(entries: Iterable[list]) -> str:
+        return "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries)
@@ -0,0 +1,219 @@
+# Helpers that pull the search payload out of AliExpress pages without
+# building a DOM, and the plan that turns its itemList records into products.
+# They only depend on the raw response body, so they can be benchmarked and
+# tested on saved pages.
+
+import json
+import re
+from collections import Counter
+from html import unescape
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+import jmespath
+from w3lib.html import remove_tags, replace_escape_chars
+
+from aliexpress.items import Product
+
+DIDA_CONFIG_MARKER = b"window._dida_config_"
+SCRIPT_END = b"</script>"
+DATA_KEY_PATTERN = re.compile(r'"data"\s*:\s*')
+
+_decoder = json.JSONDecoder()
+
+
+def _skip_whitespace(text: str, pos: int) -> int:
+    while pos < len(text) and text[pos] in " \t\r\n":
+        pos += 1
+    return pos
+
+
+def extract_dida_config(body: Union[bytes, str]) -> Optional[Dict[str, Any]]:
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+
+    start = body.find(DIDA_CONFIG_MARKER)
+    while start != -1:
+        pos = start + len(DIDA_CONFIG_MARKER)
+        while pos < len(body) and body[pos] in b" \t\r\n":
+            pos += 1
+        if pos < len(body) and body[pos:pos + 1] == b"=":
+            break
+        start = body.find(DIDA_CONFIG_MARKER, pos)
+    if start == -1:
+        return None
+
+    # Never decode past the end of the script block holding the assignment
+    end = body.find(SCRIPT_END, pos)
+    script = body[pos + 1:end if end != -1 else len(body)].decode("utf-8", errors="replace")
+
+    value_start = _skip_whitespace(script, 0)
+    try:
+        config, _ = _decoder.raw_decode(script, value_start)
+        if isinstance(config, dict) and "data" in config:
+            return config
+    except json.JSONDecodeError:
+        pass
+
+    # The config object is not always strict JSON; fall back to decoding just
+    # the "data" member, which is what the spider consumes.
+    match = DATA_KEY_PATTERN.search(script, value_start)
+    if not match:
+        return None
+    try:
+        data, _ = _decoder.raw_decode(script, match.end())
+    except json.JSONDecodeError:
+        return None
+    return {"data": data}
+
+
+NUMBER_RE = re.compile(r"\d+[+]?")
+
+
+def get_number(text):
+    if text:
+        match = NUMBER_RE.match(text)
+        if match:
+            return match.group()
+    return None
+
+
+def safe_float_cast(s):
+    try:
+        return float(s)
+    except (ValueError, TypeError):
+        return None
+
+
+def cleanup(input_text):
+    return unescape(remove_tags(replace_escape_chars(input_text)))
+
+
+def parse_count(value) -> Tuple[Optional[int], bool]:
+    # "1000+ sold" -> (1000, True); counts occasionally arrive as plain ints
+    if isinstance(value, int):
+        return value, False
+    match = NUMBER_RE.match(value)
+    if not match:
+        return None, False
+    text = match.group()
+    return (int(text[:-1]), True) if text[-1] == "+" else (int(text), False)
+
+
+def https(url: str) -> str:
+    # Image and store URLs are protocol-relative
+    return "https:" + url
+
+
+def image_urls(images) -> Tuple[str, ...]:
+    return tuple("https:" + image["imgUrl"] for image in images)
+
+
+def compile_path(path: str) -> Callable[[Any], Any]:
+    # "prices.salePrice.minPrice" -> a getter walking the nested dicts, raising
+    # KeyError or TypeError when a level is missing
+    keys = tuple(path.split("."))
+    if len(keys) == 1:
+        (key,) = keys
+        return lambda record: record[key]
+
+    def get(record):
+        for key in keys:
+            record = record[key]
+        return record
+    return get
+
+
+class Field(NamedTuple):
+    # A Product field (or a tuple of fields filled from one value) read from
+    # `path` of an itemList record. A missing required field drops the record;
+    # any other falls back to `default`, and only fields that are normally
+    # present count as missing.
+    name: Union[str, Tuple[str, ...]]
+    path: str
+    convert: Optional[Callable[[Any], Any]] = None
+    default: Any = None
+    required: bool = False
+    optional: bool = False
+
+
+FIELDS = (
+    Field("id", "productId", required=True),
+    Field("skuId", "prices.skuId", optional=True),
+    Field("title", "title.displayTitle", cleanup, required=True),
+    Field("main_image", "image.imgUrl", https),
+    Field("sale_price", "prices.salePrice.minPrice", safe_float_cast),
+    Field("original_price", "prices.originalPrice.minPrice", safe_float_cast, optional=True),
+    Field("discount", "prices.salePrice.discount", safe_float_cast, default=0.0, optional=True),
+    Field("currency", "prices.salePrice.currencyCode", required=True),
+    Field(("trade_count", "trade_count_plus"), "trade.realTradeCount", parse_count, (None, False), optional=True),
+    Field("store_name", "store.storeName", default="", optional=True),
+    Field("store_url", "store.storeUrl", https, default="https:", optional=True),
+    Field("star_rating", "evaluation.starRating", safe_float_cast, optional=True),
+    Field(("total_sales", "total_sales_plus"), "trade.tradeDesc", parse_count, (None, False), optional=True),
+    Field("images", "images", image_urls, default=(), optional=True),
+)
+
+
+class ExtractionPlan:
+    # Built once per spider: the jmespath expressions for the page payload are
+    # compiled up front and every field path becomes a plain dict walk, so a
+    # page of records is converted in one pass without re-parsing anything.
+
+    def __init__(self, fields: Iterable[Field] = FIELDS):
+        self.records = jmespath.compile("data.root.fields.mods.itemList.content")
+        self.page = jmespath.compile("data.root.fields.pageInfo.page")
+        self.total_results = jmespath.compile("data.root.fields.pageInfo.totalResults")
+        self.page_size = jmespath.compile("data.root.fields.pageInfo.pageSize")
+        self.fields = [(field, compile_path(field.path)) for field in fields]
+
+    def page_info(self, extract: Dict[str, Any]) -> Tuple[Any, Any, Any, Any]:
+        # (records, current page, total results, page size); None where absent
+        return (
+            self.records.search(extract),
+            self.page.search(extract),
+            self.total_results.search(extract),
+            self.page_size.search(extract),
+        )
+
+    def extract(
+        self, records: Iterable[Dict[str, Any]], base_url: str, scrape_date: str
+    ) -> Tuple[List[Product], Counter]:
+        # Returns a Product for every usable record, and
+        # failure counts keyed by (kind, field): kind is "missing", "invalid"
+        # (the converter raised) or "skipped" (a required field was unusable)
+        products = []
+        failures: Counter = Counter()
+        for record in records:
+            values = {}
+            for field, get in self.fields:
+                try:
+                    value = get(record)
+                except (KeyError, TypeError, IndexError):
+                    value = None
+                if value is None:
+                    kind = "missing"
+                else:
+                    try:
+                        value = field.convert(value) if field.convert else value
+                        kind = None
+                    except (KeyError, TypeError, ValueError, AttributeError):
+                        kind = "invalid"
+                if kind:
+                    name = field.name if isinstance(field.name, str) else field.name[0]
+                    if field.required:
+                        failures["skipped", name] += 1
+                        break
+                    if kind == "invalid" or not field.optional:
+                        failures[kind, name] += 1
+                    value = field.default
+                if isinstance(field.name, str):
+                    values[field.name] = value
+                else:
+                    values.update(zip(field.name, value))
+            else:
+                values["url"] = f"{base_url}/item/{values['id']}"
+                values["number_reviews"] = None
+                values["reviews_fetched_at"] = None
+                values["last_scrape_date"] = scrape_date
+                products.append(Product(**values))
+        return products, failures
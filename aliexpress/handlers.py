@@ -0,0 +1,38 @@
+import inspect
+import time
+
+from scrapy.core.downloader.handlers.base import BaseDownloadHandler
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.misc import build_from_crawler, load_object
+from twisted.internet.defer import Deferred
+
+
+class TimedDownloadHandler(BaseDownloadHandler):
+    # Runs every download through the handler named by TIMED_DOWNLOAD_HANDLER
+    # and stamps request.meta["download_started_at"] when the transfer starts,
+    # after the slot queue and delay. Only the handler sees that moment, and
+    # not every handler records download_latency (scrapy_impersonate does
+    # not), so the throttle middleware measures latency from this stamp.
+
+    def __init__(self, crawler) -> None:
+        super().__init__(crawler)
+        handler_class = load_object(crawler.settings.get("TIMED_DOWNLOAD_HANDLER"))
+        self.handler = build_from_crawler(handler_class, crawler)
+        # Older handlers return a Deferred and take the spider
+        self.old_style = not inspect.iscoroutinefunction(self.handler.download_request)
+
+    async def download_request(self, request):
+        request.meta["download_started_at"] = time.monotonic()
+        if self.old_style:
+            return await maybe_deferred_to_future(self.handler.download_request(request, self.crawler.spider))
+        return await self.handler.download_request(request)
+
+    async def close(self) -> None:
+        close = getattr(self.handler, "close", None)
+        if close is None:
+            return
+        result = close()
+        if isinstance(result, Deferred):
+            await maybe_deferred_to_future(result)
+        elif inspect.isawaitable(result):
+            await result
@@ -0,0 +1,120 @@
+import datetime
+import functools
+import hashlib
+import re
+import sqlite3
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+# One row per product and change point of sale_price, discount, trade_count or
+# star_rating, clustered on (product_id, observed_at) so a product's history is
+# a single range scan. Every column is an INTEGER, which SQLite stores as a 1-8
+# byte varint, and WITHOUT ROWID avoids a second b-tree for the primary key.
+HISTORY_SCHEMA = (
+    """
+CREATE TABLE IF NOT EXISTS {table} (
+    product_id INTEGER NOT NULL,
+    observed_at INTEGER NOT NULL,
+    sale_price_cents INTEGER,
+    discount INTEGER,
+    trade_count INTEGER,
+    star_rating_tenths INTEGER,
+    PRIMARY KEY (product_id, observed_at)
+) WITHOUT ROWID
+""",
+    # "all changes since T"
+    "CREATE INDEX IF NOT EXISTS {table}_observed_at ON {table} (observed_at)",
+)
+
+
+def create_history_table(conn: sqlite3.Connection, table: str = "product_history") -> None:
+    for statement in HISTORY_SCHEMA:
+        conn.execute(statement.format(table=table))
+
+
+def to_cents(price: Optional[float]) -> Optional[int]:
+    return None if price is None else int(round(price * 100))
+
+
+def to_tenths(rating: Optional[float]) -> Optional[int]:
+    return None if rating is None else int(round(rating * 10))
+
+
+def leading_int(value: Any) -> Optional[int]:
+    # "1000+" -> 1000; counts are scraped as text
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value
+    match = re.match(r"\d+", str(value))
+    return int(match.group()) if match else None
+
+
+# Items scraped in the same second share a date string, so parsing is cached
+@functools.lru_cache(maxsize=1024)
+def to_timestamp(scrape_date: str) -> int:
+    return int(datetime.datetime.strptime(scrape_date, "%Y-%m-%d %H:%M:%S").timestamp())
+
+
+def encode_observation(fields: Mapping[str, Any]) -> Optional[Tuple[Optional[int], ...]]:
+    # (product_id, observed_at, price cents, discount, trade count, rating tenths),
+    # or None when the product id is not numeric
+    try:
+        product_id = int(fields["id"])
+    except (TypeError, ValueError):
+        return None
+    discount = fields.get("discount")
+    return (
+        product_id,
+        to_timestamp(fields["last_scrape_date"]),
+        to_cents(fields.get("sale_price")),
+        None if discount is None else int(round(discount)),
+        leading_int(fields.get("trade_count")),
+        to_tenths(fields.get("star_rating")),
+    )
+
+
+def tracked_hash(observation: Tuple) -> int:
+    # Hash of the tracked values only, kept on the products row so a restart
+    # knows the last recorded state without scanning the history
+    payload = ",".join("" if value is None else str(value) for value in observation[2:])
+    digest = hashlib.blake2b(payload.encode("ascii"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def insert_sql(table: str = "product_history") -> str:
+    # Two changes within the same second keep the later one
+    return f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?, ?, ?)"
+
+
+def _decode(row: Tuple) -> Dict[str, Any]:
+    product_id, observed_at, cents, discount, trade_count, tenths = row
+    return {
+        "id": str(product_id),
+        "observed_at": datetime.datetime.fromtimestamp(observed_at).strftime("%Y-%m-%d %H:%M:%S"),
+        "sale_price": None if cents is None else cents / 100,
+        "discount": discount,
+        "trade_count": trade_count,
+        "star_rating": None if tenths is None else tenths / 10,
+    }
+
+
+def product_history(
+    conn: sqlite3.Connection, product_id: str, table: str = "product_history"
+) -> List[Dict[str, Any]]:
+    # Every recorded change of one product, oldest first
+    rows = conn.execute(
+        f"SELECT * FROM {table} WHERE product_id = ? ORDER BY observed_at", (int(product_id),)
+    )
+    return [_decode(tuple(row)) for row in rows]
+
+
+def changes_since(
+    conn: sqlite3.Connection, since: str, table: str = "product_history"
+) -> Iterator[Dict[str, Any]]:
+    # All changes observed at or after `since` ("%Y-%m-%d %H:%M:%S"), streamed
+    # in observation order so large ranges do not have to fit in memory
+    rows = conn.execute(
+        f"SELECT * FROM {table} WHERE observed_at >= ? ORDER BY observed_at", (to_timestamp(since),)
+    )
+    for row in rows:
+        yield _decode(tuple(row))
@@ -0,0 +1,145 @@
+import heapq
+import itertools
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+# Base share of each curl_cffi impersonation target, before feedback
+PROFILE_WEIGHTS = {
+    "chrome99": 15, "chrome100": 15, "chrome101": 15, "chrome104": 15,
+    "chrome107": 15, "chrome110": 15, "chrome116": 15, "chrome119": 15,
+    "chrome120": 65, "chrome123": 65, "chrome124": 65, "chrome131": 65,
+    "chrome99_android": 1, "chrome131_android": 1,
+    "edge99": 11, "edge101": 11,
+    "safari15_3": 5, "safari15_5": 5, "safari17_0": 5, "safari18_0": 5,
+    "safari17_2_ios": 1, "safari18_0_ios": 1,
+    "firefox133": 4,
+}
+
+
+class ProfileStats:
+    def __init__(self) -> None:
+        # Exponentially weighted; start optimistic so new profiles get tried
+        self.success_rate = 1.0
+        self.latency = 0.0
+        self.requests = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+
+class Session:
+    # A profile bound to its own cookie jar (Scrapy's "cookiejar" meta key)
+    def __init__(self, session_id: int, profile: str) -> None:
+        self.id = session_id
+        self.profile = profile
+
+
+class ImpersonationScheduler:
+    def __init__(
+        self,
+        weights: Optional[Dict[str, float]] = None,
+        pool_size: int = 16,
+        cooldown: float = 300.0,
+        failure_threshold: int = 3,
+        smoothing: float = 0.2,
+        rng: Optional[random.Random] = None,
+    ) -> None:
+        self.weights = dict(weights or PROFILE_WEIGHTS)
+        self.pool_size = max(1, pool_size)
+        self.cooldown = cooldown
+        self.failure_threshold = max(1, failure_threshold)
+        self.smoothing = smoothing
+        self.rng = rng or random.Random()
+        self.stats = {profile: ProfileStats() for profile in self.weights}
+        self.session_ids = itertools.count(1)
+        self.sessions: Dict[int, Session] = {}
+        # Session ids double as cookiejar keys, so the ids of dropped sessions
+        # are handed out again rather than leaving one jar behind per session
+        self.free_ids: List[int] = []
+        # Called with a session id whose cookies must go; set by the
+        # downloader middleware, which can reach CookiesMiddleware
+        self.forget_cookies: Optional[Callable[[int], None]] = None
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def from_settings(cls, settings) -> "ImpersonationScheduler":
+        return cls(
+            pool_size=settings.getint('IMPERSONATE_SESSION_POOL', 16),
+            cooldown=settings.getfloat('IMPERSONATE_COOLDOWN', 300.0),
+            failure_threshold=settings.getint('IMPERSONATE_FAILURE_THRESHOLD', 3),
+        )
+
+    def assign(self) -> Dict[str, Any]:
+        # Request meta for the next request: a session from the pool, weighted
+        # by how well its profile is doing
+        self._fill_pool()
+        sessions = list(self.sessions.values())
+        session = self.rng.choices(sessions, weights=[self._weight(s.profile) for s in sessions])[0]
+        return {"impersonate": session.profile, "cookiejar": session.id}
+
+    def record(self, meta: Dict[str, Any], ok: bool, latency: Optional[float] = None) -> None:
+        profile = meta.get("impersonate")
+        stats = self.stats.get(profile)
+        if stats is None:
+            return
+        stats.requests += 1
+        stats.success_rate += self.smoothing * ((1.0 if ok else 0.0) - stats.success_rate)
+        if latency is not None:
+            stats.latency += self.smoothing * (latency - stats.latency)
+        if ok:
+            stats.consecutive_failures = 0
+            return
+
+        stats.consecutive_failures += 1
+        session = self.sessions.get(meta.get("cookiejar"))
+        if session is not None and session.profile == profile:
+            # A blocked session's cookies are likely flagged too
+            self._drop(session)
+        if stats.consecutive_failures >= self.failure_threshold:
+            stats.cooldown_until = time.monotonic() + self.cooldown
+            stats.consecutive_failures = 0
+            for session in [s for s in self.sessions.values() if s.profile == profile]:
+                self._drop(session)
+            self.logger.info(f"Cooling down impersonation profile {profile} for {self.cooldown:.0f}s")
+
+    def success_rate(self, profile: str) -> Optional[float]:
+        stats = self.stats.get(profile)
+        return stats.success_rate if stats is not None else None
+
+    def _available(self) -> List[str]:
+        now = time.monotonic()
+        profiles = [profile for profile, stats in self.stats.items() if stats.cooldown_until <= now]
+        # If everything is cooling down, fall back to all profiles rather than stall
+        return profiles or list(self.stats)
+
+    def _weight(self, profile: str) -> float:
+        stats = self.stats[profile]
+        # Success counts quadratically so flaky profiles fade quickly; slow
+        # profiles lose share in proportion to their latency
+        return self.weights[profile] * max(stats.success_rate, 0.01) ** 2 / (1.0 + stats.latency)
+
+    def _fill_pool(self) -> None:
+        available = set(self._available())
+        for session in [s for s in self.sessions.values() if s.profile not in available]:
+            self._drop(session)
+        profiles = sorted(available)
+        while len(self.sessions) < self.pool_size:
+            profile = self.rng.choices(profiles, weights=[self._weight(p) for p in profiles])[0]
+            if self.free_ids:
+                session_id = heapq.heappop(self.free_ids)
+                # Requests of the old session may still have filled its jar
+                self._forget_cookies(session_id)
+            else:
+                session_id = next(self.session_ids)
+            session = Session(session_id, profile)
+            self.sessions[session.id] = session
+
+    def _drop(self, session: Session) -> None:
+        del self.sessions[session.id]
+        heapq.heappush(self.free_ids, session.id)
+        self._forget_cookies(session.id)
+
+    def _forget_cookies(self, session_id: int) -> None:
+        if self.forget_cookies is not None:
+            self.forget_cookies(session_id)
@@ -0,0 +1,264 @@
+# Per-stage timing histograms and an opt-in sampling profiler.
+#
+# The spider, middleware and pipelines call observe(stats, name, value) at the
+# end of each stage. Nothing is recorded unless the Instrumentation extension
+# is enabled for the crawl; it then publishes percentiles of every histogram
+# to the Scrapy stats (instrumentation/<name>/p50 ...), and with
+# INSTRUMENTATION_FILE set periodically dumps histograms and numeric stats as
+# Prometheus text (*.prom) or JSON (*.json). PROFILE_OUTPUT samples every
+# thread's stack and writes folded stacks for flamegraph.pl or speedscope when
+# the crawl ends.
+#
+#   scrapy crawl aliexpress -a query=... -s INSTRUMENTATION_FILE=metrics.prom -s PROFILE_OUTPUT=profile.folded
+
+import bisect
+import datetime
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import weakref
+from collections import Counter
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+# Upper bounds of the buckets; seconds for timings, plain counts for sizes
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 50000)
+
+PROMETHEUS_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+# stats collector -> Registry of the crawl it belongs to
+_registries: "weakref.WeakKeyDictionary[Any, Registry]" = weakref.WeakKeyDictionary()
+
+
+class Histogram:
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = tuple(bounds)
+        # One slot per bound plus the +Inf overflow
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q: float) -> float:
+        # Interpolated within the bucket holding the q-th observation, like
+        # Prometheus' histogram_quantile, and never above the largest value seen
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index > 0 else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(self.bounds + ("+Inf",), self.counts):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            return {"count": self.count, "sum": self.sum, "max": self.max, "buckets": buckets}
+
+
+class Registry:
+    def __init__(self) -> None:
+        # name -> (histogram, is a timing)
+        self.histograms: Dict[str, Tuple[Histogram, bool]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name: str, value: float, timing: bool = True) -> None:
+        entry = self.histograms.get(name)
+        if entry is None:
+            with self.lock:
+                entry = self.histograms.setdefault(name, (Histogram(TIME_BUCKETS if timing else SIZE_BUCKETS), timing))
+        entry[0].observe(value)
+
+    def publish(self, stats) -> None:
+        # Timings are published in milliseconds
+        for name, (histogram, timing) in list(self.histograms.items()):
+            scale, unit = (1000, "_ms") if timing else (1, "")
+            stats.set_value(f"instrumentation/{name}/count", histogram.count)
+            for label, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+                stats.set_value(f"instrumentation/{name}/{label}{unit}", round(histogram.quantile(q) * scale, 3))
+            stats.set_value(f"instrumentation/{name}/max{unit}", round(histogram.max * scale, 3))
+            if histogram.count:
+                stats.set_value(f"instrumentation/{name}/mean{unit}", round(histogram.sum / histogram.count * scale, 3))
+
+
+def observe(stats, name: str, value: float, timing: bool = True) -> None:
+    # Records one observation of `name` for the crawl owning `stats`; a no-op
+    # when instrumentation is off or the component runs outside a crawl
+    if stats is None:
+        return
+    registry = _registries.get(stats)
+    if registry is not None:
+        registry.observe(name, value, timing)
+
+
+def prometheus_name(name: str) -> str:
+    return "aliexpress_" + PROMETHEUS_NAME_RE.sub("_", name).strip("_").lower()
+
+
+def to_prometheus(registry: Registry, stats: Dict[str, Any]) -> str:
+    lines = []
+    for name, (histogram, timing) in sorted(registry.histograms.items()):
+        metric = prometheus_name(name) + ("_seconds" if timing else "")
+        snapshot = histogram.snapshot()
+        lines.append(f"# TYPE {metric} histogram")
+        for bound, cumulative in snapshot["buckets"].items():
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{metric}_sum {snapshot['sum']}")
+        lines.append(f"{metric}_count {snapshot['count']}")
+    lines.append("# TYPE aliexpress_stat gauge")
+    for key, value in sorted(stats.items()):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f'aliexpress_stat{{name="{key}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def to_json(registry: Registry, stats: Dict[str, Any]) -> str:
+    return json.dumps({
+        "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "histograms": {name: histogram.snapshot() for name, (histogram, _) in sorted(registry.histograms.items())},
+        "stats": {key: value for key, value in stats.items() if isinstance(value, (int, float, str))},
+    }, indent=2, sort_keys=True)
+
+
+class SamplingProfiler:
+    # Samples the stack of every other thread each `interval` seconds and
+    # counts identical stacks, in the folded format flamegraph.pl and
+    # speedscope read ("thread;outer;...;inner count")
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def write(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                # One entry per function rather than per line, so samples
+                # anywhere in a function add up
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(frames))] += 1
+
+
+class Instrumentation:
+    # Scrapy extension owning the crawl's Registry
+
+    def __init__(self, crawler) -> None:
+        settings = crawler.settings
+        if not settings.getbool("INSTRUMENTATION_ENABLED", True):
+            raise NotConfigured
+        self.stats = crawler.stats
+        self.crawler = crawler
+        self.registry = Registry()
+        self.dump_file = settings.get("INSTRUMENTATION_FILE")
+        self.interval = settings.getfloat("INSTRUMENTATION_INTERVAL", 30)
+        self.profile_output = settings.get("PROFILE_OUTPUT")
+        self.profiler = SamplingProfiler(settings.getfloat("PROFILE_INTERVAL", 0.005)) if self.profile_output else None
+        self.loop: Optional[task.LoopingCall] = None
+        self.engine_loop: Optional[task.LoopingCall] = None
+        self.logger = logging.getLogger(__name__)
+        _registries[self.stats] = self.registry
+
+    @classmethod
+    def from_crawler(cls, crawler) -> "Instrumentation":
+        extension = cls(crawler)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider) -> None:
+        if self.profiler:
+            self.profiler.start()
+            self.logger.info(f"Sampling profiler on, writing {self.profile_output} at close")
+        # Stats and the dump file are refreshed every interval, engine queues
+        # are sampled every second
+        if self.interval > 0:
+            self.loop = task.LoopingCall(self.dump)
+            self.loop.start(self.interval, now=False)
+        self.engine_loop = task.LoopingCall(self._sample_engine)
+        self.engine_loop.start(1, now=False)
+
+    def spider_closed(self, spider, reason) -> None:
+        for loop in (self.loop, self.engine_loop):
+            if loop and loop.running:
+                loop.stop()
+        self.dump()
+        if self.profiler:
+            self.profiler.stop()
+            self.profiler.write(self.profile_output)
+            self.logger.info(f"Wrote {sum(self.profiler.samples.values())} profile samples to {self.profile_output}")
+
+    def dump(self) -> None:
+        self.registry.publish(self.stats)
+        if not self.dump_file:
+            return
+        stats = self.stats.get_stats()
+        text = to_json(self.registry, stats) if self.dump_file.endswith(".json") else to_prometheus(self.registry, stats)
+        # Replaced atomically so a scraper never reads half a file
+        with open(f"{self.dump_file}.tmp", "w", encoding="utf-8") as file:
+            file.write(text)
+        os.replace(f"{self.dump_file}.tmp", self.dump_file)
+
+    def _sample_engine(self) -> None:
+        # Requests waiting in the scheduler and in flight in the downloader
+        engine = getattr(self.crawler, "engine", None)
+        if engine is None:
+            return
+        # The engine's slot was renamed to _slot in Scrapy 2.13
+        slot = getattr(engine, "_slot", None) or getattr(engine, "slot", None)
+        try:
+            self.registry.observe("scheduler/pending", len(slot.scheduler), timing=False)
+        except (AttributeError, TypeError):
+            pass
+        try:
+            self.registry.observe("downloader/active", len(engine.downloader.active), timing=False)
+        except (AttributeError, TypeError):
+            pass
@@ -3,10 +3,74 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
 
+import dataclasses
+import sys
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
 import scrapy
 
+from aliexpress.schema import split_count
+
 
 class AliexpressItem(scrapy.Item):
     # define the fields for your item here like:
     # name = scrapy.Field()
     pass
+
+
+@dataclass(slots=True)
+class Product:
+    # One search result. Slotted, so thousands of products waiting for their
+    # review request cost no per-instance __dict__; strings shared by many
+    # products are interned, and counts such as "1000+" are parsed once into
+    # an int and a "+" flag. ItemAdapter handles dataclasses, so the pipelines
+    # read it like the plain dicts used before.
+    id: str
+    skuId: Optional[str]
+    title: str
+    main_image: Optional[str]
+    url: str
+    sale_price: Optional[float]
+    original_price: Optional[float]
+    discount: Optional[float]
+    currency: str
+    trade_count: Optional[int]
+    trade_count_plus: bool
+    store_name: str
+    store_url: str
+    star_rating: Optional[float]
+    number_reviews: Optional[int]
+    reviews_fetched_at: Optional[str]
+    total_sales: Optional[int]
+    total_sales_plus: bool
+    images: Tuple[str, ...]
+    last_scrape_date: str
+    scrape_status: str = "successful"
+
+    # Values repeated across many products
+    INTERNED = ("currency", "store_name", "store_url", "last_scrape_date", "scrape_status")
+
+    def __post_init__(self) -> None:
+        for name in self.INTERNED:
+            value = getattr(self, name)
+            if type(value) is str:
+                setattr(self, name, sys.intern(value))
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Product":
+        # Rebuilds a product from its dict form, e.g. a crawl checkpoint. Dicts
+        # written before counts were parsed carry them as "1000+" strings.
+        values = {name: data.get(name) for name in PRODUCT_FIELDS}
+        for name in ("trade_count", "total_sales"):
+            if not isinstance(values[name], int):
+                count, plus = split_count(values[name])
+                values[name], values[f"{name}_plus"] = count, bool(plus)
+            values[f"{name}_plus"] = bool(values[f"{name}_plus"])
+        values["number_reviews"] = split_count(values["number_reviews"])[0]
+        values["images"] = tuple(values["images"] or ())
+        values["scrape_status"] = values["scrape_status"] or "successful"
+        return cls(**values)
+
+
+PRODUCT_FIELDS = tuple(field.name for field in dataclasses.fields(Product))
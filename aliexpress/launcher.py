@@ -0,0 +1,259 @@
+# Crawls with several worker processes on one host, so parsing is no longer
+# limited to one core.
+#
+#   python -m aliexpress.launcher "https://www.aliexpress.com/w/wholesale-....html?SearchText=..." --workers 4
+#   python -m aliexpress.launcher --queries-file queries.txt --workers 8 -s ADAPTIVE_THROTTLE_MAX_CONCURRENCY=4
+#
+# The queries are seeded into a SQLite work queue (aliexpress.work_queue) and
+# every worker runs AliexpressSpider against it: workers lease query, page
+# and review units, and put the pages and review requests they find back for
+# any worker to take. Workers do not write products themselves; their items
+# land in the queue's results table and this process merges them into
+# SQLITE_DATABASE through a single SQLiteWriter. A worker that dies is
+# restarted and its leased units are handed back; units that keep failing are
+# given up on after WORK_QUEUE_MAX_ATTEMPTS. Re-running the same command
+# resumes an interrupted crawl and retries failed units; the queue file is
+# removed once everything is done. With CHANGELOG_DIR set, workers also store
+# what each query listed, and this process appends the listed/delisted
+# records once the last results are merged.
+
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from aliexpress.changelog import ChangeLog, emit_listings
+from aliexpress.items import Product
+from aliexpress.pipelines import SQLiteWriter
+from aliexpress.work_queue import WorkQueue
+
+logger = logging.getLogger(__name__)
+
+
+def build_settings(overrides: Dict[str, str]):
+    # Project settings, the spider's own and then the command line, the way
+    # `scrapy crawl` layers them
+    from scrapy.settings import Settings
+    from aliexpress.spiders.aliexpress_spider import AliexpressSpider
+    settings = Settings()
+    settings.setmodule("aliexpress.settings", priority="project")
+    settings.setdict(AliexpressSpider.custom_settings, priority="spider")
+    settings.setdict(overrides, priority="cmdline")
+    return settings
+
+
+def queue_path(directory: str, queries: List[str]) -> str:
+    # Same queries, same queue, so a re-run resumes it
+    digest = hashlib.sha1("\n".join(queries).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(directory, f"aliexpress-{digest}.queue.db")
+
+
+def query_units(queries: List[str]):
+    from aliexpress.spiders.aliexpress_spider import query_key
+    for query in queries:
+        parsed_query = urlparse(query)
+        if "www.aliexpress" in parsed_query.netloc and parsed_query.path.startswith("/w/wholesale"):
+            key = query_key(query)
+            logger.info(f"Query {key}: {query}")
+            yield f"query:{query}", "query", {"url": query, "meta": {"query_key": key}, "priority": 0}, 0
+        else:
+            logger.error(f"Invalid input URL: {query}")
+
+
+def suffixed(path: Optional[str], worker: str) -> Optional[str]:
+    # metrics.prom -> metrics.worker-1.prom, so workers do not overwrite each other
+    if not path:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.{worker}{extension}"
+
+
+def run_worker(worker: str, overrides: Dict[str, str]) -> None:
+    from scrapy.crawler import CrawlerProcess
+    from aliexpress.spiders.aliexpress_spider import AliexpressSpider
+    settings = build_settings(overrides)
+    settings.setdict({
+        "WORK_QUEUE_WORKER": worker,
+        # The launcher is the only product writer; images are content-addressed,
+        # so every worker can store its own
+        "ITEM_PIPELINES": {"aliexpress.pipelines.ImageDownloader": 410},
+        # The work queue is the frontier
+        "CHECKPOINT_ENABLED": False,
+        # The launcher's writer keeps the change log, and the queue what
+        # each query listed
+        "CHANGELOG_DIR": None,
+        "WORK_QUEUE_LISTINGS": bool(settings.get("CHANGELOG_DIR")),
+        "INSTRUMENTATION_FILE": suffixed(settings.get("INSTRUMENTATION_FILE"), worker),
+        "PROFILE_OUTPUT": suffixed(settings.get("PROFILE_OUTPUT"), worker),
+        "LOG_FORMAT": f"%(asctime)s [{worker}] [%(name)s] %(levelname)s: %(message)s",
+    }, priority="cmdline")
+    process = CrawlerProcess(settings)
+    process.crawl(AliexpressSpider)
+    process.start()
+
+
+class Launcher:
+    def __init__(self, queue: WorkQueue, writer: SQLiteWriter, workers: int, overrides: Dict[str, str],
+                 max_restarts: int = 3, merge_interval: float = 1.0) -> None:
+        self.queue = queue
+        self.writer = writer
+        self.workers = workers
+        self.overrides = overrides
+        self.max_restarts = max_restarts
+        self.merge_interval = merge_interval
+        self.context = multiprocessing.get_context("spawn")
+        self.processes: Dict[str, multiprocessing.Process] = {}
+        self.restarts: Dict[str, int] = {}
+        # Highest results row already handed to the writer
+        self.merged_id = 0
+        self.merged = 0
+
+    def run(self) -> None:
+        self.writer.open_spider(None)
+        try:
+            for index in range(1, self.workers + 1):
+                self.start_worker(f"worker-{index}")
+            try:
+                while self.processes:
+                    self.merge()
+                    self.check_workers()
+                    time.sleep(self.merge_interval)
+            except KeyboardInterrupt:
+                # The workers got the same Ctrl-C and are shutting down
+                logger.info("Interrupted, waiting for the workers to stop")
+                for process in self.processes.values():
+                    process.join()
+            self.merge()
+        finally:
+            self.writer.stop_writer()
+        # Everything merged so far is in the database now
+        self.queue.discard_results(self.merged_id)
+
+    def start_worker(self, worker: str) -> None:
+        process = self.context.Process(target=run_worker, args=(worker, self.overrides), name=worker)
+        process.start()
+        self.processes[worker] = process
+        logger.info(f"Started {worker} (pid {process.pid})")
+
+    def check_workers(self) -> None:
+        for worker, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            del self.processes[worker]
+            if process.exitcode == 0:
+                logger.info(f"{worker} finished")
+                continue
+            released = self.queue.release(worker)
+            logger.error(f"{worker} exited with code {process.exitcode}; released {released} leased units")
+            if self.queue.finished():
+                continue
+            if self.restarts.get(worker, 0) >= self.max_restarts:
+                logger.error(f"{worker} restarted {self.max_restarts} times already, not restarting")
+                continue
+            self.restarts[worker] = self.restarts.get(worker, 0) + 1
+            self.start_worker(worker)
+
+    def merge(self) -> None:
+        while True:
+            results = self.queue.results(after=self.merged_id)
+            if not results:
+                return
+            for result_id, item in results:
+                self.writer.process_item(Product.from_dict(item), None)
+                self.merged_id = result_id
+                self.merged += 1
+
+
+def setting_override(text: str):
+    # argparse type for -s NAME=VALUE, shared with benchmarks.load
+    name, _, value = text.partition("=")
+    if not name or not _:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got {text!r}")
+    return name, value
+
+
+def main(argv=None) -> int:
+    from aliexpress.spiders.aliexpress_spider import load_queries
+    parser = argparse.ArgumentParser(description="Crawl with several worker processes sharing a SQLite work queue")
+    parser.add_argument("query", nargs="?", default="", help="search URL")
+    parser.add_argument("--queries-file", help="file with one search URL per line")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--queue", help="work queue database (default: derived from the queries, in CHECKPOINT_DIR)")
+    parser.add_argument("--max-restarts", type=int, default=3, help="restarts per crashed worker")
+    parser.add_argument("-s", "--set", type=setting_override, action="append", default=[], metavar="NAME=VALUE",
+                        help="override a spider setting, e.g. SQLITE_DATABASE=shop.db")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(asctime)s [launcher] [%(name)s] %(levelname)s: %(message)s")
+
+    queries = load_queries(args.query, args.queries_file)
+    if not queries:
+        logger.error("No query URL provided.")
+        return 1
+    overrides = dict(args.set)
+    settings = build_settings(overrides)
+    overrides["WORK_QUEUE"] = args.queue or queue_path(settings.get("CHECKPOINT_DIR") or ".", queries)
+    overrides.setdefault("LOG_LEVEL", args.log_level)
+    settings = build_settings(overrides)
+    database_name = settings.get("SQLITE_DATABASE")
+    if not database_name:
+        logger.error("SQLITE_DATABASE setting is required")
+        return 1
+
+    queue = WorkQueue.from_settings(settings).open()
+    # Whatever a previous, interrupted run had leased is free again, and
+    # units it gave up on get another round of attempts
+    released = queue.release(count_attempt=False)
+    requeued = queue.requeue_failed()
+    added = queue.add(query_units(queries))
+    logger.info(
+        f"Work queue {queue.path}: {added} new queries, {released} units released, {requeued} failed units requeued"
+    )
+
+    change_log = ChangeLog.from_settings(settings)
+    writer = SQLiteWriter(
+        database_name=database_name,
+        batch_size=settings.getint("SQLITE_BATCH_SIZE", 500),
+        flush_interval=settings.getfloat("SQLITE_FLUSH_INTERVAL", 5.0),
+        queue_size=settings.getint("SQLITE_QUEUE_SIZE", 10000),
+        history_table=settings.get("SQLITE_HISTORY_TABLE", "product_history") or None,
+        change_log=change_log.open() if change_log else None,
+    )
+    launcher = Launcher(queue, writer, max(1, args.workers), overrides, max_restarts=args.max_restarts)
+    started = time.monotonic()
+    try:
+        launcher.run()
+        if change_log:
+            # Listings stored by this and any interrupted earlier run; products
+            # missing from a query only count once nothing is left to crawl
+            listed, delisted = emit_listings(
+                change_log, queue.listings(), queue.incomplete_queries(), complete=queue.finished()
+            )
+            logger.info(f"Change log: {listed} products listed, {delisted} delisted")
+    finally:
+        if change_log:
+            change_log.close()
+    elapsed = time.monotonic() - started
+
+    counts = queue.counts()
+    logger.info(
+        f"Merged {launcher.merged} products into {database_name} in {elapsed:.1f}s "
+        f"({launcher.merged / elapsed if elapsed else 0:.1f}/s); units: "
+        + ", ".join(f"{count} {state}" for state, count in counts.items())
+    )
+    finished = queue.finished() and not counts["failed"]
+    queue.close()
+    if finished:
+        os.remove(queue.path)
+    elif counts["failed"]:
+        logger.warning(f"{counts['failed']} units failed; re-run the same command to retry them")
+    return 0 if finished else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,11 +3,17 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import time
+
 from scrapy import signals
+from scrapy.downloadermiddlewares.cookies import CookiesMiddleware
+from scrapy.exceptions import NotConfigured
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from aliexpress import instrumentation
+
 
 class AliexpressSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -56,49 +62,163 @@ class AliexpressSpiderMiddleware:
         spider.logger.info("Spider opened: %s" % spider.name)
 
 
+# Markers of the slider/captcha interstitial served instead of real content
+BLOCK_MARKERS = (b"x5secdata", b"/_____tmd_____/punish", b"baxia-punish")
+BLOCK_STATUSES = (403, 429)
+
+def is_blocked(response):
+    if response.status in BLOCK_STATUSES:
+        return True
+    if "/punish" in response.url or any(marker in response.body for marker in BLOCK_MARKERS):
+        return True
+    # A search page without a result list is what a soft block looks like
+    if "/w/wholesale" in response.url and response.status == 200:
+        return b"_dida_config_" not in response.body or b'"itemList"' not in response.body
+    return False
+
+
+class HostWindow:
+    # Concurrency/delay window of one download slot (one host)
+    def __init__(self, concurrency, delay):
+        self.concurrency = concurrency
+        self.delay = delay
+        self.successes = 0
+
+
 class AliexpressDownloaderMiddleware:
-    # Not all methods need to be defined. If a method is not defined,
-    # scrapy acts as if the downloader middleware does not modify the
-    # passed objects.
+    # Adaptive throttle: grows each host's concurrency additively while
+    # responses are fast and healthy, and halves it while doubling the delay
+    # whenever the host answers with a block.
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool("ADAPTIVE_THROTTLE_ENABLED", True):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.max_concurrency = settings.getint("ADAPTIVE_THROTTLE_MAX_CONCURRENCY", 8)
+        self.min_delay = settings.getfloat("ADAPTIVE_THROTTLE_MIN_DELAY", 0.25)
+        self.max_delay = settings.getfloat("ADAPTIVE_THROTTLE_MAX_DELAY", 60.0)
+        self.target_latency = settings.getfloat("ADAPTIVE_THROTTLE_TARGET_LATENCY", 3.0)
+        self.block_retries = settings.getint("ADAPTIVE_THROTTLE_BLOCK_RETRIES", 2)
+        self.windows = {}
 
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        s = cls(crawler)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
-    def process_request(self, request, spider):
-        # Called for each request that goes through the downloader
-        # middleware.
-
-        # Must either:
-        # - return None: continue processing this request
-        # - or return a Response object
-        # - or return a Request object
-        # - or raise IgnoreRequest: process_exception() methods of
-        #   installed downloader middleware will be called
-
-        return None
-
     def process_response(self, request, response, spider):
-        # Called with the response returned from the downloader.
-
-        # Must either;
-        # - return a Response object
-        # - return a Request object
-        # - or raise IgnoreRequest
+        key, slot = self._get_slot(request)
+        if slot is None:
+            return response
+        window = self._window(key, slot)
+        latency = self._latency(request)
+        impersonation = getattr(spider, "impersonation", None)
+        if latency is not None:
+            instrumentation.observe(self.stats, f"download/{key}", latency)
+        if request.meta.get("dont_throttle"):
+            return response
+
+        if is_blocked(response):
+            self._back_off(key, window)
+            self._apply(key, window, slot)
+            if impersonation is not None:
+                self._record(impersonation, request.meta, False, latency)
+            retries = request.meta.get("block_retries", 0)
+            if retries < self.block_retries:
+                self.stats.inc_value(f"throttle/{key}/block_retries")
+                retry = request.replace(dont_filter=True)
+                retry.meta["block_retries"] = retries + 1
+                if impersonation is not None:
+                    # Retry under another session rather than the one just blocked
+                    retry.meta.update(impersonation.assign())
+                return retry
+            return response
+
+        if impersonation is not None and 200 <= response.status < 400:
+            # Other statuses (404, 500) say nothing about the profile either way
+            self._record(impersonation, request.meta, True, latency)
+        if response.status == 200 and latency is not None and latency <= self.target_latency:
+            # Additive increase: one more parallel request per full window of successes
+            window.successes += 1
+            if window.successes >= window.concurrency:
+                window.successes = 0
+                window.concurrency = min(self.max_concurrency, window.concurrency + 1)
+                window.delay = max(self.min_delay, window.delay * 0.75)
+        elif latency is not None and latency > self.target_latency:
+            window.successes = 0
+            window.delay = min(self.max_delay, max(self.min_delay, window.delay) * 1.25)
+        self._apply(key, window, slot)
         return response
 
     def process_exception(self, request, exception, spider):
-        # Called when a download handler or a process_request()
-        # (from other downloader middleware) raises an exception.
+        # Timeouts and connection errors: slow down but keep the window size
+        if request.meta.get("dont_throttle"):
+            return None
+        impersonation = getattr(spider, "impersonation", None)
+        if impersonation is not None:
+            self._record(impersonation, request.meta, False, None)
+        key, slot = self._get_slot(request)
+        if slot is not None:
+            window = self._window(key, slot)
+            window.successes = 0
+            window.delay = min(self.max_delay, max(self.min_delay, window.delay) * 1.5)
+            self._apply(key, window, slot)
+        return None
 
-        # Must either:
-        # - return None: continue processing this exception
-        # - return a Response object: stops process_exception() chain
-        # - return a Request object: stops process_exception() chain
-        pass
+    def _latency(self, request):
+        # From when aliexpress.handlers.TimedDownloadHandler started the
+        # transfer, so it does not depend on the handler filling in
+        # download_latency; that is only the fallback without the wrapper
+        started = request.meta.get("download_started_at")
+        if started is not None:
+            return time.monotonic() - started
+        return request.meta.get("download_latency")
+
+    def _record(self, impersonation, meta, ok, latency):
+        profile = meta.get("impersonate")
+        if impersonation.success_rate(profile) is None:
+            return
+        impersonation.record(meta, ok, latency)
+        self.stats.inc_value(f"impersonation/{profile}/{'ok' if ok else 'failed'}")
+        self.stats.set_value(f"impersonation/{profile}/success_rate", round(impersonation.success_rate(profile), 3))
+
+    def _forget_cookies(self, jar):
+        # Empties a retired impersonation session's cookie jar
+        for middleware in self.crawler.engine.downloader.middleware.middlewares:
+            if isinstance(middleware, CookiesMiddleware):
+                middleware.jars.pop(jar, None)
+
+    def _get_slot(self, request):
+        key = request.meta.get("download_slot")
+        if key is None:
+            return None, None
+        return key, self.crawler.engine.downloader.slots.get(key)
+
+    def _window(self, key, slot):
+        window = self.windows.get(key)
+        if window is None:
+            # Start from the configured per-domain concurrency and delay
+            window = self.windows[key] = HostWindow(slot.concurrency, slot.delay)
+        return window
+
+    def _back_off(self, key, window):
+        window.successes = 0
+        window.concurrency = max(1, window.concurrency // 2)
+        window.delay = min(self.max_delay, max(1.0, window.delay * 2))
+        self.stats.inc_value(f"throttle/{key}/blocked")
+
+    def _apply(self, key, window, slot):
+        slot.concurrency = window.concurrency
+        slot.delay = window.delay
+        self.stats.set_value(f"throttle/{key}/concurrency", window.concurrency)
+        self.stats.set_value(f"throttle/{key}/delay", round(window.delay, 3))
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+        impersonation = getattr(spider, "impersonation", None)
+        if impersonation is not None:
+            impersonation.forget_cookies = self._forget_cookies
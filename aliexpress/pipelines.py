@@ -12,194 +12,1096 @@ class AliexpressPipeline:
     def process_item(self, item, spider):
         return item
 
+import datetime
+import functools
+import hashlib
+import json
+import queue
 import sqlite3
+import threading
+import time
 import traceback
 import logging
-from typing import Any, Dict, List, Optional
-from scrapy.exceptions import NotConfigured
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+from scrapy import Request, signals
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+from scrapy.utils.defer import deferred_from_coro
+from twisted.internet import defer, threads
+
+from aliexpress import changelog, history, instrumentation, schema, signals as aliexpress_signals
+
+# Sentinel telling a writer thread to flush, close and exit
+_STOP = object()
+
+class ThreadedWriter:
+    # Base for pipelines whose disk I/O runs on a dedicated writer thread.
+    # process_item hands a snapshot of the item to a bounded queue and returns
+    # a Deferred; when the queue is full the Deferred only fires once the
+    # writer has made room, which holds back Scrapy's item processing instead
+    # of blocking the reactor. Subclasses implement _write, _flush,
+    # _has_pending, _pending_count and _close, all of which run on the writer
+    # thread, and call _timed_flush rather than _flush.
+    #
+    # With crawler signals, the ids of the items are reported in an
+    # items_committed signal once a flush has made them durable, which is
+    # what the crawl checkpoint waits for.
+
+    stat_prefix = "writer"
+    # False for writers whose output is only complete once _close has run;
+    # their items are reported committed then
+    commits_on_flush = True
+
+    def __init__(self, queue_size: int = 10000, flush_interval: float = 5.0, stats=None, signals=None) -> None:
+        self.queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+        self.flush_interval = flush_interval
+        self.stats = stats
+        self.signals = signals
+        self.thread: Optional[threading.Thread] = None
+        # (job, item, deferred) waiting for room in the queue; reactor thread only
+        self.waiting: List[Tuple[Any, Any, defer.Deferred]] = []
+        # Ids of the items written since the last commit; writer thread only
+        self.uncommitted: List[Any] = []
+        self.logger = logging.getLogger(__name__)
+
+    def start_writer(self) -> None:
+        self.thread = threading.Thread(target=self._run, name=f"{type(self).__name__}-writer", daemon=True)
+        self.thread.start()
+        if self.signals is not None:
+            self.signals.send_catch_log(signal=aliexpress_signals.writer_started, writer=self)
+
+    def stop_writer(self) -> Optional[defer.Deferred]:
+        # Drains the queue and waits for the writer to finish its last flush
+        if self.thread is None:
+            return None
+        from twisted.internet import reactor
+        if reactor.running:
+            return threads.deferToThread(self._join)
+        self._join()
+        return None
+
+    def enqueue(self, job: Any, item: Any) -> defer.Deferred:
+        from twisted.internet import reactor
+        # The writer thread gets the item's id along, to report it committed
+        job = (job, ItemAdapter(item).get("id") if self.signals is not None else None)
+        if not reactor.running:
+            # Used outside a crawl (benchmarks, scripts): plain blocking put
+            self.queue.put(job)
+            return defer.succeed(item)
+        if not self.waiting:
+            try:
+                self.queue.put_nowait(job)
+                return defer.succeed(item)
+            except queue.Full:
+                pass
+        self._inc_stat(f"{self.stat_prefix}/backpressure")
+        d = defer.Deferred()
+        self.waiting.append((job, item, d))
+        # The writer may have made room, and found nobody waiting, between the
+        # failed put and the append; nothing would admit the job after that
+        self._admit_waiting()
+        return d
+
+    def _join(self) -> None:
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def _admit_waiting(self) -> None:
+        while self.waiting:
+            job, item, d = self.waiting[0]
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                return
+            self.waiting.pop(0)
+            d.callback(item)
+
+    def _run(self) -> None:
+        from twisted.internet import reactor
+        while True:
+            try:
+                job = self.queue.get(timeout=self.flush_interval if self.flush_interval > 0 else None)
+            except queue.Empty:
+                job = None
+            if self.waiting:
+                reactor.callFromThread(self._admit_waiting)
+            try:
+                if job is _STOP:
+                    self._timed_flush()
+                    self._close()
+                    self._committed(self.uncommitted)
+                    return
+                if job is not None:
+                    job, item_id = job
+                    self._write(job)
+                    # After _write, which may flush earlier items on its own
+                    if item_id is not None:
+                        self.uncommitted.append(item_id)
+                if self.flush_interval > 0 and self._has_pending() and \
+                        time.monotonic() - self.last_flush >= self.flush_interval:
+                    self._timed_flush()
+            except Exception as e:
+                self.logger.error(f"Error in {type(self).__name__} writer thread: {e}\n{traceback.format_exc()}")
+                if job is _STOP:
+                    return
+
+    def _inc_stat(self, key: str) -> None:
+        if self.stats is not None:
+            self.stats.inc_value(key)
+
+    def _inc_stat_by(self, key: str, count: int) -> None:
+        if self.stats is not None:
+            self.stats.inc_value(key, count)
+
+    def _timed_flush(self) -> None:
+        # _flush, recording its latency, the batch it wrote and how many jobs
+        # were queued behind it
+        batch = self._pending_count()
+        written = None
+        if self.commits_on_flush:
+            written, self.uncommitted = self.uncommitted, []
+        started = time.perf_counter()
+        self._flush()
+        if written:
+            self._committed(written)
+        if batch:
+            instrumentation.observe(self.stats, f"{self.stat_prefix}/flush", time.perf_counter() - started)
+            instrumentation.observe(self.stats, f"{self.stat_prefix}/batch_size", batch, timing=False)
+            instrumentation.observe(self.stats, f"{self.stat_prefix}/queue_depth", self.queue.qsize(), timing=False)
+
+    def _committed(self, ids: List[Any]) -> None:
+        if self.signals is None or not ids:
+            return
+        from twisted.internet import reactor
+        reactor.callFromThread(
+            self.signals.send_catch_log, signal=aliexpress_signals.items_committed, writer=self, ids=ids
+        )
 
-class SQLiteWriter:
-    def __init__(self, database_name: str, table_name: str = "products") -> None:
+    def _write(self, job: Any) -> None:
+        raise NotImplementedError
+
+    def _flush(self) -> None:
+        raise NotImplementedError
+
+    def _has_pending(self) -> bool:
+        raise NotImplementedError
+
+    def _pending_count(self) -> int:
+        raise NotImplementedError
+
+    def _close(self) -> None:
+        raise NotImplementedError
+
+
+def configure_connection(conn: sqlite3.Connection) -> None:
+    # WAL keeps readers unblocked while a batch is written, and with WAL
+    # synchronous=NORMAL only syncs on checkpoints instead of every commit.
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -65536")
+    conn.execute("PRAGMA mmap_size = 268435456")
+
+# Bookkeeping fields that change on every crawl and must not affect the hash
+HASH_EXCLUDED_FIELDS = frozenset({"last_scrape_date", "reviews_fetched_at", "content_hash", "history_hash"})
+
+def content_hash(fields: Mapping[str, Any]) -> int:
+    # Stable 64-bit hash of the business fields, stored as a signed SQLite INTEGER
+    payload = json.dumps(
+        {key: value for key, value in fields.items() if key not in HASH_EXCLUDED_FIELDS},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str,
+    )
+    digest = hashlib.blake2b(payload.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class SQLiteWriter(ThreadedWriter):
+    stat_prefix = "sqlite"
+
+    def __init__(
+        self,
+        database_name: str,
+        table_name: str = "products",
+        batch_size: int = 500,
+        flush_interval: float = 5.0,
+        stats=None,
+        queue_size: int = 10000,
+        history_table: Optional[str] = "product_history",
+        change_log: Optional[changelog.ChangeLog] = None,
+        signals=None,
+    ) -> None:
+        super().__init__(queue_size=queue_size, flush_interval=flush_interval, stats=stats, signals=signals)
         self.database_name = database_name
         self.table_name = table_name
+        self.history_table = history_table
+        self.batch_size = max(1, batch_size)
         self.conn: Optional[sqlite3.Connection] = None
-        self.logger = logging.getLogger(__name__)
+        # Pending rows as (columns, values, image URLs) in the normalized layout;
+        # values are captured when the item is buffered because later pipelines
+        # may still mutate the item.
+        self.buffer: List[Tuple[Tuple[str, ...], Tuple[Any, ...], Optional[List[str]]]] = []
+        # store id -> (id, name, url) as last written, and stores rows to write
+        self.stores: Dict[int, Tuple[int, Any, Any]] = {}
+        self.store_rows: List[Tuple[int, Any, Any]] = []
+        # Pending (last_scrape_date, reviews_fetched_at, id) of products whose content is unchanged
+        self.touches: List[Tuple[Any, Any, Any]] = []
+        # id -> content hash of the stored row, preloaded at open_spider and
+        # afterwards only touched by the writer thread
+        self.hashes: Dict[Any, Optional[int]] = {}
+        # id -> history_hash of the last recorded change point, and the
+        # change points waiting for the next flush
+        self.history_hashes: Dict[Any, Optional[int]] = {}
+        self.observations: List[Tuple[Optional[int], ...]] = []
+        # Change log records for the pending rows, appended once they are
+        # committed, and the ids of the products among those rows
+        self.change_log = change_log
+        self.changes: List[Dict[str, Any]] = []
+        self.buffered_ids: set = set()
+        self.last_flush = time.monotonic()
 
     @classmethod
     def from_crawler(cls, crawler) -> "SQLiteWriter":
         database_name = crawler.settings.get('SQLITE_DATABASE')
         if not database_name:
             raise NotConfigured("SQLITE_DATABASE setting is required")
-        return cls(database_name=database_name)
+        feed = changelog.feed_for(crawler.stats)
+        return cls(
+            database_name=database_name,
+            batch_size=crawler.settings.getint('SQLITE_BATCH_SIZE', 500),
+            flush_interval=crawler.settings.getfloat('SQLITE_FLUSH_INTERVAL', 5.0),
+            stats=crawler.stats,
+            queue_size=crawler.settings.getint('SQLITE_QUEUE_SIZE', 10000),
+            history_table=crawler.settings.get('SQLITE_HISTORY_TABLE', "product_history") or None,
+            change_log=feed.changelog if feed is not None else None,
+            signals=crawler.signals,
+        )
 
     def open_spider(self, spider) -> None:
         try:
-            self.conn = sqlite3.connect(self.database_name)
+            # Set up here, then used only by the writer thread
+            self.conn = sqlite3.connect(self.database_name, check_same_thread=False)
             self.conn.text_factory = lambda x: x.decode("utf-8", errors="ignore")
             self.conn.row_factory = sqlite3.Row
+            configure_connection(self.conn)
             self.logger.info(f"Connected to SQLite database: {self.database_name}")
             self._create_table_if_not_exists()
+            self._load_hashes()
         except sqlite3.Error as e:
             self.logger.error(f"Error connecting to SQLite: {e}")
             raise
+        self.start_writer()
 
-    def close_spider(self, spider) -> None:
-        if self.conn:
-            self.conn.close()
-            self.logger.info("Closed SQLite connection")
+    def close_spider(self, spider) -> Optional[defer.Deferred]:
+        return self.stop_writer()
 
-    def process_item(self, item: Dict[str, Any], spider) -> Dict[str, Any]:
+    def process_item(self, item: Dict[str, Any], spider):
         if not self.conn:
             self.logger.error("No database connection available.")
             return item
-        try:
-            self._do_update_or_insert(item)
-        except Exception as e:
-            self.logger.error(
-                f"Error processing item with id {item.get('id', 'UNKNOWN')}: {e}\n{traceback.format_exc()}"
+        adapter = ItemAdapter(item)
+        columns = tuple(adapter.field_names())
+        return self.enqueue((columns, tuple(adapter[column] for column in columns)), item)
+
+    def _write(self, job: Tuple[Tuple[str, ...], Tuple[Any, ...]]) -> None:
+        columns, values = job
+        fields = dict(zip(columns, values))
+        product_id = fields["id"]
+        digest = content_hash(fields)
+        stored_digest = self.hashes.get(product_id, False)
+
+        if stored_digest == digest:
+            # Unchanged product: only bump last_scrape_date, and reviews_fetched_at
+            # when the reviews were fetched again, never read the row back
+            self.touches.append((fields["last_scrape_date"], fields.get("reviews_fetched_at"), product_id))
+            self._inc_stat("sqlite/items_unchanged")
+        else:
+            # Tracked fields can only change when the content hash does
+            history_digest = self._observe(fields)
+            row_columns, row_values, store, images = schema.normalize(fields)
+            if self.change_log is not None:
+                self._record_change(fields, stored_digest is False, row_columns, row_values, store, images)
+            if store is not None and self.stores.get(store[0]) != store:
+                self.stores[store[0]] = store
+                self.store_rows.append(store)
+            self.buffer.append(
+                (row_columns + ("content_hash", "history_hash"), row_values + (digest, history_digest), images)
             )
-        return item
+            self._inc_stat("sqlite/items_inserted" if stored_digest is False else "sqlite/items_changed")
+            self.buffered_ids.add(product_id)
+        self.hashes[product_id] = digest
+
+        if len(self.buffer) + len(self.touches) >= self.batch_size:
+            self._timed_flush()
+
+    def _observe(self, fields: Dict[str, Any]) -> Optional[int]:
+        # Queues a change point when a tracked field differs from the last one
+        # recorded, and returns the history_hash to store on the products row
+        if not self.history_table:
+            return None
+        observation = history.encode_observation(fields)
+        if observation is None:
+            return None
+        product_id = fields["id"]
+        history_digest = history.tracked_hash(observation)
+        if self.history_hashes.get(product_id) != history_digest:
+            self.observations.append(observation)
+            self.history_hashes[product_id] = history_digest
+            self._inc_stat("sqlite/history_changes")
+        return history_digest
+
+    def _record_change(self, fields: Dict[str, Any], inserted: bool, columns: Tuple[str, ...],
+                       values: Tuple[Any, ...], store: Optional[Tuple[int, Any, Any]],
+                       images: Optional[List[str]]) -> None:
+        # Queues the change log record of a new product, or of the fields that
+        # differ from its stored row; the content hash already said something did
+        new = dict(zip(columns, values))
+        if store is not None:
+            new["store_name"], new["store_url"] = store[1], store[2]
+        if images is not None:
+            new["images"] = images
+        for name in ("id", "store_id", *HASH_EXCLUDED_FIELDS):
+            new.pop(name, None)
+        product_id = fields["id"]
+        # A review refresh keeps the search's last_scrape_date but is newer
+        seen_at = max(filter(None, (fields.get("last_scrape_date"), fields.get("reviews_fetched_at"))), default=None)
+        record = {"id": product_id, "at": seen_at}
+        if inserted:
+            self.changes.append({"op": "insert", **record, "fields": new})
+            return
+        old = self._stored_fields(product_id, tuple(new))
+        changes = {name: [old.get(name), value] for name, value in new.items() if old.get(name) != value}
+        if changes:
+            self.changes.append({"op": "update", **record, "changes": changes})
+
+    def _stored_fields(self, product_id: Any, names: Tuple[str, ...]) -> Dict[str, Any]:
+        # The stored values of `names`, in the shape _record_change compares
+        if product_id in self.buffered_ids:
+            # An earlier version is still in the batch
+            self._timed_flush()
+        columns = [name for name in names if name not in ("store_name", "store_url", "images")]
+        row = self.conn.execute(
+            f"SELECT {', '.join(f'p.{column}' for column in columns + ['id'])}, s.name, s.url "
+            f"FROM {self.table_name} p LEFT JOIN {schema.STORES_TABLE} s ON s.id = p.store_id WHERE p.id = ?",
+            (product_id,),
+        ).fetchone()
+        if row is None:
+            return {}
+        stored = dict(zip(columns, tuple(row)))
+        stored["store_name"], stored["store_url"] = row[-2], row[-1]
+        if "images" in names:
+            stored["images"] = [url for url, in self.conn.execute(
+                f"SELECT url FROM {schema.IMAGES_TABLE} WHERE product_id = ? ORDER BY position", (product_id,)
+            )]
+        return stored
+
+    def _has_pending(self) -> bool:
+        return bool(self.buffer or self.touches)
+
+    def _pending_count(self) -> int:
+        return len(self.buffer) + len(self.touches)
+
+    def _close(self) -> None:
+        self.conn.close()
+        self.conn = None
+        self.logger.info("Closed SQLite connection")
 
     def _create_table_if_not_exists(self) -> None:
-        create_table_sql = f"""
-        CREATE TABLE IF NOT EXISTS {self.table_name} (
-            id TEXT NOT NULL PRIMARY KEY,
-            skuid TEXT Not NULL,
-            title TEXT NOT NULL,
-            main_image TEXT,
-            url TEXT NOT NULL,
-            sale_price REAL,
-            original_price REAL,
-            discount REAL,
-            currency CHAR(3) NOT NULL,
-            trade_count INTEGER,
-            store_name TEXT,
-            store_url TEXT,
-            star_rating REAL,
-            number_reviews INTEGER,
-            total_sales TEXT,
-            images TEXT,
-            last_scrape_date TEXT NOT NULL,
-            scrape_status CHAR NOT NULL
-        )
-        """
         try:
+            migrated = schema.migrate(self.conn, self.table_name)
+            if migrated:
+                self.logger.info(f"Migrated {migrated} rows of '{self.table_name}' to the normalized schema")
             with self.conn:
-                self.conn.execute(create_table_sql)
+                schema.create_tables(self.conn, self.table_name)
+                if self.history_table:
+                    history.create_history_table(self.conn, self.history_table)
             self.logger.debug(f"Created '{self.table_name}' table")
         except sqlite3.Error as e:
             self.logger.error(f"Error creating table: {e}")
             raise
 
-    def _do_update_or_insert(self, item: Dict[str, Any]) -> None:
-        keys = item.keys()
-        columns = ", ".join(keys)
-        placeholders = ", ".join("?" for _ in keys)
-        args = tuple(item[key] for key in keys)
+    def _load_hashes(self) -> None:
+        # Rows written before content hashes existed have NULL here and are
+        # treated as changed once, which stores their hash. Ids are stored as
+        # integers but items carry them as strings.
+        cursor = self.conn.execute(f"SELECT id, content_hash, history_hash FROM {self.table_name}")
+        cursor.row_factory = None
+        for product_id, digest, history_digest in cursor:
+            self.hashes[str(product_id)] = digest
+            if history_digest is not None:
+                self.history_hashes[str(product_id)] = history_digest
+        self.logger.info(f"Loaded {len(self.hashes)} content hashes from '{self.table_name}'")
+        cursor = self.conn.execute(f"SELECT id, name, url FROM {schema.STORES_TABLE}")
+        cursor.row_factory = None
+        self.stores = {row[0]: row for row in cursor}
+
+    def _flush(self) -> None:
+        self.last_flush = time.monotonic()
+        if not self.buffer and not self.touches:
+            return
+        rows, self.buffer = self.buffer, []
+        touches, self.touches = self.touches, []
+        observations, self.observations = self.observations, []
+        store_rows, self.store_rows = self.store_rows, []
+        changes, self.changes = self.changes, []
+        self.buffered_ids = set()
+
+        # executemany needs one statement per column layout; items from the
+        # spider all share the same keys, so this is normally a single group.
+        groups: Dict[Tuple[str, ...], List[Tuple[Any, ...]]] = {}
+        image_owners: List[Tuple[Any]] = []
+        image_rows: List[Tuple[Any, int, str]] = []
+        for columns, values, images in rows:
+            groups.setdefault(columns, []).append(values)
+            if images is not None:
+                product_id = values[columns.index("id")]
+                image_owners.append((product_id,))
+                image_rows.extend(schema.image_rows(product_id, images))
 
-        # Check if the record already exists
         try:
-            cursor = self.conn.cursor()
-            cursor.execute(f"SELECT * FROM {self.table_name} WHERE id = ?", (item["id"],))
-            existing_record = cursor.fetchone()
+            with self.conn:
+                if store_rows:
+                    self.conn.executemany(schema.store_upsert_sql(), store_rows)
+                for columns, args in groups.items():
+                    self.conn.executemany(self._upsert_sql(columns), args)
+                if image_owners:
+                    # A changed product's image list replaces the stored one
+                    self.conn.executemany(schema.image_delete_sql(), image_owners)
+                    self.conn.executemany(schema.image_insert_sql(), image_rows)
+                if touches:
+                    self.conn.executemany(self._touch_sql(), touches)
+                if observations:
+                    self.conn.executemany(history.insert_sql(self.history_table), observations)
+            self.logger.debug(f"Flushed {len(rows)} items and {len(touches)} touches to '{self.table_name}'")
         except sqlite3.Error as e:
-            self.logger.error(f"Error checking for existing record with id: {item['id']} - {e}")
-            raise
+            self.logger.error(f"Error flushing batch of {len(rows)} items: {e}; retrying one by one")
+            self._stores_one_by_one(store_rows)
+            self._flush_one_by_one(rows)
+            self._touch_one_by_one(touches)
+            self._observe_one_by_one(observations)
+            # Rows that still failed lost their hash and are retried later
+            changes = [change for change in changes if change["id"] in self.hashes]
+        self._log_changes(changes)
 
-        if existing_record:
-            # Prepare the UPDATE clause for existing records
-            update_columns = []
-            update_args = []
+    def _log_changes(self, changes: List[Dict[str, Any]]) -> None:
+        if not changes:
+            return
+        try:
+            self.change_log.append(changes)
+        except OSError as e:
+            self.logger.error(f"Error appending {len(changes)} records to the change log: {e}")
+            return
+        self._inc_stat_by("changelog/records", len(changes))
 
-            for key in keys:
-                if key == "last_scrape_date":
-                    update_columns.append(f"{key} = ?")
-                    update_args.append(item[key])  # Always update last_scrape_date
-                else:
-                    # Only update if the value differs
-                    existing_value = existing_record[key]  # Access the existing value by key
-                    if item[key] != existing_value:
-                        update_columns.append(f"{key} = ?")
-                        update_args.append(item[key])
-
-            if update_columns:
-                # Update only if there's something to update
-                update_clause = ", ".join(update_columns)
-                update_sql = f"UPDATE {self.table_name} SET {update_clause} WHERE id = ?"
-                update_args.append(item["id"])  # Add the id for the WHERE clause
-                try:
-                    with self.conn:
-                        self.conn.execute(update_sql, update_args)
-                except sqlite3.Error as e:
-                    self.logger.error(f"Error updating record with id: {item['id']} - {e}")
-                    raise
-            
-        else:
-            # Insert a new record if it doesn't exist
-            insert_sql = f"INSERT INTO {self.table_name} ({columns}) VALUES ({placeholders})"
+    def _stores_one_by_one(self, store_rows: List[Tuple[int, Any, Any]]) -> None:
+        for store in store_rows:
             try:
                 with self.conn:
-                    self.conn.execute(insert_sql, args)
+                    self.conn.execute(schema.store_upsert_sql(), store)
             except sqlite3.Error as e:
-                self.logger.error(f"Error inserting new record with id: {item['id']} - {e}")
-                raise
+                self.stores.pop(store[0], None)
+                self.logger.error(f"Error writing store with id: {store[0]} - {e}")
+
+    def _flush_one_by_one(self, rows: List[Tuple[Tuple[str, ...], Tuple[Any, ...], Optional[List[str]]]]) -> None:
+        # Isolate the rows that make the batch fail so the rest still get stored.
+        for columns, values, images in rows:
+            try:
+                with self.conn:
+                    self.conn.execute(self._upsert_sql(columns), values)
+                    if images is not None:
+                        product_id = values[columns.index("id")]
+                        self.conn.execute(schema.image_delete_sql(), (product_id,))
+                        self.conn.executemany(schema.image_insert_sql(), schema.image_rows(product_id, images))
+            except sqlite3.Error as e:
+                item_id = values[columns.index("id")] if "id" in columns else "UNKNOWN"
+                # Forget the hashes so the next sighting retries the full write
+                self.hashes.pop(item_id, None)
+                self.history_hashes.pop(item_id, None)
+                self.logger.error(
+                    f"Error processing item with id {item_id}: {e}\n{traceback.format_exc()}"
+                )
+
+    def _touch_one_by_one(self, touches: List[Tuple[Any, Any, Any]]) -> None:
+        for args in touches:
+            try:
+                with self.conn:
+                    self.conn.execute(self._touch_sql(), args)
+            except sqlite3.Error as e:
+                self.logger.error(f"Error updating record with id: {args[-1]} - {e}")
+
+    def _observe_one_by_one(self, observations: List[Tuple[Optional[int], ...]]) -> None:
+        for observation in observations:
+            try:
+                with self.conn:
+                    self.conn.execute(history.insert_sql(self.history_table), observation)
+            except sqlite3.Error as e:
+                self.logger.error(f"Error recording history for id: {observation[0]} - {e}")
+
+    def _touch_sql(self) -> str:
+        # A re-fetched review count that did not change still restarts the
+        # review cache's TTL
+        return (
+            f"UPDATE {self.table_name} SET last_scrape_date = ?, "
+            f"reviews_fetched_at = COALESCE(?, reviews_fetched_at) WHERE id = ?"
+        )
+
+    def _upsert_sql(self, columns: Tuple[str, ...]) -> str:
+        # Assigning a column its current value leaves it unchanged, so this keeps
+        # the old rule: only last_scrape_date and differing columns change, and
+        # columns missing from the item keep their stored value.
+        placeholders = ", ".join("?" for _ in columns)
+        assignments = ", ".join(f"{column} = excluded.{column}" for column in columns if column != "id")
+        return (
+            f"INSERT INTO {self.table_name} ({', '.join(columns)}) VALUES ({placeholders}) "
+            f"ON CONFLICT(id) DO UPDATE SET {assignments}"
+        )
 
 
-import json
 import os
 
-class JsonWriter:
-    def __init__(self, filename="products.json"):
+def compact_jsonl(log_filename: str, index: Dict[str, int], output: str, output_format: str = "json") -> int:
+    # Streams the latest line of every product from the append-only log into
+    # output, so memory stays bounded by the id index rather than the data.
+    tmp_output = f"{output}.tmp"
+    written = 0
+    with open(log_filename, "rb") as log, open(tmp_output, "w", encoding="utf-8") as out:
+        if output_format == "json":
+            out.write("[")
+        for offset in sorted(index.values()):
+            log.seek(offset)
+            line = log.readline().decode("utf-8").rstrip("\n")
+            if output_format == "json":
+                out.write(",\n" if written else "\n")
+            out.write(line)
+            if output_format != "json":
+                out.write("\n")
+            written += 1
+        if output_format == "json":
+            out.write("\n]\n" if written else "]\n")
+    os.replace(tmp_output, output)
+    return written
+
+
+class JsonWriter(ThreadedWriter):
+    stat_prefix = "json"
+
+    def __init__(self, filename="products.json", log_filename=None, output_format="json", compact_on_close=True,
+                 queue_size=10000, flush_interval=5.0, stats=None, signals=None):
+        super().__init__(queue_size=queue_size, flush_interval=flush_interval, stats=stats, signals=signals)
         self.filename = filename
-        self.data_cache = []
-        self.batch_size = 10  # Adjust batch size as needed
-        # Ensure the file exists
-        if not os.path.exists(self.filename):
-            with open(self.filename, "w") as file:
-                json.dump([], file)
-    
+        self.log_filename = log_filename or f"{os.path.splitext(filename)[0]}.jsonl"
+        self.output_format = output_format
+        self.compact_on_close = compact_on_close
+        # id -> (byte offset of the latest line in the log, digest of that line)
+        self.index: Dict[str, Tuple[int, bytes]] = {}
+        self.log_lines = 0
+        self.log_file = None
+        # Lines written since the last flush
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+    @classmethod
+    def from_crawler(cls, crawler) -> "JsonWriter":
+        filename = crawler.settings.get('JSON_OUTPUT', "products.json")
+        if not filename:
+            raise NotConfigured("JSON_OUTPUT is empty")
+        return cls(
+            filename=filename,
+            log_filename=crawler.settings.get('JSON_LOG_FILE'),
+            output_format=crawler.settings.get('JSON_OUTPUT_FORMAT', "json"),
+            compact_on_close=crawler.settings.getbool('JSON_COMPACT_ON_CLOSE', True),
+            queue_size=crawler.settings.getint('JSON_QUEUE_SIZE', 10000),
+            stats=crawler.stats,
+            signals=crawler.signals,
+        )
+
+    def open_spider(self, spider):
+        if not os.path.exists(self.log_filename) and os.path.exists(self.filename):
+            self._seed_log_from_output()
+        self._load_index()
+        self.log_file = open(self.log_filename, "ab")
+        self.start_writer()
+
+    def close_spider(self, spider):
+        return self.stop_writer()
+
     def process_item(self, item, spider):
         try:
+            adapter = ItemAdapter(item)
             # Convert images field from JSON string to list if necessary
-            if isinstance(item.get("images"), str):
+            if isinstance(adapter.get("images"), str):
                 try:
-                    item["images"] = json.loads(item["images"])
+                    adapter["images"] = json.loads(adapter["images"])
                 except json.JSONDecodeError:
                     spider.logger.error("Error decoding images field to list")
-                    item["images"] = []
-            
-            # Read existing data
-            with open(self.filename, "r") as file:
-                existing_data = json.load(file)
-            
-            # Check if item already exists
-            product_index = next((i for i, prod in enumerate(existing_data) if prod.get("id") == item["id"]), None)
-            
-            if product_index is not None:
-                # Check if any field has changed
-                existing_product = existing_data[product_index]
-                if any(existing_product.get(k) != item[k] for k in item):
-                    existing_data[product_index] = item  # Update record
-            else:
-                self.data_cache.append(item)  # Add new record to cache
-            
-            # Save when cache reaches batch size
-            if len(self.data_cache) >= self.batch_size:
-                self._flush_data(existing_data)
+                    adapter["images"] = []
+            # asdict() copies the item, so later pipelines cannot change what gets written
+            return self.enqueue(adapter.asdict(), item)
         except Exception as e:
             spider.logger.error(f"Error processing item: {e}")
         return item
-    
-    def _flush_data(self, existing_data):
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        digest = hashlib.blake2b(line, digest_size=16).digest()
+        existing = self.index.get(record["id"])
+
+        # Only append when the product is new or any field has changed
+        if existing is None or existing[1] != digest:
+            offset = self.log_file.tell()
+            self.log_file.write(line)
+            self.log_lines += 1
+            self.unflushed += 1
+            self.index[record["id"]] = (offset, digest)
+
+    def _flush(self):
+        self.last_flush = time.monotonic()
+        if self.log_file and self.unflushed:
+            self.log_file.flush()
+            self.unflushed = 0
+
+    def _has_pending(self):
+        return bool(self.unflushed)
+
+    def _pending_count(self):
+        return self.unflushed
+
+    def _close(self):
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+        if self.compact_on_close:
+            self.compact()
+
+    def compact(self) -> None:
+        if not os.path.exists(self.log_filename):
+            return
+        try:
+            offsets = {product_id: offset for product_id, (offset, _) in self.index.items()}
+            written = compact_jsonl(self.log_filename, offsets, self.filename, self.output_format)
+            self.logger.info(f"Compacted {written} products from {self.log_filename} into {self.filename}")
+            if self.log_lines > 2 * len(self.index):
+                # Most of the log is superseded versions; keep only the latest ones
+                compact_jsonl(self.log_filename, offsets, self.log_filename, "jsonl")
+                self._load_index()
+        except Exception as e:
+            self.logger.error(f"Error compacting {self.log_filename}: {e}")
+
+    def _load_index(self) -> None:
+        self.index = {}
+        self.log_lines = 0
+        if not os.path.exists(self.log_filename):
+            return
+        offset = 0
+        with open(self.log_filename, "rb") as log:
+            for line in log:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    product_id = json.loads(line)["id"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    self.logger.error(f"Skipping malformed line at offset {offset} in {self.log_filename}")
+                else:
+                    self.index[product_id] = (offset, hashlib.blake2b(line, digest_size=16).digest())
+                self.log_lines += 1
+                offset += len(line)
+        if offset < os.path.getsize(self.log_filename):
+            # Drop a partial line left by an interrupted write before appending
+            with open(self.log_filename, "r+b") as log:
+                log.truncate(offset)
+        self.logger.info(f"Indexed {len(self.index)} products from {self.log_filename}")
+
+    def _seed_log_from_output(self) -> None:
+        # One-off migration of an existing products.json written by the old writer
+        try:
+            with open(self.filename, "r") as file:
+                existing_data = json.load(file) if self.output_format == "json" else [
+                    json.loads(line) for line in file if line.strip()
+                ]
+        except (OSError, json.JSONDecodeError) as e:
+            self.logger.error(f"Could not seed {self.log_filename} from {self.filename}: {e}")
+            return
+        with open(self.log_filename, "wb") as log:
+            for product in existing_data:
+                log.write(json.dumps(product, ensure_ascii=False).encode("utf-8") + b"\n")
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_scrape_date(value: Optional[str]) -> Optional[datetime.datetime]:
+    return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S") if value else None
+
+
+class ParquetWriter(ThreadedWriter):
+    # Streams products into a Parquet file, one row group per row_group_size
+    # items, so memory is bounded by a single row group. The file is written
+    # under a temporary name and moved into place on close, since a Parquet
+    # file is only readable once its footer is written.
+    stat_prefix = "parquet"
+    commits_on_flush = False
+
+    # Typed columns; counts are split like the SQLite schema does
+    FLOAT_FIELDS = ("sale_price", "original_price", "discount", "star_rating")
+    COUNT_FIELDS = ("trade_count", "total_sales")
+    STRING_FIELDS = ("id", "skuId", "title", "main_image", "url", "currency", "store_name", "store_url",
+                     "scrape_status")
+    DATE_FIELDS = ("last_scrape_date", "reviews_fetched_at")
+
+    def __init__(self, filename: str, row_group_size: int = 10000, compression: str = "zstd",
+                 queue_size: int = 10000, stats=None, signals=None) -> None:
+        # No periodic flushes: row groups are only cut at row_group_size
+        super().__init__(queue_size=queue_size, flush_interval=0, stats=stats, signals=signals)
+        self.filename = filename
+        self.row_group_size = max(1, row_group_size)
+        self.compression = compression
+        self.columns: Dict[str, List[Any]] = {}
+        self.rows = 0
+        self.written = 0
+        self.writer = None
+        self.arrow_schema = None
+        self.last_flush = time.monotonic()
+
+    @classmethod
+    def from_crawler(cls, crawler) -> "ParquetWriter":
+        filename = crawler.settings.get('PARQUET_OUTPUT')
+        if not filename:
+            raise NotConfigured("PARQUET_OUTPUT is not set")
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise NotConfigured("ParquetWriter needs pyarrow")
+        return cls(
+            filename=filename,
+            row_group_size=crawler.settings.getint('PARQUET_ROW_GROUP_SIZE', 10000),
+            compression=crawler.settings.get('PARQUET_COMPRESSION', "zstd"),
+            queue_size=crawler.settings.getint('PARQUET_QUEUE_SIZE', 10000),
+            stats=crawler.stats,
+            signals=crawler.signals,
+        )
+
+    def open_spider(self, spider) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        fields = [pa.field(name, pa.string()) for name in self.STRING_FIELDS]
+        fields += [pa.field(name, pa.float64()) for name in self.FLOAT_FIELDS]
+        for name in self.COUNT_FIELDS:
+            fields += [pa.field(name, pa.int64()), pa.field(f"{name}_plus", pa.bool_())]
+        fields += [
+            pa.field("number_reviews", pa.int64()),
+            pa.field("images", pa.list_(pa.string())),
+        ]
+        fields += [pa.field(name, pa.timestamp("s")) for name in self.DATE_FIELDS]
+        self.arrow_schema = pa.schema(fields)
+        self._reset_columns()
+        self.writer = pq.ParquetWriter(f"{self.filename}.tmp", self.arrow_schema, compression=self.compression)
+        self.start_writer()
+
+    def close_spider(self, spider) -> Optional[defer.Deferred]:
+        return self.stop_writer()
+
+    def process_item(self, item, spider):
+        return self.enqueue(ItemAdapter(item).asdict(), item)
+
+    def _reset_columns(self) -> None:
+        self.columns = {name: [] for name in self.arrow_schema.names}
+        self.rows = 0
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        columns = self.columns
+        for name in self.STRING_FIELDS:
+            value = record.get(name)
+            columns[name].append(None if value is None else str(value))
+        for name in self.FLOAT_FIELDS:
+            value = record.get(name)
+            columns[name].append(None if value is None else float(value))
+        for name in self.COUNT_FIELDS:
+            count, plus = schema.split_count(record.get(name))
+            columns[name].append(count)
+            columns[f"{name}_plus"].append(bool(record.get(f"{name}_plus", plus)))
+        columns["number_reviews"].append(schema.split_count(record.get("number_reviews"))[0])
+        columns["images"].append(schema.parse_images(record.get("images")))
+        for name in self.DATE_FIELDS:
+            columns[name].append(parse_scrape_date(record.get(name)))
+        self.rows += 1
+        if self.rows >= self.row_group_size:
+            self._timed_flush()
+
+    def _flush(self) -> None:
+        import pyarrow as pa
+        self.last_flush = time.monotonic()
+        if not self.rows:
+            return
+        table = pa.Table.from_pydict(self.columns, schema=self.arrow_schema)
+        self.writer.write_table(table, row_group_size=self.rows)
+        self.written += self.rows
+        self._inc_stat("parquet/row_groups")
+        self._reset_columns()
+
+    def _has_pending(self) -> bool:
+        return False
+
+    def _pending_count(self) -> int:
+        return self.rows
+
+    def _close(self) -> None:
+        self.writer.close()
+        self.writer = None
+        os.replace(f"{self.filename}.tmp", self.filename)
+        self.logger.info(f"Wrote {self.written} products to {self.filename}")
+
+
+# Leading bytes of the image formats the CDN serves -> file extension
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"GIF8", ".gif"),
+    (b"RIFF", ".webp"),
+)
+
+IMAGE_INDEX_SCHEMA = (
+    """
+CREATE TABLE IF NOT EXISTS images (
+    url TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    fetched_at TEXT NOT NULL
+) WITHOUT ROWID
+""",
+    # Every URL sharing a file
+    "CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256)",
+)
+
+
+def image_extension(body: bytes) -> str:
+    for signature, extension in IMAGE_SIGNATURES:
+        if body.startswith(signature):
+            return extension
+    return ".bin"
+
+
+def content_path(digest: str, extension: str) -> str:
+    # Fanned out over 256 directories so none grows too large to list
+    return os.path.join(digest[:2], f"{digest}{extension}")
+
+
+def store_image(root: str, body: bytes) -> Tuple[str, str, bool]:
+    # Writes `body` under its content hash unless that file already exists;
+    # returns (sha256, path relative to root, whether it was new)
+    digest = hashlib.sha256(body).hexdigest()
+    path = content_path(digest, image_extension(body))
+    full_path = os.path.join(root, "full", path)
+    if os.path.exists(full_path):
+        return digest, path, False
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    # Renamed into place, so a file under its hash is always complete
+    tmp_path = f"{full_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(body)
+    os.replace(tmp_path, full_path)
+    return digest, path, True
+
+
+def make_thumbnail(source: str, target: str, size: int) -> None:
+    # Runs in the thumbnail process pool
+    from PIL import Image
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with Image.open(source) as image:
+        image.thumbnail((size, size))
+        image.convert("RGB").save(f"{target}.tmp", "JPEG", quality=85)
+    os.replace(f"{target}.tmp", target)
+
+
+class ImageDownloader:
+    # Downloads the main_image and images of every product into IMAGES_STORE,
+    # through the crawler's downloader on the "images" download slot. Files are
+    # named by the SHA-256 of their content (full/ab/abcd....jpg), so an image
+    # shared by several products or stores is kept once, and the images table
+    # of IMAGES_STORE/index.db maps every URL to its file; URLs already in it
+    # are not fetched again. At most IMAGES_CONCURRENCY downloads are in
+    # flight; once IMAGES_QUEUE_SIZE more are waiting, item processing waits
+    # too. Hashing and writing run on the thread pool, and with
+    # IMAGES_THUMBNAIL_SIZE set (needs Pillow) new files also get a JPEG
+    # thumbnail from a pool of IMAGES_THUMBNAIL_WORKERS processes.
+
+    def __init__(self, crawler, store: str, concurrency: int = 16, queue_size: int = 1000,
+                 thumbnail_size: int = 0, thumbnail_workers: int = 2, stats=None) -> None:
+        self.crawler = crawler
+        self.store = store
+        self.semaphore = defer.DeferredSemaphore(max(1, concurrency))
+        self.queue_size = max(1, queue_size)
+        self.thumbnail_size = thumbnail_size
+        self.thumbnail_workers = max(1, thumbnail_workers)
+        self.stats = stats
+        self.executor = None
+        self.conn: Optional[sqlite3.Connection] = None
+        # URLs in the index or requested in this run
+        self.known: set = set()
+        # Index rows waiting for the next flush
+        self.rows: List[Tuple[str, str, str, int, str]] = []
+        # Downloads and thumbnails not finished yet, and items waiting for room
+        self.pending: set = set()
+        self.waiting: List[Tuple[Any, defer.Deferred]] = []
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def from_crawler(cls, crawler) -> "ImageDownloader":
+        store = crawler.settings.get('IMAGES_STORE')
+        if not store:
+            raise NotConfigured("IMAGES_STORE is not set")
+        pipeline = cls(
+            crawler,
+            store=store,
+            concurrency=crawler.settings.getint('IMAGES_CONCURRENCY', 16),
+            queue_size=crawler.settings.getint('IMAGES_QUEUE_SIZE', 1000),
+            thumbnail_size=crawler.settings.getint('IMAGES_THUMBNAIL_SIZE', 0),
+            thumbnail_workers=crawler.settings.getint('IMAGES_THUMBNAIL_WORKERS', 2),
+            stats=crawler.stats,
+        )
+        crawler.signals.connect(pipeline.spider_idle, signal=signals.spider_idle)
+        return pipeline
+
+    def spider_idle(self, spider) -> None:
+        # Downloads waiting for the semaphore are not in the downloader yet
+        if self.pending:
+            raise DontCloseSpider
+
+    def open_spider(self, spider) -> None:
+        os.makedirs(self.store, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(self.store, "index.db"))
+        configure_connection(self.conn)
+        with self.conn:
+            for statement in IMAGE_INDEX_SCHEMA:
+                self.conn.execute(statement)
+        self.known = {url for url, in self.conn.execute("SELECT url FROM images")}
+        self.logger.info(f"Loaded {len(self.known)} image URLs from {self.store}/index.db")
+        if self.thumbnail_size > 0:
+            try:
+                import PIL  # noqa: F401
+            except ImportError:
+                self.logger.warning("IMAGES_THUMBNAIL_SIZE is set but Pillow is not installed; no thumbnails")
+                self.thumbnail_size = 0
+            else:
+                import concurrent.futures
+                import multiprocessing
+                # Spawned, not forked from a process running threads
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    self.thumbnail_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+
+    def close_spider(self, spider) -> defer.Deferred:
+        d = defer.DeferredList(list(self.pending))
+        d.addBoth(lambda _: threads.deferToThread(self._shutdown_executor))
+        d.addBoth(lambda _: self._close_index())
+        return d
+
+    def process_item(self, item, spider):
+        adapter = ItemAdapter(item)
+        urls = [adapter.get("main_image"), *(adapter.get("images") or ())]
+        for url in dict.fromkeys(urls):
+            if not url or url in self.known:
+                if url:
+                    self._inc_stat("images/known")
+                continue
+            self.known.add(url)
+            self._inc_stat("images/requested")
+            self._track(self.semaphore.run(self._fetch, url))
+        if len(self.semaphore.waiting) < self.queue_size:
+            return item
+        # Hold the item back until the downloads catch up
+        self._inc_stat("images/backpressure")
+        d = defer.Deferred()
+        self.waiting.append((item, d))
+        return d
+
+    def _track(self, d: defer.Deferred) -> None:
+        self.pending.add(d)
+        d.addBoth(self._untrack, d)
+
+    def _untrack(self, result, d: defer.Deferred):
+        self.pending.discard(d)
+        while self.waiting and len(self.semaphore.waiting) < self.queue_size:
+            item, waiting = self.waiting.pop(0)
+            waiting.callback(item)
+        return None
+
+    @defer.inlineCallbacks
+    def _fetch(self, url: str):
+        request = Request(
+            url,
+            headers={"referer": "https://www.aliexpress.com/"},
+            # The CDN gets its own slot, outside the adaptive throttle
+            meta={"download_slot": "images", "dont_throttle": True},
+        )
+        started = time.perf_counter()
         try:
-            # Append cached data
-            existing_data.extend(self.data_cache)
-            
-            # Write back to file
-            with open(self.filename, "w") as file:
-                json.dump(existing_data, file, indent=4)
-            
-            # Clear cache
-            self.data_cache = []
+            response = yield deferred_from_coro(self.crawler.engine.download_async(request))
         except Exception as e:
-            print(f"Error saving batch data: {e}")
+            self._failed(url, repr(e))
+            return
+        if response.status != 200 or not response.body:
+            self._failed(url, f"HTTP {response.status}")
+            return
+        instrumentation.observe(self.stats, "images/download", time.perf_counter() - started)
+        body = response.body
+        digest, path, created = yield threads.deferToThread(store_image, self.store, body)
+        self._inc_stat("images/downloaded")
+        self._inc_stat("images/stored" if created else "images/duplicates")
+        if self.stats is not None:
+            self.stats.inc_value("images/bytes", len(body))
+        self.rows.append((url, digest, path, len(body), datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+        if len(self.rows) >= 500:
+            self._flush_index()
+        if created and self.executor is not None:
+            self._track(self._thumbnail(digest, path))
+
+    def _thumbnail(self, digest: str, path: str) -> defer.Deferred:
+        from twisted.internet import reactor
+        source = os.path.join(self.store, "full", path)
+        target = os.path.join(self.store, "thumbs", str(self.thumbnail_size), content_path(digest, ".jpg"))
+        d = defer.Deferred()
+        future = self.executor.submit(make_thumbnail, source, target, self.thumbnail_size)
+        # Done callbacks run on the pool's management thread
+        future.add_done_callback(lambda future: reactor.callFromThread(self._thumbnail_done, future, d, path))
+        return d
+
+    def _thumbnail_done(self, future, d: defer.Deferred, path: str) -> None:
+        error = future.exception()
+        if error is None:
+            self._inc_stat("images/thumbnails")
+        else:
+            self._inc_stat("images/thumbnail_failed")
+            self.logger.warning(f"Could not make a thumbnail of {path}: {error}")
+        d.callback(None)
+
+    def _failed(self, url: str, reason: str) -> None:
+        # Left out of the index, so the next crawl tries again
+        self.known.discard(url)
+        self._inc_stat("images/failed")
+        self.logger.debug(f"Image download failed for {url}: {reason}")
+
+    def _flush_index(self) -> None:
+        if not self.rows or not self.conn:
+            return
+        rows, self.rows = self.rows, []
+        try:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            self.logger.error(f"Error writing {len(rows)} rows to the image index: {e}")
+
+    def _shutdown_executor(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def _close_index(self) -> None:
+        self._flush_index()
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+    def _inc_stat(self, key: str) -> None:
+        if self.stats is not None:
+            self.stats.inc_value(key)
@@ -0,0 +1,189 @@
+# Filtered, paginated queries over the products database.
+#
+#   python -m aliexpress.query products.db --search "phone case" --max-price 10
+#   python -m aliexpress.query products.db --store "Store 12 Official" --order-by rating --format csv -o out.csv
+#
+# Results are streamed from the cursor straight to the output, so exports of
+# any size run in constant memory.
+
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from aliexpress import schema
+
+COLUMNS = (
+    "id", "skuId", "title", "main_image", "url", "sale_price", "original_price", "discount", "currency",
+    "trade_count", "store_name", "store_url", "star_rating", "number_reviews", "total_sales", "images",
+    "last_scrape_date", "scrape_status", "reviews_fetched_at",
+)
+
+ORDERINGS = {
+    "price": "p.sale_price",
+    "rating": "p.star_rating",
+    "date": "p.last_scrape_date",
+    "id": "p.id",
+    # bm25 rank, only with --search
+    "relevance": "f.rank",
+}
+
+
+def build_query(
+    search: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    min_rating: Optional[float] = None,
+    store: Optional[str] = None,
+    since: Optional[str] = None,
+    order_by: Optional[str] = None,
+    descending: bool = False,
+    limit: Optional[int] = None,
+    offset: int = 0,
+    table: str = "products",
+) -> Tuple[str, List[Any]]:
+    # Every filter maps onto an indexed column; store matches a numeric store
+    # id or an exact store name
+    conditions: List[str] = []
+    params: List[Any] = []
+    joins = f"LEFT JOIN {schema.STORES_TABLE} s ON s.id = p.store_id"
+    if search:
+        joins = f"JOIN {table}_fts f ON f.rowid = p.id " + joins
+        conditions.append(f"{table}_fts MATCH ?")
+        params.append(search)
+    if min_price is not None:
+        conditions.append("p.sale_price >= ?")
+        params.append(min_price)
+    if max_price is not None:
+        conditions.append("p.sale_price <= ?")
+        params.append(max_price)
+    if min_rating is not None:
+        conditions.append("p.star_rating >= ?")
+        params.append(min_rating)
+    if store:
+        if store.isdigit():
+            conditions.append("p.store_id = ?")
+            params.append(int(store))
+        else:
+            conditions.append(f"p.store_id IN (SELECT id FROM {schema.STORES_TABLE} WHERE name = ?)")
+            params.append(store)
+    if since:
+        conditions.append("p.last_scrape_date >= ?")
+        params.append(since)
+
+    order_by = order_by or ("relevance" if search else "id")
+    if order_by not in ORDERINGS:
+        raise ValueError(f"order_by must be one of {', '.join(ORDERINGS)}")
+    if order_by == "relevance" and not search:
+        raise ValueError("relevance ordering needs a search")
+
+    sql = f"""
+        SELECT
+            p.id, p.skuid, p.title, p.main_image, p.url, p.sale_price, p.original_price, p.discount, p.currency,
+            p.trade_count || CASE WHEN p.trade_count_plus THEN '+' ELSE '' END,
+            s.name, s.url, p.star_rating, p.number_reviews,
+            p.total_sales || CASE WHEN p.total_sales_plus THEN '+' ELSE '' END,
+            (
+                SELECT json_group_array(url) FROM (
+                    SELECT url FROM {schema.IMAGES_TABLE} i WHERE i.product_id = p.id ORDER BY position
+                )
+            ),
+            p.last_scrape_date, p.scrape_status, p.reviews_fetched_at
+        FROM {table} p {joins}
+    """
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += f" ORDER BY {ORDERINGS[order_by]}{' DESC' if descending else ''}, p.id"
+    if limit is not None or offset:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit if limit is not None else -1, offset]
+    return sql, params
+
+
+def connect(database_name: str) -> sqlite3.Connection:
+    return sqlite3.connect(f"file:{database_name}?mode=ro", uri=True)
+
+
+def query(conn: sqlite3.Connection, **filters) -> Iterator[Dict[str, Any]]:
+    # Yields products as dicts shaped like the spider's items, one at a time
+    sql, params = build_query(**filters)
+    for row in conn.execute(sql, params):
+        product = dict(zip(COLUMNS, row))
+        product["id"] = str(product["id"])
+        product["images"] = json.loads(product["images"]) if product["images"] else []
+        yield product
+
+
+def write_jsonl(products: Iterator[Dict[str, Any]], out) -> int:
+    written = 0
+    for product in products:
+        out.write(json.dumps(product, ensure_ascii=False))
+        out.write("\n")
+        written += 1
+    return written
+
+
+def write_csv(products: Iterator[Dict[str, Any]], out) -> int:
+    writer = csv.writer(out)
+    writer.writerow(COLUMNS)
+    written = 0
+    for product in products:
+        product["images"] = json.dumps(product["images"])
+        writer.writerow(product[column] for column in COLUMNS)
+        written += 1
+    return written
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Query the products database written by SQLiteWriter")
+    parser.add_argument("database")
+    parser.add_argument("--search", help="FTS5 query over titles, e.g. 'phone case' or 'case NOT silicone'")
+    parser.add_argument("--min-price", type=float)
+    parser.add_argument("--max-price", type=float)
+    parser.add_argument("--min-rating", type=float)
+    parser.add_argument("--store", help="store id or exact store name")
+    parser.add_argument("--since", help="only products scraped at or after this time (YYYY-MM-DD HH:MM:SS)")
+    parser.add_argument("--order-by", choices=sorted(ORDERINGS))
+    parser.add_argument("--desc", action="store_true", help="sort descending")
+    parser.add_argument("--limit", type=int, help="page size")
+    parser.add_argument("--page", type=int, help="1-based page number, with --limit")
+    parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    args = parser.parse_args(argv)
+    if args.page is not None and not args.limit:
+        parser.error("--page needs --limit")
+    if args.page is not None and args.page < 1:
+        parser.error("--page starts at 1")
+
+    filters = dict(
+        search=args.search,
+        min_price=args.min_price,
+        max_price=args.max_price,
+        min_rating=args.min_rating,
+        store=args.store,
+        since=args.since,
+        order_by=args.order_by,
+        descending=args.desc,
+        limit=args.limit,
+        offset=(args.page - 1) * args.limit if args.page else 0,
+    )
+    conn = connect(args.database)
+    out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    try:
+        write = write_csv if args.format == "csv" else write_jsonl
+        written = write(query(conn, **filters), out)
+    except (ValueError, sqlite3.Error) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        conn.close()
+    print(f"{written} products", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+import datetime
+import logging
+import os
+import sqlite3
+from typing import Dict, Optional, Tuple
+
+
+class ReviewCache:
+    # Review counts fetched within the last `ttl` seconds, read from the
+    # products table that SQLiteWriter maintains.
+
+    def __init__(self, database_name: str, ttl: float, table_name: str = "products") -> None:
+        self.database_name = database_name
+        self.ttl = ttl
+        self.table_name = table_name
+        # id -> (number_reviews, reviews_fetched_at)
+        self.entries: Dict[str, Tuple[Optional[int], str]] = {}
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def from_settings(cls, settings) -> Optional["ReviewCache"]:
+        database_name = settings.get('SQLITE_DATABASE')
+        ttl = settings.getfloat('REVIEW_CACHE_TTL', 0)
+        if not database_name or ttl <= 0:
+            return None
+        return cls(database_name=database_name, ttl=ttl)
+
+    def load(self) -> None:
+        if not os.path.exists(self.database_name):
+            return
+        cutoff = (datetime.datetime.now() - datetime.timedelta(seconds=self.ttl)).strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            conn = sqlite3.connect(f"file:{self.database_name}?mode=ro", uri=True)
+            try:
+                rows = conn.execute(
+                    f"SELECT id, number_reviews, reviews_fetched_at FROM {self.table_name} "
+                    f"WHERE reviews_fetched_at >= ?",
+                    (cutoff,),
+                )
+                # Ids are text in items but integers in the table
+                self.entries = {
+                    str(product_id): (number_reviews, fetched_at)
+                    for product_id, number_reviews, fetched_at in rows
+                }
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            # A database without the reviews_fetched_at column simply has no cache yet
+            self.logger.warning(f"Review cache not loaded from {self.database_name}: {e}")
+            return
+        self.logger.info(f"Loaded {len(self.entries)} fresh review counts from {self.database_name}")
+
+    def get(self, product_id: str) -> Optional[Tuple[Optional[int], str]]:
+        return self.entries.get(product_id)
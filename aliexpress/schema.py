@@ -0,0 +1,309 @@
+# Normalized SQLite layout for scraped products.
+#
+# Store names and URLs live once in `stores`, image URLs in `product_images`,
+# and counts such as "1000+" are split into an INTEGER and a "+" flag. The
+# `products_flat` view rebuilds the original one-row-per-product shape for
+# queries written against the old table.
+#
+#   python -m aliexpress.schema products.db     # migrate an existing database
+
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import sys
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+STORES_TABLE = "stores"
+IMAGES_TABLE = "product_images"
+
+# Item fields that are not stored as products columns of the same name.
+# Counts arrive either as "1000+" strings or already split into an int and a
+# *_plus flag (Product); the flag is written together with its count.
+SPLIT_COUNT_FIELDS = frozenset({"trade_count", "total_sales"})
+SKIPPED_FIELDS = frozenset({"store_name", "store_url", "images", "trade_count_plus", "total_sales_plus"})
+
+COUNT_RE = re.compile(r"(\d+)(\+?)")
+STORE_ID_RE = re.compile(r"/store/(\d+)")
+
+logger = logging.getLogger(__name__)
+
+
+def schema(table: str = "products") -> Tuple[str, ...]:
+    return (
+        f"""
+        CREATE TABLE IF NOT EXISTS {STORES_TABLE} (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            url TEXT
+        )
+        """,
+        # INTEGER PRIMARY KEY makes the product id the rowid, so there is no
+        # separate index holding a second copy of every id
+        f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY,
+            skuid TEXT NOT NULL,
+            title TEXT NOT NULL,
+            main_image TEXT,
+            url TEXT NOT NULL,
+            sale_price REAL,
+            original_price REAL,
+            discount REAL,
+            currency CHAR(3) NOT NULL,
+            trade_count INTEGER,
+            trade_count_plus INTEGER NOT NULL DEFAULT 0,
+            store_id INTEGER REFERENCES {STORES_TABLE} (id),
+            star_rating REAL,
+            number_reviews INTEGER,
+            total_sales INTEGER,
+            total_sales_plus INTEGER NOT NULL DEFAULT 0,
+            last_scrape_date TEXT NOT NULL,
+            scrape_status CHAR NOT NULL,
+            reviews_fetched_at TEXT,
+            content_hash INTEGER,
+            history_hash INTEGER
+        )
+        """,
+        f"CREATE INDEX IF NOT EXISTS {table}_store_id ON {table} (store_id)",
+        # Secondary indexes for the filters aliexpress.query offers
+        f"CREATE INDEX IF NOT EXISTS {table}_sale_price ON {table} (sale_price)",
+        f"CREATE INDEX IF NOT EXISTS {table}_star_rating ON {table} (star_rating)",
+        f"CREATE INDEX IF NOT EXISTS {table}_last_scrape_date ON {table} (last_scrape_date)",
+        f"CREATE INDEX IF NOT EXISTS {STORES_TABLE}_name ON {STORES_TABLE} (name)",
+        f"""
+        CREATE TABLE IF NOT EXISTS {IMAGES_TABLE} (
+            product_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            PRIMARY KEY (product_id, position)
+        ) WITHOUT ROWID
+        """,
+        f"""
+        CREATE VIEW IF NOT EXISTS {table}_flat AS
+        SELECT
+            p.id, p.skuid, p.title, p.main_image, p.url, p.sale_price, p.original_price, p.discount, p.currency,
+            p.trade_count || CASE WHEN p.trade_count_plus THEN '+' ELSE '' END AS trade_count,
+            s.name AS store_name, s.url AS store_url, p.star_rating, p.number_reviews,
+            p.total_sales || CASE WHEN p.total_sales_plus THEN '+' ELSE '' END AS total_sales,
+            (
+                SELECT json_group_array(url) FROM (
+                    SELECT url FROM {IMAGES_TABLE} i WHERE i.product_id = p.id ORDER BY position
+                )
+            ) AS images,
+            p.last_scrape_date, p.scrape_status, p.reviews_fetched_at
+        FROM {table} p LEFT JOIN {STORES_TABLE} s ON s.id = p.store_id
+        """,
+    )
+
+
+def search_index(table: str = "products") -> Tuple[str, ...]:
+    # External-content FTS5 index over titles, kept current by triggers so
+    # every write the pipeline makes updates it in the same transaction. The
+    # update trigger only fires when the title really changed.
+    return (
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+            title, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts (rowid, title) VALUES (new.id, new.title);
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, title) VALUES ('delete', old.id, old.title);
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF title ON {table}
+        WHEN old.title IS NOT new.title BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, title) VALUES ('delete', old.id, old.title);
+            INSERT INTO {table}_fts (rowid, title) VALUES (new.id, new.title);
+        END
+        """,
+    )
+
+
+def has_fts5(conn: sqlite3.Connection) -> bool:
+    return any(option == "ENABLE_FTS5" for (option,) in conn.execute("PRAGMA compile_options"))
+
+
+def create_tables(conn: sqlite3.Connection, table: str = "products") -> None:
+    for statement in schema(table):
+        conn.execute(statement)
+    if not has_fts5(conn):
+        logger.warning("SQLite was built without FTS5; title search is unavailable")
+        return
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (f"{table}_fts",)
+    ).fetchone()
+    for statement in search_index(table):
+        conn.execute(statement)
+    if not exists:
+        # Index rows written before the search index existed
+        conn.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+
+def is_legacy(conn: sqlite3.Connection, table: str = "products") -> bool:
+    # The original layout kept store_name on every products row
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    return "store_name" in columns
+
+
+def split_count(value: Any) -> Tuple[Optional[int], int]:
+    # "1000+" -> (1000, 1); "37" -> (37, 0); None -> (None, 0)
+    if value is None:
+        return None, 0
+    if isinstance(value, int):
+        return value, 0
+    text = str(value)
+    # Fast path for the two shapes get_number produces
+    if text.isdigit():
+        return int(text), 0
+    if text[:-1].isdigit() and text[-1] == "+":
+        return int(text[:-1]), 1
+    match = COUNT_RE.match(text)
+    if not match:
+        return None, 0
+    return int(match.group(1)), int(bool(match.group(2)))
+
+
+def store_key(url: Optional[str]) -> Optional[int]:
+    # AliExpress store URLs end in the numeric store id; anything else gets a
+    # stable 63-bit hash of the URL so the same store always maps to one row
+    if not url or url == "https:":
+        return None
+    match = STORE_ID_RE.search(url)
+    if match:
+        return int(match.group(1))
+    digest = hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") >> 1
+
+
+def parse_images(images: Any) -> Optional[List[str]]:
+    if images is None:
+        return None
+    if isinstance(images, str):
+        try:
+            images = json.loads(images)
+        except json.JSONDecodeError:
+            return []
+    return list(images)
+
+
+def normalize(
+    fields: Mapping[str, Any]
+) -> Tuple[Tuple[str, ...], Tuple[Any, ...], Optional[Tuple[int, Any, Any]], Optional[List[str]]]:
+    # Maps item fields to (products columns, values, stores row, image URLs).
+    # Only fields present in the item become columns, so a partial item leaves
+    # the other stored columns untouched. Images are None when the item has none.
+    columns: List[str] = []
+    values: List[Any] = []
+    for key, value in fields.items():
+        if key in SKIPPED_FIELDS:
+            continue
+        if key in SPLIT_COUNT_FIELDS:
+            count, plus = split_count(value)
+            columns += [key, f"{key}_plus"]
+            values += [count, int(fields.get(f"{key}_plus", plus))]
+        else:
+            columns.append(key)
+            values.append(value)
+
+    store = None
+    store_id = store_key(fields.get("store_url"))
+    if store_id is not None:
+        store = (store_id, fields.get("store_name"), fields.get("store_url"))
+        columns.append("store_id")
+        values.append(store_id)
+    return tuple(columns), tuple(values), store, parse_images(fields.get("images"))
+
+
+def store_upsert_sql() -> str:
+    return (
+        f"INSERT INTO {STORES_TABLE} (id, name, url) VALUES (?, ?, ?) "
+        f"ON CONFLICT(id) DO UPDATE SET name = excluded.name, url = excluded.url "
+        f"WHERE name IS NOT excluded.name OR url IS NOT excluded.url"
+    )
+
+
+def image_rows(product_id: Any, images: List[str]) -> List[Tuple[Any, int, str]]:
+    return [(product_id, position, url) for position, url in enumerate(images)]
+
+
+def image_delete_sql() -> str:
+    return f"DELETE FROM {IMAGES_TABLE} WHERE product_id = ?"
+
+
+def image_insert_sql() -> str:
+    return f"INSERT OR REPLACE INTO {IMAGES_TABLE} (product_id, position, url) VALUES (?, ?, ?)"
+
+
+def migrate(conn: sqlite3.Connection, table: str = "products", chunk_size: int = 10000) -> int:
+    # Rewrites a database in the original one-table layout in place. Runs in a
+    # single transaction, so an interrupted migration leaves the old table as it was.
+    if not is_legacy(conn, table):
+        return 0
+    legacy = f"{table}_legacy"
+    migrated = 0
+    with conn:
+        # Explicit BEGIN so the DDL below is part of the transaction too
+        conn.execute("BEGIN")
+        conn.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        create_tables(conn, table)
+        cursor = conn.execute(f"SELECT * FROM {legacy}")
+        names = [description[0] for description in cursor.description]
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            stores: Dict[int, Tuple[int, Any, Any]] = {}
+            images: List[Tuple[Any, int, str]] = []
+            groups: Dict[Tuple[str, ...], List[Tuple[Any, ...]]] = {}
+            for row in rows:
+                fields = dict(zip(names, tuple(row)))
+                # Hashes were computed over the old field values; dropping them
+                # makes the next crawl store fresh ones once
+                fields.pop("content_hash", None)
+                fields.pop("history_hash", None)
+                columns, values, store, product_images = normalize(fields)
+                groups.setdefault(columns, []).append(values)
+                if store is not None:
+                    stores[store[0]] = store
+                if product_images:
+                    images.extend(image_rows(fields["id"], product_images))
+            conn.executemany(store_upsert_sql(), stores.values())
+            for columns, args in groups.items():
+                placeholders = ", ".join("?" for _ in columns)
+                conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", args)
+            conn.executemany(image_insert_sql(), images)
+            migrated += len(rows)
+        conn.execute(f"DROP TABLE {legacy}")
+    logger.info(f"Migrated {migrated} products to the normalized schema")
+    return migrated
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print("usage: python -m aliexpress.schema DATABASE", file=sys.stderr)
+        return 2
+    logging.basicConfig(level=logging.INFO)
+    conn = sqlite3.connect(argv[0])
+    try:
+        migrated = migrate(conn)
+        if migrated:
+            # Reclaim the pages the old table used
+            conn.execute("VACUUM")
+        print(f"{argv[0]}: migrated {migrated} products" if migrated else f"{argv[0]}: already normalized")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,8 @@
+# Signals of this project, sent through crawler.signals like Scrapy's own
+
+# A ThreadedWriter started its writer thread. Args: writer
+writer_started = object()
+
+# A ThreadedWriter committed items to disk, sent from the reactor thread.
+# Args: writer, ids (the ids of the items, in the order they were written)
+items_committed = object()
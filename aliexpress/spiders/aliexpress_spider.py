@@ -1,40 +1,97 @@
+import asyncio
 import scrapy
+from scrapy import signals
 import datetime
+import hashlib
 from scrapy.utils import spider
+from twisted.internet import task
 from twisted.internet.error import DNSLookupError, TimeoutError, TCPTimedOutError
 import json
-import random
+import math
+import os
 import re
-from urllib.parse import urlparse
-import jmespath
-from w3lib.html import remove_tags, replace_escape_chars
-from html import unescape
-
-def get_number(text):
-    if text:
-        match = re.search(r"^\d+[+]?", text)
-        if match:
-            return match.group()
-    return None
-
-def safe_float_cast(s):
-    try:
-        return float(s)
-    except (ValueError, TypeError):
+import socket
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse, urlsplit, urlunsplit
+from itemadapter import ItemAdapter
+
+from aliexpress import changelog, instrumentation, signals as aliexpress_signals
+from aliexpress.checkpoint import PAGE_META_KEYS, CrawlCheckpoint, checkpoint_path
+from aliexpress.extractors import ExtractionPlan, extract_dida_config, get_number, safe_float_cast
+from aliexpress.impersonation import ImpersonationScheduler
+from aliexpress.items import Product
+from aliexpress.review_cache import ReviewCache
+from aliexpress.schema import split_count
+from aliexpress.work_queue import WorkQueue
+
+REVIEWS_URL = "https://feedback.aliexpress.com/pc/searchEvaluation.do?productId={}"
+
+# AliExpress never serves more than this many result pages for one query
+MAX_PAGES = 60
+
+def set_query_params(url, **params):
+    # Replaces (or with a None value removes) query parameters, keeping the rest in order
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key not in params]
+    query.extend((key, str(value)) for key, value in params.items() if value is not None)
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+def build_page_url(url, page):
+    return set_query_params(url, page=page)
+
+def format_price(value):
+    return f"{value:.2f}".rstrip("0").rstrip(".") if value is not None else None
+
+def build_shard_url(url, price_range):
+    min_price, max_price = price_range
+    return set_query_params(url, page=None, minPrice=format_price(min_price), maxPrice=format_price(max_price))
+
+def query_price_range(url):
+    # The price filter the query already has, so shards stay inside it; the
+    # whole range when it has none
+    params = dict(parse_qsl(urlsplit(url).query))
+    min_price = safe_float_cast(params.get("minPrice"))
+    max_price = safe_float_cast(params.get("maxPrice"))
+    return (min_price or 0, max_price)
+
+def split_price_range(price_range, start_max, min_width):
+    # Bisects a (min, max) price range; max None means unbounded. Returns None
+    # when the range is too narrow to split any further.
+    min_price, max_price = price_range
+    if max_price is None:
+        split_at = max(min_price * 2, min_price + start_max)
+        return [(min_price, split_at), (split_at, None)]
+    if max_price - min_price < 2 * min_width:
         return None
+    split_at = round((min_price + max_price) / 2, 2)
+    return [(min_price, split_at), (split_at, max_price)]
+
+def load_queries(query='', queries_file=None):
+    queries = [query.strip()] if query and query.strip() else []
+    if queries_file:
+        with open(queries_file, encoding="utf-8") as file:
+            for line in file:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    queries.append(line)
+    # Keep the order but crawl each query once
+    return list(dict.fromkeys(queries))
 
-def cleanup(input_text):
-    return unescape(remove_tags(replace_escape_chars(input_text)))
+def query_key(url):
+    # Short stable id used to tag a query's requests and stats
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
 
 def parse_reviews(response, product):
+    adapter = ItemAdapter(product)
     try:
         json_response = json.loads(response.text)
         display_message = (json_response.get("displayMessage", {}))
         num_ratings = display_message.get("numRatings", 0)
-        product['number_reviews'] = get_number(num_ratings) if get_number(num_ratings) else None
+        adapter['number_reviews'] = split_count(get_number(num_ratings))[0]
+        adapter['reviews_fetched_at'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     except json.JSONDecodeError:
-        spider.logger.error(f"Failed to decode JSON for product {product['id']} reviews.")
-        product['scrape_status'] = 'failed'
+        spider.logger.error(f"Failed to decode JSON for product {adapter['id']} reviews.")
+        adapter['scrape_status'] = 'failed'
 
     yield product
 
@@ -49,53 +106,172 @@ def errback_handler(failure):
         spider.logger.error(f"Unhandled error on {request.url}: {failure}")
 
 
-class AliexpressSpider(scrapy.Spider):
+# How both spiders talk to AliExpress
+FETCH_SETTINGS = {
+    "USER-AGENT": None,
+    "ROBOTSTXT_OBEY": False,
+    "COOKIES_ENABLED": True,
+    "DOWNLOAD_DELAY": 1,
+    "CONCURRENT_REQUESTS_PER_DOMAIN": 1,
+
+    "DOWNLOADER_MIDDLEWARES": {
+        # Ahead of RetryMiddleware (550) so blocks are seen before being retried
+        "aliexpress.middlewares.AliexpressDownloaderMiddleware": 585,
+    },
+    "ADAPTIVE_THROTTLE_ENABLED": True,
+    "ADAPTIVE_THROTTLE_MAX_CONCURRENCY": 8,
+    "ADAPTIVE_THROTTLE_TARGET_LATENCY": 3.0,
+    "ADAPTIVE_THROTTLE_BLOCK_RETRIES": 2,
+    "IMPERSONATE_SESSION_POOL": 16,
+    "IMPERSONATE_COOLDOWN": 300,
+    "IMPERSONATE_FAILURE_THRESHOLD": 3,
+
+    "DOWNLOAD_HANDLERS": {
+        "http": "aliexpress.handlers.TimedDownloadHandler",
+        "https": "aliexpress.handlers.TimedDownloadHandler",
+    },
+    # Does the downloading; TimedDownloadHandler times it for the throttle
+    "TIMED_DOWNLOAD_HANDLER": "scrapy_impersonate.ImpersonateDownloadHandler",
+
+    "TWISTED_REACTOR": "twisted.internet.asyncioreactor.AsyncioSelectorReactor",
+
+    "RETRY_TIMES": 5,
+    # 403/429 are block signals handled by the throttle middleware, and 404s do not recover
+    "RETRY_HTTP_CODES": [500, 502, 503, 504, 400, 408],
+}
+
+# The products database both spiders write through SQLiteWriter, and its change log
+STORAGE_SETTINGS = {
+    "SQLITE_DATABASE": "products.db",
+    "SQLITE_BATCH_SIZE": 500,
+    "SQLITE_FLUSH_INTERVAL": 5.0,
+    "SQLITE_QUEUE_SIZE": 10000,
+    "SQLITE_HISTORY_TABLE": "product_history",
+    "REVIEW_CACHE_TTL": 7 * 24 * 3600,
+    # Set to a directory for a change log of product diffs (see aliexpress.changelog)
+    "CHANGELOG_DIR": None,
+    "CHANGELOG_SEGMENT_SIZE": 64 * 1024 * 1024,
+}
+
+
+class AliexpressBaseSpider(scrapy.Spider):
+    # What the AliExpress spiders share: browser impersonation and the
+    # Scrapy 2.13+ entry point. Subclasses merge FETCH_SETTINGS into their
+    # custom_settings.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Replaced by a scheduler configured from settings in from_crawler
+        self.impersonation = ImpersonationScheduler()
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.impersonation = ImpersonationScheduler.from_settings(crawler.settings)
+        return spider
+
+    async def start(self):
+        # Entry point since Scrapy 2.13, which no longer calls start_requests
+        for request in self.start_requests():
+            yield request
+
+
+class AliexpressSpider(AliexpressBaseSpider):
     name = 'aliexpress'
 
     custom_settings = {
-        "USER-AGENT": None,
-        "ROBOTSTXT_OBEY": False,
-        "COOKIES_ENABLED": True,
-        "DOWNLOAD_DELAY": 1,
-        "CONCURRENT_REQUESTS_PER_DOMAIN": 1,
-
-        "DOWNLOAD_HANDLERS": {
-            "http": "scrapy_impersonate.ImpersonateDownloadHandler",
-            "https": "scrapy_impersonate.ImpersonateDownloadHandler",
-        },
+        **FETCH_SETTINGS,
+        **STORAGE_SETTINGS,
 
         "ITEM_PIPELINES": {
             "aliexpress.pipelines.SQLiteWriter": 400,
             "aliexpress.pipelines.JsonWriter":401,
+            "aliexpress.pipelines.ParquetWriter": 402,
+            "aliexpress.pipelines.ImageDownloader": 410,
+        },
+        "JSON_OUTPUT": "products.json",
+        "JSON_LOG_FILE": "products.jsonl",
+        "JSON_OUTPUT_FORMAT": "json",
+        "JSON_QUEUE_SIZE": 10000,
+        # Set to e.g. "products.parquet" to also write a Parquet file (needs pyarrow)
+        "PARQUET_OUTPUT": None,
+        "PARQUET_ROW_GROUP_SIZE": 10000,
+        # Set to a directory to download product images into it (see ImageDownloader)
+        "IMAGES_STORE": None,
+        "IMAGES_CONCURRENCY": 16,
+        "IMAGES_QUEUE_SIZE": 1000,
+        # Longest side of a JPEG thumbnail per image, 0 for none (needs Pillow)
+        "IMAGES_THUMBNAIL_SIZE": 0,
+        "IMAGES_THUMBNAIL_WORKERS": 2,
+        # Image downloads share this slot; IMAGES_CONCURRENCY bounds them
+        "DOWNLOAD_SLOTS": {
+            "images": {"concurrency": 16, "delay": 0},
         },
-        "SQLITE_DATABASE": "products.db",
 
-        "TWISTED_REACTOR": "twisted.internet.asyncioreactor.AsyncioSelectorReactor",
+        "EXTENSIONS": {
+            "aliexpress.instrumentation.Instrumentation": 500,
+            "aliexpress.changelog.ChangeFeed": 510,
+        },
+        "INSTRUMENTATION_ENABLED": True,
+        # Set to e.g. "metrics.prom" (Prometheus text) or "metrics.json" for a periodic dump
+        "INSTRUMENTATION_FILE": None,
+        "INSTRUMENTATION_INTERVAL": 30,
+        # Set to e.g. "profile.folded" to sample stacks for the whole crawl
+        "PROFILE_OUTPUT": None,
+        "PROFILE_INTERVAL": 0.005,
+
         "FEED_EXPORT_ENCODING": "utf-8",
 
-        "RETRY_TIMES": 5,
-        "RETRY_HTTP_CODES": [500, 502, 503, 504, 400, 403, 404, 408],
+        "CHECKPOINT_ENABLED": True,
+        "CHECKPOINT_DIR": ".checkpoints",
+        "CHECKPOINT_INTERVAL": 30,
+
+        # Set by aliexpress.launcher for its worker processes
+        "WORK_QUEUE": None,
+        "WORK_QUEUE_WORKER": None,
+        "WORK_QUEUE_LEASE_TIME": 300,
+        "WORK_QUEUE_MAX_ATTEMPTS": 3,
+        "WORK_QUEUE_RETRY_DELAY": 30,
+        "WORK_QUEUE_PREFETCH": 16,
+        "WORK_QUEUE_POLL_INTERVAL": 1.0,
+        # Store what each query listed in the queue, for the launcher's change log
+        "WORK_QUEUE_LISTINGS": False,
+
+        "PRICE_SHARD_START_MAX": 100.0,
+        "PRICE_SHARD_MIN_WIDTH": 0.01,
     }
 
-    def __init__(self, query='', *args, **kwargs):
+    def __init__(self, query='', queries_file=None, shard_by_price=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.query = query.strip()
+        self.queries = load_queries(query, queries_file)
+        self.query = self.queries[0] if self.queries else ''
         self.parsed_query = urlparse(self.query)
-        self.prefix, self.domain = self.parsed_query.netloc.split('.', 1)
+        self.shard_by_price = str(shard_by_price).lower() in ("1", "true", "yes")
+        # Product ids already handed to review enrichment in this run, across all queries
+        self.seen_products = set()
+        self.review_cache = None
+        self.checkpoint = None
+        self.checkpoint_loop = None
+        # Writers that must commit a product before the checkpoint counts it
+        # as done, and for each product still being written, how many have not
+        self.writers = set()
+        self.unwritten = {}
+        # Worker of aliexpress.launcher: the shared queue, and the ids of the
+        # units this process has leased and not finished yet
+        self.work_queue = None
+        self.worker_id = None
+        self.leased = set()
+        self.lease_loop = None
+        # (query key, product id) listings and incomplete queries of the unit
+        # being parsed, stored with its completion when recording listings
+        self.record_listings = False
+        self.unit_listed = []
+        self.unit_incomplete = set()
+        self.prefix, _, self.domain = self.parsed_query.netloc.partition('.')
         self.total_results = None
         self.page_size = None
         self.total_pages = None
-
-        self.browsers_list = [
-                                 "chrome99", "chrome100", "chrome101", "chrome104", "chrome107", "chrome110",
-                                 "chrome116", "chrome119"
-                             ] * 15 + ["chrome120", "chrome123", "chrome124", "chrome131"] * 65 + ["chrome99_android",
-                                                                                                   "chrome131_android"] + [
-                                 "edge99", "edge101"
-                             ] * 11 + ["safari15_3", "safari15_5", "safari17_0", "safari18_0"] * 5 + ["safari17_2_ios",
-                                                                                                      "safari18_0_ios"] + [
-                                 "firefox133"
-                             ] * 4
+        self.plan = ExtractionPlan()
 
         self.headers = {
             'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
@@ -107,112 +283,465 @@ class AliexpressSpider(scrapy.Spider):
             'aep_usuc_f': 'glo&province=&city=&c_tp=USD&region=US&b_locale=en_US&ae_u_p_s=2',
         }
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.work_queue = WorkQueue.from_settings(crawler.settings)
+        spider.worker_id = crawler.settings.get("WORK_QUEUE_WORKER") or f"{socket.gethostname()}-{os.getpid()}"
+        spider.record_listings = spider.work_queue is not None and crawler.settings.getbool("WORK_QUEUE_LISTINGS")
+        crawler.signals.connect(spider.writer_started, signal=aliexpress_signals.writer_started)
+        crawler.signals.connect(spider.items_committed, signal=aliexpress_signals.items_committed)
+        crawler.signals.connect(spider.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(spider.item_error, signal=signals.item_error)
+        return spider
+
+    async def start(self):
+        if self.work_queue:
+            async for request in self.queue_requests():
+                yield request
+            return
+        async for request in super().start():
+            yield request
+
+    async def queue_requests(self):
+        # Requests for the units leased from the shared work queue. Pages and
+        # review requests found along the way go back to the queue (see
+        # complete_page), so any worker may pick them up. Runs until no worker
+        # has anything left, since a busy one may still add units.
+        self.work_queue.open()
+        spider.logger.info(f"Worker {self.worker_id} pulling from {self.work_queue.path}")
+        self.review_cache = ReviewCache.from_settings(self.settings)
+        if self.review_cache:
+            self.review_cache.load()
+        self.lease_loop = task.LoopingCall(self.work_queue.renew, self.worker_id)
+        self.lease_loop.start(self.work_queue.lease_time / 3, now=False)
+
+        prefetch = max(1, self.settings.getint("WORK_QUEUE_PREFETCH", 16))
+        poll_interval = self.settings.getfloat("WORK_QUEUE_POLL_INTERVAL", 1.0)
+        while True:
+            units = self.work_queue.lease(self.worker_id, prefetch - len(self.leased)) \
+                if len(self.leased) < prefetch else []
+            for unit_id, kind, payload in units:
+                self.leased.add(unit_id)
+                self.inc_stat(f"work_queue/leased/{kind}")
+                yield self.unit_request(unit_id, kind, payload)
+            if not units:
+                if not self.leased and self.work_queue.finished():
+                    return
+                await asyncio.sleep(poll_interval)
+
+    def unit_request(self, unit_id, kind, payload):
+        if kind == "review":
+            request = self.review_request(
+                Product.from_dict(payload["product"]), {**self.headers, 'referer': payload["referer"]}
+            )
+        else:
+            meta = payload["meta"]
+            if meta.get("price_range") is not None:
+                meta["price_range"] = tuple(meta["price_range"])
+            request = self.page_request(payload["url"], meta=meta, priority=payload["priority"])
+        request.meta["unit_id"] = unit_id
+        # The queue already dedupes units, and a retried unit has the URL of
+        # the attempt that failed
+        return request.replace(errback=self.unit_failed, dont_filter=True)
+
+    def complete_page(self, unit_id, outputs):
+        # Turns what parse_page produced into queue units and results, stored
+        # in one transaction with the page's completion
+        children = []
+        items = []
+        self.unit_listed, self.unit_incomplete = [], set()
+        try:
+            for output in outputs:
+                if isinstance(output, scrapy.Request) and output.callback == self.parse_product_reviews:
+                    product = output.cb_kwargs["product"]
+                    # Ahead of further pages, so products do not pile up
+                    # waiting for their reviews
+                    children.append((f"review:{product.id}", "review", {
+                        "product": ItemAdapter(product).asdict(),
+                        "referer": output.headers.get("referer", b"").decode(),
+                    }, MAX_PAGES))
+                elif isinstance(output, scrapy.Request):
+                    meta = {key: output.meta[key] for key in PAGE_META_KEYS if output.meta.get(key) is not None}
+                    children.append((f"page:{output.url}", "page", {
+                        "url": output.url, "meta": meta, "priority": output.priority,
+                    }, output.priority))
+                else:
+                    items.append(output)
+        except Exception as e:
+            self.fail_unit(unit_id, repr(e))
+            raise
+        added = self.work_queue.complete(
+            unit_id, children, [ItemAdapter(item).asdict() for item in items],
+            listed=self.unit_listed, incomplete=self.unit_incomplete,
+        )
+        self.leased.discard(unit_id)
+        self.inc_stat("work_queue/queued", added)
+        self.inc_stat("work_queue/known", len(children) - added)
+        # Still yielded, for the item stats; the launcher does the writing
+        yield from items
+
+    def unit_failed(self, failure):
+        errback_handler(failure)
+        unit_id = failure.request.meta.get("unit_id")
+        if unit_id is not None:
+            self.fail_unit(unit_id, repr(failure.value))
+
+    def fail_unit(self, unit_id, error):
+        retried = self.work_queue.fail(unit_id, error)
+        self.leased.discard(unit_id)
+        self.inc_stat("work_queue/retried" if retried else "work_queue/failed")
+
     def start_requests(self):
         spider.logger.info("Starting the spider...")
-        if not self.query:
+        if not self.queries:
             spider.logger.error("No query URL provided.")
             return
 
-        if "www.aliexpress" in self.parsed_query.netloc and self.parsed_query.path.startswith("/w/wholesale"):
-            try:
-                yield scrapy.Request(
-                    url=self.query,
-                    headers=self.headers,
-                    cookies=self.cookies,
-                    callback=self.parse,
-                    errback=errback_handler,
-                    meta={"impersonate": random.choice(self.browsers_list)},
-                )
-            except ValueError:
-                spider.logger.error("Failed to parse the input URL.")
-        else:
-            spider.logger.error("Invalid input URL.")
+        self.review_cache = ReviewCache.from_settings(self.settings)
+        if self.review_cache:
+            self.review_cache.load()
+
+        if self.settings.getbool("CHECKPOINT_ENABLED"):
+            path = checkpoint_path(self.settings.get("CHECKPOINT_DIR"), self.name, self.queries)
+            checkpoint = CrawlCheckpoint(path)
+            resumed = checkpoint.load()
+            self.checkpoint = checkpoint if resumed else CrawlCheckpoint(path)
+            self.checkpoint_loop = task.LoopingCall(self.checkpoint.save)
+            self.checkpoint_loop.start(self.settings.getfloat("CHECKPOINT_INTERVAL", 30), now=False)
+            if resumed:
+                crawler = getattr(self, "crawler", None)
+                if crawler is not None:
+                    changelog.mark_partial(crawler.stats)
+                yield from self.resume_requests()
+                return
+
+        for query in self.queries:
+            parsed_query = urlparse(query)
+            if "www.aliexpress" in parsed_query.netloc and parsed_query.path.startswith("/w/wholesale"):
+                key = query_key(query)
+                spider.logger.info(f"Query {key}: {query}")
+                try:
+                    yield self.page_request(query, meta={"query_key": key})
+                except ValueError:
+                    spider.logger.error(f"Failed to parse the input URL: {query}")
+            else:
+                spider.logger.error(f"Invalid input URL: {query}")
+
+    def resume_requests(self):
+        # Products already stored or still pending must not be emitted again
+        self.seen_products.update(self.checkpoint.done_products)
+        self.seen_products.update(self.checkpoint.pending_products)
+        for url, page in list(self.checkpoint.pending_pages.items()):
+            yield self.page_request(url, meta=page["meta"], priority=page["priority"])
+        for product_id, data in list(self.checkpoint.pending_products.items()):
+            product = Product.from_dict(data)
+            if product_id in self.checkpoint.ready_products:
+                # Had its reviews, but the writers had not committed it yet
+                self.product_ready(product)
+                yield product
+            else:
+                yield self.review_request(product, self.headers)
+
+    def page_request(self, url, meta=None, priority=0):
+        if self.checkpoint:
+            self.checkpoint.page_scheduled(url, meta or {}, priority)
+        return scrapy.Request(
+            url=url,
+            headers={**self.headers, 'referer': f'https://{urlparse(url).netloc}/'},
+            cookies=self.cookies,
+            callback=self.parse,
+            errback=self.page_failed,
+            priority=priority,
+            meta={**self.impersonation.assign(), **(meta or {}), "checkpoint_url": url},
+        )
+
+    def review_request(self, product, headers):
+        if self.checkpoint:
+            self.checkpoint.product_pending(product)
+        return scrapy.Request(
+            url=REVIEWS_URL.format(product.id),
+            headers=headers,
+            callback=self.parse_product_reviews,
+            cb_kwargs={"product": product},
+            errback=self.review_failed,
+            meta={**self.impersonation.assign(), "review_requested_at": time.monotonic()},
+        )
+
+    def page_failed(self, failure):
+        # Out of retries: the page is given up on for this run rather than
+        # left pending, which would make the next run resume instead of
+        # starting over
+        errback_handler(failure)
+        self.inc_stat("pages/failed")
+        self.query_incomplete(failure.request.meta.get("query_key"))
+        if self.checkpoint:
+            request = failure.request
+            self.checkpoint.page_failed(request.meta.get("checkpoint_url", request.url))
+
+    def review_failed(self, failure):
+        errback_handler(failure)
+        self.inc_stat("reviews/failed")
+        if self.checkpoint:
+            self.checkpoint.product_failed(failure.request.cb_kwargs["product"].id)
+
+    def parse_product_reviews(self, response, product):
+        requested_at = response.meta.get("review_requested_at")
+        if requested_at is not None:
+            # Scheduler wait, download and retries included
+            self.observe("reviews/round_trip", time.monotonic() - requested_at)
+        unit_id = response.meta.get("unit_id")
+        for item in parse_reviews(response, product):
+            self.product_ready(item)
+            if unit_id is not None:
+                self.work_queue.complete(unit_id, items=[ItemAdapter(item).asdict()])
+                self.leased.discard(unit_id)
+            yield item
+
+    def product_ready(self, product):
+        # The product is complete and about to be yielded; the checkpoint
+        # keeps it until every writer has committed it, so a crash before
+        # the writers flush does not lose it
+        if not self.checkpoint:
+            return
+        if not self.writers:
+            self.checkpoint.product_done(product.id)
+            return
+        self.checkpoint.product_ready(product)
+        self.unwritten[product.id] = len(self.writers)
+
+    def writer_started(self, writer):
+        self.writers.add(writer)
+
+    def items_committed(self, writer, ids):
+        for product_id in ids:
+            remaining = self.unwritten.get(product_id)
+            if remaining is None:
+                continue
+            if remaining > 1:
+                self.unwritten[product_id] = remaining - 1
+            else:
+                del self.unwritten[product_id]
+                self.checkpoint.product_done(product_id)
+
+    def item_dropped(self, item):
+        # A dropped product never reaches the remaining writers
+        product_id = ItemAdapter(item).get("id")
+        if self.unwritten.pop(product_id, None) is not None:
+            self.checkpoint.product_done(product_id)
+
+    def item_error(self, item):
+        product_id = ItemAdapter(item).get("id")
+        if self.unwritten.pop(product_id, None) is not None:
+            self.checkpoint.product_failed(product_id)
+
+    def closed(self, reason):
+        if self.checkpoint_loop and self.checkpoint_loop.running:
+            self.checkpoint_loop.stop()
+        if self.lease_loop and self.lease_loop.running:
+            self.lease_loop.stop()
+        if self.work_queue and self.work_queue.conn:
+            # Units still in flight on shutdown go straight back to the queue
+            released = self.work_queue.release(self.worker_id, count_attempt=False)
+            if released:
+                spider.logger.info(f"Released {released} unfinished units")
+            self.work_queue.close()
+        if self.checkpoint:
+            if reason == "finished":
+                # Nothing can still be in flight; the next run with these
+                # queries starts over, retrying whatever failed
+                if not self.checkpoint.empty:
+                    spider.logger.warning(
+                        f"{len(self.checkpoint.pending_pages)} pages and {len(self.checkpoint.pending_products)} "
+                        "reviews never completed"
+                    )
+                self.checkpoint.remove()
+            else:
+                self.checkpoint.save()
+
+        crawler = getattr(self, "crawler", None)
+        if crawler is None:
+            return
+        hits = crawler.stats.get_value("reviews/cache_hit", 0)
+        misses = crawler.stats.get_value("reviews/cache_miss", 0)
+        if hits + misses:
+            crawler.stats.set_value("reviews/cache_hit_rate", round(hits / (hits + misses), 4))
+
+    def query_incomplete(self, key):
+        # A page of the query failed, came back without results or lies past
+        # MAX_PAGES, so this crawl did not see its whole listing
+        self.inc_stat(f"queries/{key}/incomplete")
+        crawler = getattr(self, "crawler", None)
+        if crawler is not None:
+            changelog.query_incomplete(crawler.stats, key)
+        if self.record_listings and key:
+            self.unit_incomplete.add(key)
+
+    def inc_stat(self, key, count=1):
+        crawler = getattr(self, "crawler", None)
+        if crawler is not None:
+            crawler.stats.inc_value(key, count)
+
+    def observe(self, name, value, timing=True):
+        crawler = getattr(self, "crawler", None)
+        if crawler is not None:
+            instrumentation.observe(crawler.stats, name, value, timing)
 
     def parse(self, response):
+        unit_id = response.meta.get("unit_id")
+        if unit_id is not None:
+            yield from self.complete_page(unit_id, self.parse_page(response))
+            return
+        yield from self.parse_page(response)
+        # Only once everything the page leads to has been scheduled
+        if self.checkpoint:
+            self.checkpoint.page_done(response.meta.get("checkpoint_url", response.url))
+
+    def parse_page(self, response):
+        started = time.perf_counter()
+        key = response.meta.get("query_key")
+        extract = extract_dida_config(response.body)
+        if extract is None:
+            spider.logger.debug("Fast-path extraction failed, falling back to XPath.")
+            extract = self.extract_with_selector(response)
+        if extract is None:
+            self.query_incomplete(key)
+            return
+
+        records, current_page, total_results, page_size = self.plan.page_info(extract)
+        self.observe("parse", time.perf_counter() - started)
+        self.observe("records_per_page", len(records or ()), timing=False)
+        if current_page is None or total_results is None or not page_size:
+            spider.logger.error("Page info missing from the search payload.")
+            self.query_incomplete(key)
+            return
+        # Every price shard has its own page count; the attributes keep the
+        # values of the first response for the query as a whole
+        total_pages = math.ceil(total_results / page_size)
+        self.total_results = total_results if not self.total_results else self.total_results
+        self.page_size = page_size if not self.page_size else self.page_size
+        self.total_pages = total_pages if not self.total_pages else self.total_pages
+
+        if current_page <= total_pages and current_page <= MAX_PAGES:
+            if records:
+                spider.logger.info(f"Processing page {current_page}...")
+                self.inc_stat(f"queries/{key}/pages")
+                for item in self.extract_fields(records, response):
+                    yield item
+            else:
+                self.query_incomplete(key)
+
+            # The first response knows how many pages there are, so every
+            # remaining page is scheduled at once and the per-host
+            # concurrency settings decide how many run in parallel.
+            # Earlier pages get higher priority.
+            if records and not response.meta.get("fanned_out"):
+                price_range = response.meta.get("price_range")
+                if self.shard_by_price and total_pages > MAX_PAGES:
+                    shards = self.split_shard(price_range or query_price_range(response.url), total_results)
+                    if shards:
+                        for shard in shards:
+                            if self.is_page_done(build_shard_url(response.url, shard)):
+                                continue
+                            yield self.page_request(
+                                build_shard_url(response.url, shard),
+                                meta={"query_key": key, "price_range": shard},
+                            )
+                        return
+                if total_pages > MAX_PAGES:
+                    # Not sharded, or a shard too narrow to split: the rest is out of reach
+                    self.query_incomplete(key)
+                if price_range is not None:
+                    self.inc_stat("shards/leaf")
+                last_page = min(total_pages, MAX_PAGES)
+                for page in range(current_page + 1, last_page + 1):
+                    if self.is_page_done(build_page_url(response.url, page)):
+                        continue
+                    yield self.page_request(
+                        build_page_url(response.url, page),
+                        meta={"query_key": key, "fanned_out": True, "price_range": price_range},
+                        priority=last_page - page,
+                    )
+
+    def is_page_done(self, url):
+        return self.checkpoint is not None and self.checkpoint.is_page_done(url)
+
+    def split_shard(self, price_range, total_results):
+        shards = split_price_range(
+            price_range,
+            self.settings.getfloat("PRICE_SHARD_START_MAX", 100.0),
+            self.settings.getfloat("PRICE_SHARD_MIN_WIDTH", 0.01),
+        )
+        if shards:
+            spider.logger.info(f"Splitting price range {price_range} with {total_results} results into {shards}")
+            self.inc_stat("shards/split")
+        else:
+            spider.logger.warning(f"Price range {price_range} cannot be split further; crawling only {MAX_PAGES} pages")
+            self.inc_stat("shards/capped")
+        return shards
+
+    def extract_with_selector(self, response):
         body = response.selector
         script = body.xpath(
             '//script[not(@*) and starts-with(normalize-space(text()), "window._dida_config_ =")]/text()').get()
         if not script:
             spider.logger.error("Script block not found in response.")
-            return
+            return None
         pattern = r'(\"data\":\s*{.*})'
         match = re.search(pattern, script)
         if not match:
-            print("no matches found!")
-            return
+            spider.logger.error("No data object found in script block.")
+            return None
         try:
             extract_ = "{" + match.group(1).rsplit('}', 1)[0].strip()
-            extract = json.loads(extract_)
+            return json.loads(extract_)
         except Exception as e:
             spider.logger.error(f"Error parsing JS objects: {e}")
-            return
+            return None
 
-        try:
-            records = jmespath.search("data.root.fields.mods.itemList.content", extract)
-            current_page = jmespath.search("data.root.fields.pageInfo.page", extract)
-            self.total_results = jmespath.search("data.root.fields.pageInfo.totalResults", extract) if not self.total_results else self.total_results
-            self.page_size = jmespath.search("data.root.fields.pageInfo.pageSize", extract) if not self.page_size else self.page_size 
-            self.total_pages = self.total_results // self.page_size + self.total_results % self.page_size // 10 if not self.total_pages else self.total_pages
-
-            if current_page <= self.total_pages and current_page <= 60:
-                if records:
-                    spider.logger.info(f"Processing page {current_page}...")
-                    for item in self.extract_fields(records, response):
-                        yield item
-
-                    headers = response.headers
-                    next_page_url = ''
-
-                    if 'page=' in self.parsed_query.query:
-                        next_page_url = re.sub(
-                            r'page=(\d+)', 
-                            lambda match: f'page={int(match.group(1)) + 1}', response.url)
-                    else:
-                        next_page_url = f"{response.url}&page={current_page + 1}" if '?' in response.url else f"{response.url}?page={current_page + 1}"
-
-                    yield scrapy.Request(
-                        url=next_page_url,
-                        headers=headers,
-                        cookies=self.cookies,
-                        callback=self.parse,
-                        errback=errback_handler,
-                        meta={"impersonate": random.choice(self.browsers_list)},
-                    )
+    def extract_fields(self, records, response):
+        parsed_url = urlparse(response.url)
+        key = response.meta.get("query_key")
+        started = time.perf_counter()
+        products, failures = self.plan.extract(
+            records,
+            f"{parsed_url.scheme}://{parsed_url.netloc}",
+            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        )
+        self.observe("extract_fields", time.perf_counter() - started)
+        for (kind, field), count in failures.items():
+            self.inc_stat(f"extract/{kind}/{field}", count)
+            if kind == "skipped":
+                spider.logger.error(f"Skipped {count} item(s) without a usable {field}")
+            else:
+                spider.logger.warning(f"{count} item(s) with {kind} {field}")
 
-        except (jmespath.exceptions.JMESPathTypeError, jmespath.exceptions.ParseError) as e:
-            spider.logger.error(f"Error parsing JSON content: {e}")
+        crawler = getattr(self, "crawler", None)
+        for product in products:
+            if crawler is not None:
+                # Before deduplication: every query that lists the product counts
+                changelog.product_listed(crawler.stats, key, product.id)
+            if self.record_listings:
+                self.unit_listed.append((key, product.id))
+            # Price shards overlap at their boundaries, pages can repeat products
+            # and batch queries share products; each is enriched only once
+            if product.id in self.seen_products:
+                self.inc_stat("products/duplicates")
+                self.inc_stat(f"queries/{key}/duplicates")
+                continue
+            self.seen_products.add(product.id)
+            self.inc_stat(f"queries/{key}/products")
 
-    def extract_fields(self, records, response):
-        for item in records:
-            try:
-                product = {
-                    "id": item["productId"],
-                    "skuId": item["prices"].get("skuId"),
-                    "title": cleanup(item["title"]["displayTitle"]),
-                    "main_image": f'https:{item["image"]["imgUrl"]}',
-                    "url": f"{self.parsed_query.scheme}://{self.parsed_query.netloc}/item/{item["productId"]}",
-                    "sale_price": safe_float_cast(item["prices"]["salePrice"]["minPrice"]),
-                    "original_price": safe_float_cast(item["prices"].get("originalPrice", {}).get("minPrice", "")),
-                    "discount": safe_float_cast(item["prices"]["salePrice"].get("discount", 0)),
-                    "currency": item["prices"]["salePrice"]["currencyCode"],
-                    "trade_count": get_number(item.get("trade", {}).get("realTradeCount", 0)),
-                    "store_name": item.get("store", {}).get("storeName", ""),
-                    "store_url": f'https:{item.get("store", {}).get("storeUrl", "")}',
-                    "star_rating": safe_float_cast(item.get("evaluation", {}).get("starRating", "")),
-                    "number_reviews": None,
-                    "total_sales": get_number(item.get("trade", {}).get("tradeDesc", "")),
-                    "images": json.dumps(["https:" + image.get('imgUrl') for image in item.get('images', {})]),
-                    "last_scrape_date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                    "scrape_status": 'successful',
-                }
-            except KeyError as e:
-                spider.logger.error(f"KeyError extracting fields for item: {e}")
+            cached = self.review_cache.get(product.id) if self.review_cache else None
+            if cached:
+                # Review count is still fresh, so skip the feedback request
+                product.number_reviews, product.reviews_fetched_at = cached
+                self.inc_stat("reviews/cache_hit")
+                self.product_ready(product)
+                yield product
                 continue
+            self.inc_stat("reviews/cache_miss")
 
-            yield scrapy.Request(
-                url=f"https://feedback.aliexpress.com/pc/searchEvaluation.do?productId={product['id']}",
-                headers=response.headers,
-                callback=parse_reviews,
-                cb_kwargs={"product": product},
-                meta={"impersonate": random.choice(self.browsers_list)},
-            )
+            # Not response.headers: replaying its Content-Length on a GET makes
+            # the server wait for a body that never comes
+            yield self.review_request(product, {**self.headers, 'referer': response.url})
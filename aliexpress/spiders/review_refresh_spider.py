@@ -0,0 +1,129 @@
+import scrapy
+import datetime
+import os
+import sqlite3
+from scrapy.utils import spider
+
+from aliexpress.items import Product
+from aliexpress.schema import parse_images
+from aliexpress.spiders.aliexpress_spider import (
+    FETCH_SETTINGS, REVIEWS_URL, STORAGE_SETTINGS, AliexpressBaseSpider, errback_handler, parse_reviews,
+)
+
+ORDERINGS = {
+    # Never-fetched rows first, then the oldest review counts
+    "staleness": "reviews_fetched_at IS NOT NULL, reviews_fetched_at",
+    # Best sellers first
+    "trade_count": "trade_count DESC",
+}
+
+
+def load_products(conn, product_ids, chunk_size=500):
+    # The stored products, in the order of product_ids and in the shape the
+    # search spider yields them, so SQLiteWriter finds their content hash
+    # unchanged unless the refreshed review count differs
+    conn.row_factory = sqlite3.Row
+    products = {}
+    for start in range(0, len(product_ids), chunk_size):
+        chunk = product_ids[start:start + chunk_size]
+        rows = conn.execute(
+            f"SELECT * FROM products_flat WHERE id IN ({', '.join('?' for _ in chunk)})", chunk
+        )
+        for row in rows:
+            data = dict(row)
+            data["id"] = str(data["id"])
+            data["skuId"] = data.pop("skuid")
+            data["images"] = parse_images(data["images"])
+            products[data["id"]] = Product.from_dict(data)
+    return [products[product_id] for product_id in product_ids if product_id in products]
+
+
+class ReviewRefreshSpider(AliexpressBaseSpider):
+    # Refreshes number_reviews for products already in the database, without
+    # re-crawling searches. Rows refreshed within max_age seconds are skipped,
+    # so an interrupted run resumes with whatever is still stale. Refreshed
+    # products go through SQLiteWriter like search results do, which keeps
+    # their content hash and the change log current.
+    name = 'review_refresh'
+
+    custom_settings = {
+        **FETCH_SETTINGS,
+        **STORAGE_SETTINGS,
+
+        "ITEM_PIPELINES": {
+            "aliexpress.pipelines.SQLiteWriter": 400,
+        },
+        "REVIEW_REFRESH_BUDGET": 1000,
+
+        "EXTENSIONS": {
+            "aliexpress.changelog.ChangeFeed": 510,
+        },
+    }
+
+    def __init__(self, order='staleness', budget=None, max_age=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if order not in ORDERINGS:
+            raise ValueError(f"order must be one of {', '.join(ORDERINGS)}")
+        self.order = order
+        self.budget = budget
+        self.max_age = max_age
+
+        self.headers = {
+            'accept': 'application/json, text/plain, */*',
+            'accept-language': 'en-US,en;q=0.9',
+            'referer': 'https://www.aliexpress.com/',
+        }
+
+        self.cookies = {
+            'aep_usuc_f': 'glo&province=&city=&c_tp=USD&region=US&b_locale=en_US&ae_u_p_s=2',
+        }
+
+    def select_products(self):
+        database_name = self.settings.get('SQLITE_DATABASE')
+        budget = int(self.budget) if self.budget is not None else self.settings.getint('REVIEW_REFRESH_BUDGET')
+        max_age = float(self.max_age) if self.max_age is not None else self.settings.getfloat('REVIEW_CACHE_TTL')
+        if not database_name or not os.path.exists(database_name):
+            spider.logger.error(f"Product database not found: {database_name}")
+            return []
+
+        cutoff = (datetime.datetime.now() - datetime.timedelta(seconds=max_age)).strftime("%Y-%m-%d %H:%M:%S")
+        conn = sqlite3.connect(f"file:{database_name}?mode=ro", uri=True)
+        try:
+            rows = conn.execute(
+                "SELECT id FROM products "
+                "WHERE reviews_fetched_at IS NULL OR reviews_fetched_at < ? "
+                f"ORDER BY {ORDERINGS[self.order]} LIMIT ?",
+                (cutoff, budget),
+            ).fetchall()
+            return load_products(conn, [str(product_id) for (product_id,) in rows])
+        except sqlite3.Error as e:
+            spider.logger.error(f"Error reading products from {database_name}: {e}")
+            return []
+        finally:
+            conn.close()
+
+    def start_requests(self):
+        products = self.select_products()
+        spider.logger.info(f"Refreshing reviews for {len(products)} products ordered by {self.order}")
+        self.crawler.stats.set_value("reviews/refresh_selected", len(products))
+        for product in products:
+            yield scrapy.Request(
+                url=REVIEWS_URL.format(product.id),
+                headers=self.headers,
+                cookies=self.cookies,
+                callback=self.parse_product_reviews,
+                errback=errback_handler,
+                cb_kwargs={"product": product},
+                meta=self.impersonation.assign(),
+            )
+
+    def parse_product_reviews(self, response, product):
+        # parse_reviews only sets reviews_fetched_at when it could decode the
+        # count; otherwise the product is not written and keeps its stored count
+        product.reviews_fetched_at = None
+        for item in parse_reviews(response, product):
+            if item.reviews_fetched_at:
+                self.crawler.stats.inc_value("reviews/refreshed")
+                yield item
+            else:
+                self.crawler.stats.inc_value("reviews/refresh_failed")
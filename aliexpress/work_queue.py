@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+# Units of work shared by the worker processes of aliexpress.launcher: a
+# "query" (the first result page of a search), a further result "page", or a
+# "review" request for one product. Keys are unique, so a page or product
+# found by several workers is queued once. Workers lease units for
+# `lease_time` seconds and renew their leases while the units are in flight;
+# a lease that runs out (the worker died) puts the unit back. Results are
+# stored in the same transaction that completes their unit, for the
+# launcher's single writer to merge, and so are the products each query listed
+# and the queries whose listing came back incomplete, for the change log.
+WORK_QUEUE_SCHEMA = (
+    """
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    available_at REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+)
+""",
+    # Next units to lease, and expired leases
+    "CREATE INDEX IF NOT EXISTS units_ready ON units (state, priority DESC, id)",
+    "CREATE INDEX IF NOT EXISTS units_leased ON units (state, lease_until)",
+    "CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, item TEXT NOT NULL)",
+    """
+CREATE TABLE IF NOT EXISTS listings (
+    query TEXT NOT NULL,
+    product_id TEXT NOT NULL,
+    PRIMARY KEY (query, product_id)
+) WITHOUT ROWID
+""",
+    "CREATE TABLE IF NOT EXISTS incomplete_queries (query TEXT PRIMARY KEY) WITHOUT ROWID",
+)
+
+STATES = ("pending", "leased", "done", "failed")
+
+
+class WorkQueue:
+    def __init__(
+        self,
+        path: str,
+        lease_time: float = 300.0,
+        max_attempts: int = 3,
+        retry_delay: float = 30.0,
+    ) -> None:
+        self.path = path
+        self.lease_time = lease_time
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self.conn: Optional[sqlite3.Connection] = None
+        self.logger = logging.getLogger(__name__)
+
+    @classmethod
+    def from_settings(cls, settings) -> Optional["WorkQueue"]:
+        path = settings.get('WORK_QUEUE')
+        if not path:
+            return None
+        return cls(
+            path=path,
+            lease_time=settings.getfloat('WORK_QUEUE_LEASE_TIME', 300.0),
+            max_attempts=settings.getint('WORK_QUEUE_MAX_ATTEMPTS', 3),
+            retry_delay=settings.getfloat('WORK_QUEUE_RETRY_DELAY', 30.0),
+        )
+
+    def open(self) -> "WorkQueue":
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Transactions are managed explicitly: leases need BEGIN IMMEDIATE so
+        # two workers never select the same units
+        self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        for statement in WORK_QUEUE_SCHEMA:
+            self.conn.execute(statement)
+        return self
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _transaction(self):
+        return _Immediate(self.conn)
+
+    def add(self, units: Iterable[Tuple[str, str, Dict[str, Any], int]]) -> int:
+        # Queues (key, kind, payload, priority) units whose key is new; returns
+        # how many were added
+        with self._transaction():
+            return self._add(units)
+
+    def _add(self, units: Iterable[Tuple[str, str, Dict[str, Any], int]]) -> int:
+        before = self.conn.total_changes
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO units (key, kind, payload, priority) VALUES (?, ?, ?, ?)",
+            ((key, kind, json.dumps(payload, ensure_ascii=False), priority) for key, kind, payload, priority in units),
+        )
+        return self.conn.total_changes - before
+
+    def lease(self, worker: str, limit: int) -> List[Tuple[int, str, Dict[str, Any]]]:
+        # Up to `limit` ready units as (id, kind, payload), highest priority first
+        now = time.time()
+        with self._transaction():
+            self._reclaim(now)
+            rows = self.conn.execute(
+                "SELECT id, kind, payload FROM units WHERE state = 'pending' AND available_at <= ? "
+                "ORDER BY priority DESC, id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE units SET state = 'leased', worker = ?, lease_until = ? WHERE id = ?",
+                ((worker, now + self.lease_time, unit_id) for unit_id, _, _ in rows),
+            )
+        return [(unit_id, kind, json.loads(payload)) for unit_id, kind, payload in rows]
+
+    def renew(self, worker: str) -> None:
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE units SET lease_until = ? WHERE state = 'leased' AND worker = ?",
+                (time.time() + self.lease_time, worker),
+            )
+
+    def complete(
+        self,
+        unit_id: int,
+        children: Iterable[Tuple[str, str, Dict[str, Any], int]] = (),
+        items: Iterable[Dict[str, Any]] = (),
+        listed: Iterable[Tuple[str, str]] = (),
+        incomplete: Iterable[str] = (),
+    ) -> int:
+        # Marks a unit done, queues the units it led to and stores its items,
+        # (query, product id) listings and incomplete queries, all or nothing;
+        # returns how many children were new
+        with self._transaction():
+            added = self._add(children)
+            self.conn.executemany(
+                "INSERT INTO results (item) VALUES (?)",
+                ((json.dumps(item, ensure_ascii=False),) for item in items),
+            )
+            self.conn.executemany("INSERT OR IGNORE INTO listings VALUES (?, ?)", listed)
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO incomplete_queries VALUES (?)", ((query,) for query in incomplete)
+            )
+            self.conn.execute(
+                "UPDATE units SET state = 'done', worker = NULL, lease_until = NULL, error = NULL WHERE id = ?",
+                (unit_id,),
+            )
+        return added
+
+    def fail(self, unit_id: int, error: str) -> bool:
+        # Puts the unit back after an increasing delay, or gives up on it after
+        # max_attempts; returns True when it will be retried
+        with self._transaction():
+            row = self.conn.execute("SELECT attempts FROM units WHERE id = ?", (unit_id,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            retry = attempts < self.max_attempts
+            self.conn.execute(
+                "UPDATE units SET state = ?, worker = NULL, lease_until = NULL, attempts = ?, "
+                "available_at = ?, error = ? WHERE id = ?",
+                (
+                    "pending" if retry else "failed",
+                    attempts,
+                    time.time() + self.retry_delay * 2 ** (attempts - 1),
+                    error,
+                    unit_id,
+                ),
+            )
+        return retry
+
+    def release(self, worker: Optional[str] = None, count_attempt: bool = True) -> int:
+        # Hands back the leases of a worker that is gone or shutting down (or
+        # of every worker, when the launcher starts). A crash counts as a
+        # failed attempt, so a unit that kills its worker is given up on.
+        condition, args = ("AND worker = ?", (worker,)) if worker is not None else ("", ())
+        with self._transaction():
+            cursor = self.conn.execute(self._release_sql(condition, count_attempt), args)
+            return cursor.rowcount
+
+    def requeue_failed(self) -> int:
+        with self._transaction():
+            cursor = self.conn.execute(
+                "UPDATE units SET state = 'pending', attempts = 0, available_at = 0 WHERE state = 'failed'"
+            )
+            return cursor.rowcount
+
+    def _reclaim(self, now: float) -> None:
+        cursor = self.conn.execute(self._release_sql("AND lease_until < ?", True), (now,))
+        if cursor.rowcount:
+            self.logger.warning(f"Reclaimed {cursor.rowcount} units whose lease expired")
+
+    def _release_sql(self, condition: str, count_attempt: bool) -> str:
+        if not count_attempt:
+            return (
+                "UPDATE units SET state = 'pending', worker = NULL, lease_until = NULL "
+                f"WHERE state = 'leased' {condition}"
+            )
+        return (
+            f"UPDATE units SET state = CASE WHEN attempts + 1 >= {self.max_attempts} THEN 'failed' ELSE 'pending' END, "
+            "attempts = attempts + 1, worker = NULL, lease_until = NULL, error = 'lease lost' "
+            f"WHERE state = 'leased' {condition}"
+        )
+
+    def counts(self) -> Dict[str, int]:
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.conn.execute("SELECT state, COUNT(*) FROM units GROUP BY state"))
+        return counts
+
+    def listings(self) -> Dict[str, Set[str]]:
+        listings: Dict[str, Set[str]] = {}
+        for query, product_id in self.conn.execute("SELECT query, product_id FROM listings"):
+            listings.setdefault(query, set()).add(product_id)
+        return listings
+
+    def incomplete_queries(self) -> Set[str]:
+        incomplete = {query for query, in self.conn.execute("SELECT query FROM incomplete_queries")}
+        # A query or page unit given up on leaves its query's listing short
+        for payload, in self.conn.execute("SELECT payload FROM units WHERE state = 'failed' AND kind != 'review'"):
+            incomplete.add(json.loads(payload)["meta"].get("query_key"))
+        return incomplete
+
+    def finished(self) -> bool:
+        # Nothing left to lease now or later; leased units may still add more
+        row = self.conn.execute("SELECT 1 FROM units WHERE state IN ('pending', 'leased') LIMIT 1").fetchone()
+        return row is None
+
+    def results(self, after: int = 0, limit: int = 1000) -> List[Tuple[int, Dict[str, Any]]]:
+        rows = self.conn.execute(
+            "SELECT id, item FROM results WHERE id > ? ORDER BY id LIMIT ?", (after, limit)
+        ).fetchall()
+        return [(result_id, json.loads(item)) for result_id, item in rows]
+
+    def discard_results(self, up_to: int) -> None:
+        with self._transaction():
+            self.conn.execute("DELETE FROM results WHERE id <= ?", (up_to,))
+
+
+class _Immediate:
+    # BEGIN IMMEDIATE ... COMMIT, rolled back on error. Taking the write lock
+    # up front means concurrent workers queue on busy_timeout instead of
+    # failing to upgrade a read transaction.
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
@@ -0,0 +1,218 @@
+# Fixture loading and synthetic data generation for the benchmarks.
+#
+# Recorded pages dropped into benchmarks/fixtures/ are picked up as-is:
+#   *.html  saved /w/wholesale search result pages
+#   *.json  saved feedback.aliexpress.com/pc/searchEvaluation.do responses
+# The synthetic generators follow the same shape and are used to scale the
+# benchmarks beyond what was recorded.
+
+import datetime
+import glob
+import json
+import os
+import random
+import struct
+import zlib
+from typing import Any, Dict, Iterator, List, Optional
+
+from aliexpress.items import Product
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+SEARCH_URL = "https://www.aliexpress.com/w/wholesale-phone-case.html?g=y&SearchText=phone+case"
+
+_WORDS = (
+    "phone case silicone magnetic shockproof cover for iphone samsung galaxy xiaomi clear "
+    "leather wallet card holder luxury cute soft matte transparent protective slim"
+).split()
+_STORES = 5000
+
+
+def load_html_fixtures() -> List[bytes]:
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html"))):
+        with open(path, "rb") as file:
+            pages.append(file.read())
+    return pages
+
+
+def load_review_fixtures() -> List[bytes]:
+    responses = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.json"))):
+        with open(path, "rb") as file:
+            responses.append(file.read())
+    return responses
+
+
+def make_record(index: int, rng: Optional[random.Random] = None) -> Dict[str, Any]:
+    # One entry of data.root.fields.mods.itemList.content
+    rng = rng or random.Random(index)
+    product_id = str(1005001000000000 + index)
+    store_id = index % _STORES
+    sale_price = round(rng.uniform(0.5, 150), 2)
+    discount = rng.choice((0, 5, 10, 25, 40, 60))
+    image_ids = [f"S{rng.getrandbits(64):016x}" for _ in range(rng.randint(1, 6))]
+    trade = rng.choice((0, 3, 27, 150, 1000, 5000, 10000))
+    return {
+        "productId": product_id,
+        "lunchTime": "2024-01-01 00:00:00",
+        "prices": {
+            "skuId": str(12000030000000000 + index),
+            "pricesStyle": "default",
+            "builderType": "skuCoupon",
+            "currencySymbol": "US $",
+            "prefix": "Sale price:",
+            "salePrice": {
+                "discount": discount,
+                "minPriceDiscount": discount,
+                "priceType": "sale_price",
+                "currencyCode": "USD",
+                "minPrice": sale_price,
+                "minPriceType": 1,
+                "formattedPrice": f"US ${sale_price:.2f}",
+            },
+            "originalPrice": {
+                "priceType": "original_price",
+                "currencyCode": "USD",
+                "minPrice": round(sale_price / (1 - discount / 100), 2),
+                "formattedPrice": f"US ${sale_price / (1 - discount / 100):.2f}",
+            },
+        },
+        "image": {
+            "imgUrl": f"//ae-pic-a1.aliexpress-media.com/kf/{image_ids[0]}.jpg",
+            "imgWidth": 350,
+            "imgHeight": 350,
+            "imgType": "0",
+        },
+        "title": {
+            "displayTitle": " ".join(rng.choice(_WORDS) for _ in range(rng.randint(8, 20))).title()
+            + " &amp; Accessories",
+            "seoTitle": "phone case",
+        },
+        "store": {
+            "storeUrl": f"//www.aliexpress.com/store/{1100000000 + store_id}",
+            "storeName": f"Store {store_id} Official",
+            "storeId": 1100000000 + store_id,
+            "aliMemberId": 200000000 + store_id,
+        },
+        "trade": {
+            "realTradeCount": f"{trade}+" if trade >= 1000 else str(trade),
+            "tradeDesc": f"{trade}+ sold" if trade >= 1000 else f"{trade} sold",
+        },
+        "evaluation": {"starRating": round(rng.uniform(3.5, 5.0), 1)},
+        "images": [
+            {"imgUrl": f"//ae-pic-a1.aliexpress-media.com/kf/{image_id}.jpg", "imgWidth": 350, "imgHeight": 350}
+            for image_id in image_ids
+        ],
+        "trace": {"pdpParams": {"pdp_npi": "4@dis!USD!" + str(sale_price)}, "exposure": {"algo_exp_id": "x" * 64}},
+    }
+
+
+def make_config(page: int, records: List[Dict[str, Any]], total_results: int, page_size: int = 60) -> Dict[str, Any]:
+    return {
+        "data": {
+            "root": {
+                "fields": {
+                    "pageInfo": {"page": page, "pageSize": page_size, "totalResults": total_results},
+                    "mods": {"itemList": {"content": records}},
+                }
+            }
+        }
+    }
+
+
+def make_search_page(
+    page: int = 1,
+    page_size: int = 60,
+    total_results: int = 3600,
+    first_index: Optional[int] = None,
+    records: Optional[List[Dict[str, Any]]] = None,
+    padding: int = 200_000,
+) -> bytes:
+    if records is None:
+        first_index = (page - 1) * page_size if first_index is None else first_index
+        count = max(0, min(page_size, total_results - first_index))
+        records = [make_record(first_index + i) for i in range(count)]
+    config = json.dumps(make_config(page, records, total_results, page_size))
+    # Live pages carry a few hundred KB of markup and other scripts around the payload
+    filler = "<div class=\"filler\">" + "x" * 1000 + "</div>\n"
+    return (
+        "<!DOCTYPE html><html><head><title>Phone Case - Buy Phone Case with free shipping on AliExpress</title>"
+        "<script src=\"//assets.alicdn.com/g/ae-fe/app.js\"></script>"
+        "<script>window.__INIT_DATA__ = {\"ok\": true};</script></head><body>"
+        + filler * (padding // len(filler))
+        + f"<script>\n window._dida_config_ = {config};\n window._dida_config_.hook = null;\n</script>"
+        + "</body></html>"
+    ).encode("utf-8")
+
+
+def make_review_response(product_id: str, rng: Optional[random.Random] = None) -> bytes:
+    rng = rng or random.Random(product_id)
+    ratings = rng.choice((0, 4, 57, 312, 1500, 20000))
+    return json.dumps({
+        "code": 200,
+        "msg": "success",
+        "data": {"productEvaluationStatistic": {"evarageStar": 4.7, "totalNum": ratings}, "evaViewList": []},
+        "displayMessage": {"numRatings": str(ratings), "reviewsTitle": "Reviews"},
+    }).encode("utf-8")
+
+
+def make_image(name: str, variants: int = 500, size: int = 64) -> bytes:
+    # A valid PNG of `size`x`size` noise pixels for an image file name. Names
+    # map onto `variants` distinct images, so many URLs share their content
+    # like re-uploaded product photos do.
+    rng = random.Random(zlib.crc32(name.encode("utf-8")) % max(1, variants))
+    rows = b"".join(b"\x00" + rng.randbytes(size * 3) for _ in range(size))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+
+def make_product_dicts(count: int, seed: int = 0, id_offset: int = 0) -> Iterator[Dict[str, Any]]:
+    # Products as the free-form dicts extract_fields used to build
+    rng = random.Random(seed)
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for index in range(id_offset, id_offset + count):
+        record = make_record(index, rng)
+        prices = record["prices"]
+        yield {
+            "id": record["productId"],
+            "skuId": prices["skuId"],
+            "title": record["title"]["displayTitle"],
+            "main_image": "https:" + record["image"]["imgUrl"],
+            "url": f"https://www.aliexpress.com/item/{record['productId']}",
+            "sale_price": float(prices["salePrice"]["minPrice"]),
+            "original_price": float(prices["originalPrice"]["minPrice"]),
+            "discount": float(prices["salePrice"]["discount"]),
+            "currency": prices["salePrice"]["currencyCode"],
+            "trade_count": record["trade"]["realTradeCount"],
+            "store_name": record["store"]["storeName"],
+            "store_url": "https:" + record["store"]["storeUrl"],
+            "star_rating": record["evaluation"]["starRating"],
+            "number_reviews": str(rng.randint(0, 5000)),
+            "total_sales": record["trade"]["tradeDesc"].split(" ")[0],
+            "images": ["https:" + image["imgUrl"] for image in record["images"]],
+            "last_scrape_date": now,
+            "scrape_status": "successful",
+        }
+
+
+def make_products(count: int, seed: int = 0, id_offset: int = 0) -> Iterator[Product]:
+    # Products in the shape extract_fields hands to the pipelines
+    for product in make_product_dicts(count, seed, id_offset):
+        yield Product.from_dict(product)
+
+
+def write_default_fixtures() -> None:
+    # Regenerates the small fixture set committed with the benchmarks
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    with open(os.path.join(FIXTURES_DIR, "search_page_1.html"), "wb") as file:
+        file.write(make_search_page(page=1))
+    with open(os.path.join(FIXTURES_DIR, "search_evaluation.json"), "wb") as file:
+        file.write(make_review_response("1005001000000000"))
+
+
+if __name__ == "__main__":
+    write_default_fixtures()
@@ -0,0 +1,160 @@
+# End-to-end load test: runs AliexpressSpider, with its real pipelines and
+# middlewares, against benchmarks.mock_server in a separate process.
+#
+#   python -m benchmarks.load                                   # 1 query, 3600 products
+#   python -m benchmarks.load --queries 4 --latency 0.1 --jitter 0.2 --error-rate 0.01 \
+#       --block-every 400 --block-length 20 -s ADAPTIVE_THROTTLE_MAX_CONCURRENCY=16
+#
+# Requests keep their AliExpress URLs (so download slots, throttling and the
+# stored product URLs look like production); only the download handler sends
+# them to the mock server. Settings are the spider's own except DOWNLOAD_DELAY,
+# which is 0; add -s ADAPTIVE_THROTTLE_MIN_DELAY=0 to take the throttle's
+# politeness floor out as well. Ctrl-C stops the crawl and still reports.
+#
+# Reports pages/s, items/s, request amplification (requests made per request
+# the crawl strictly needed) and peak RSS.
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import urllib.request
+from typing import Dict, List
+from urllib.parse import urlsplit, urlunsplit
+
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+
+from aliexpress.launcher import setting_override
+from benchmarks import mock_server
+
+
+class MockDownloadHandler(HTTP11DownloadHandler):
+    # Downloads every request from MOCK_SERVER_URL and hands the response back
+    # under the original URL
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        self.target = urlsplit(crawler.settings.get("MOCK_SERVER_URL"))
+
+    async def download_request(self, request):
+        parts = urlsplit(request.url)
+        local = urlunsplit((self.target.scheme, self.target.netloc, parts.path, parts.query, ""))
+        forwarded = request.replace(url=local)
+        response = await super().download_request(forwarded)
+        # download_latency and friends were recorded on the copy
+        request.meta.update(forwarded.meta)
+        return response.replace(url=request.url)
+
+
+def query_urls(count: int) -> List[str]:
+    return [
+        f"https://www.aliexpress.com/w/wholesale-load-{index}.html?g=y&SearchText=load+{index}"
+        for index in range(count)
+    ]
+
+
+def crawl(server_url: str, workdir: str, queries: int, overrides: Dict[str, str], log_level: str) -> Dict:
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.settings import Settings
+    from aliexpress.spiders.aliexpress_spider import AliexpressSpider
+
+    queries_file = os.path.join(workdir, "queries.txt")
+    with open(queries_file, "w", encoding="utf-8") as file:
+        file.write("\n".join(query_urls(queries)) + "\n")
+
+    settings = Settings()
+    settings.setmodule("aliexpress.settings", priority="project")
+    # Above the spider's custom_settings
+    settings.setdict({
+        # Through the same timing wrapper as the live handler
+        "TIMED_DOWNLOAD_HANDLER": "benchmarks.load.MockDownloadHandler",
+        "MOCK_SERVER_URL": server_url,
+        "DOWNLOAD_DELAY": 0,
+        "SQLITE_DATABASE": os.path.join(workdir, "products.db"),
+        "JSON_OUTPUT": os.path.join(workdir, "products.json"),
+        "JSON_LOG_FILE": os.path.join(workdir, "products.jsonl"),
+        "CHECKPOINT_DIR": os.path.join(workdir, "checkpoints"),
+        "TELNETCONSOLE_ENABLED": False,
+        "LOG_LEVEL": log_level,
+    }, priority="cmdline")
+    for name, value in overrides.items():
+        settings.set(name, value, priority="cmdline")
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(AliexpressSpider)
+    process.crawl(crawler, queries_file=queries_file)
+    process.start()
+    return crawler.stats.get_stats()
+
+
+def summarize(stats: Dict, server_stats: Dict) -> Dict[str, float]:
+    elapsed = stats.get("elapsed_time_seconds") or 0.0
+    pages = sum(value for key, value in stats.items() if key.startswith("queries/") and key.endswith("/pages"))
+    items = stats.get("item_scraped_count", 0)
+    requests = stats.get("downloader/request_count", 0)
+    # One request per result page, one review request per scraped product not
+    # served from the review cache and one per new image URL
+    needed = pages + items - stats.get("reviews/cache_hit", 0) + stats.get("images/requested", 0)
+    return {
+        "seconds": elapsed,
+        "pages": pages,
+        "items": items,
+        "requests": requests,
+        "pages_per_s": pages / elapsed if elapsed else 0.0,
+        "items_per_s": items / elapsed if elapsed else 0.0,
+        "amplification": requests / needed if needed else 0.0,
+        "retries": stats.get("retry/count", 0),
+        "blocked": stats.get("downloader/response_status_count/403", 0),
+        "server_errors": stats.get("downloader/response_status_count/500", 0),
+        "images": stats.get("images/downloaded", 0),
+        "image_files": stats.get("images/stored", 0),
+        "server_requests": server_stats.get("requests", 0),
+        # ru_maxrss is reported in KiB on Linux and bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        / (1024 * 1024 if sys.platform == "darwin" else 1024),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Crawl the local mock server and report end-to-end throughput")
+    parser.add_argument("--queries", type=int, default=1, help="distinct search queries to crawl")
+    mock_server.add_arguments(parser)
+    parser.add_argument("-s", "--set", type=setting_override, action="append", default=[], metavar="NAME=VALUE",
+                        help="override a spider setting, e.g. CONCURRENT_REQUESTS_PER_DOMAIN=8")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--keep-output", help="copy the crawl's database and json output to this directory")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    server = context.Process(target=mock_server.serve, args=(mock_server.server_options(args), ready), daemon=True)
+    server.start()
+    server_url = f"http://127.0.0.1:{ready.get(timeout=30)}"
+    workdir = tempfile.mkdtemp(prefix="load-")
+    try:
+        stats = crawl(server_url, workdir, args.queries, dict(args.set), args.log_level)
+        with urllib.request.urlopen(f"{server_url}/_stats") as response:
+            server_stats = json.load(response)
+        if args.keep_output:
+            shutil.copytree(workdir, args.keep_output, dirs_exist_ok=True)
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = summarize(stats, server_stats)
+    for name, value in result.items():
+        print(f"{name:>16}  {value:.2f}" if isinstance(value, float) else f"{name:>16}  {value}")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
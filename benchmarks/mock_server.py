@@ -0,0 +1,187 @@
+# A local stand-in for the two AliExpress endpoints the spider talks to, for
+# end-to-end load tests that must not touch production.
+#
+#   python -m benchmarks.mock_server --port 8080 --latency 0.2 --error-rate 0.02 --block-every 500
+#
+# /w/wholesale-*.html serves search pages built by fixtures.make_search_page,
+# with pageInfo and a paginated itemList over `catalog_size` results per query
+# (every distinct SearchText gets its own product ids), and
+# /pc/searchEvaluation.do serves review counts, and /kf/*.jpg the product
+# images (small PNGs; `image_variants` distinct ones shared by all names). The
+# host is ignored, so www., feedback.aliexpress.com and the image CDN can all
+# be routed here. /_stats returns the request counters as JSON.
+
+import argparse
+import functools
+import json
+import random
+import signal
+import sys
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from twisted.web import resource, server
+
+from benchmarks import fixtures
+
+
+# Pages are expensive to build and retries ask for the same ones again
+@functools.lru_cache(maxsize=256)
+def search_page(page: int, first_index: int, page_size: int, total_results: int, padding: int) -> bytes:
+    start = (page - 1) * page_size
+    records = [fixtures.make_record(first_index + index) for index in range(start, min(start + page_size, total_results))]
+    return fixtures.make_search_page(
+        page=page, page_size=page_size, total_results=total_results, records=records, padding=padding
+    )
+
+
+class MockAliExpress(resource.Resource):
+    isLeaf = True
+
+    def __init__(
+        self,
+        catalog_size: int = 3600,
+        page_size: int = 60,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        block_every: int = 0,
+        block_length: int = 0,
+        padding: int = 200_000,
+        image_variants: int = 500,
+        seed: int = 0,
+    ) -> None:
+        super().__init__()
+        self.catalog_size = catalog_size
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        # Every `block_every` requests the next `block_length` get a 403
+        self.block_every = block_every
+        self.block_length = block_length
+        self.padding = padding
+        self.image_variants = image_variants
+        self.rng = random.Random(seed)
+        # SearchText -> index of its first product
+        self.queries: Dict[str, int] = {}
+        self.stats: Counter = Counter()
+
+    def render_GET(self, request):
+        path = request.path.decode("utf-8", errors="replace")
+        args = {key.decode(): values[-1].decode() for key, values in request.args.items()}
+        if path == "/_stats":
+            request.setHeader(b"content-type", b"application/json")
+            return json.dumps(self.stats).encode("utf-8")
+
+        self.stats["requests"] += 1
+        status, content_type, body = self.respond(path, args)
+        self.stats[f"status/{status}"] += 1
+        delay = self.latency + self.rng.uniform(0, self.jitter) if self.latency or self.jitter else 0
+        if not delay:
+            return self._render(request, status, content_type, body)
+
+        from twisted.internet import reactor
+        call = reactor.callLater(delay, self._finish, request, status, content_type, body)
+        request.notifyFinish().addErrback(lambda _: call.active() and call.cancel())
+        return server.NOT_DONE_YET
+
+    def respond(self, path: str, args: Dict[str, str]) -> Tuple[int, bytes, bytes]:
+        if self.blocked():
+            self.stats["blocked"] += 1
+            return 403, b"text/html", b"<html><body>Access denied</body></html>"
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return 500, b"text/html", b"<html><body>Internal error</body></html>"
+        if path.startswith("/w/wholesale"):
+            self.stats["search"] += 1
+            return 200, b"text/html; charset=utf-8", self.search_response(args)
+        if path == "/pc/searchEvaluation.do" and args.get("productId"):
+            self.stats["reviews"] += 1
+            return 200, b"application/json", fixtures.make_review_response(args["productId"])
+        if path.startswith("/kf/"):
+            self.stats["images"] += 1
+            return 200, b"image/png", fixtures.make_image(path.rsplit("/", 1)[-1], self.image_variants)
+        return 404, b"text/plain", b"not found"
+
+    def search_response(self, args: Dict[str, str]) -> bytes:
+        query = args.get("SearchText", "")
+        first_index = self.queries.setdefault(query, len(self.queries) * self.catalog_size)
+        page = max(1, int(args.get("page") or 1))
+        return search_page(page, first_index, self.page_size, self.catalog_size, self.padding)
+
+    def blocked(self) -> bool:
+        if not self.block_every or not self.block_length:
+            return False
+        return (self.stats["requests"] - 1) % (self.block_every + self.block_length) >= self.block_every
+
+    def _render(self, request, status: int, content_type: bytes, body: bytes) -> bytes:
+        request.setResponseCode(status)
+        request.setHeader(b"content-type", content_type)
+        return body
+
+    def _finish(self, request, status: int, content_type: bytes, body: bytes) -> None:
+        request.write(self._render(request, status, content_type, body))
+        request.finish()
+
+
+def listen(site_resource: MockAliExpress, port: int = 0, interface: str = "127.0.0.1"):
+    from twisted.internet import reactor
+    return reactor.listenTCP(port, server.Site(site_resource), interface=interface)
+
+
+def serve(options: Dict, ready=None, port: int = 0) -> None:
+    # Runs the server until the process is terminated; the bound port is put
+    # on `ready` (a multiprocessing queue) once it is listening
+    from twisted.internet import reactor
+    listening = listen(MockAliExpress(**options), port)
+    if ready is None:
+        reactor.run()
+        return
+    # Started by a runner: Ctrl-C stops its crawl gracefully, which needs the
+    # server to keep answering until the runner terminates it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ready.put(listening.getHost().port)
+    reactor.run(installSignalHandlers=False)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--catalog-size", type=int, default=3600, help="search results per query")
+    parser.add_argument("--page-size", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds, uniformly")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--block-every", type=int, default=0, help="start a 403 burst after this many requests")
+    parser.add_argument("--block-length", type=int, default=10, help="requests per 403 burst")
+    parser.add_argument("--padding", type=int, default=200_000, help="bytes of markup around the payload")
+    parser.add_argument("--image-variants", type=int, default=500, help="distinct images behind all image URLs")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def server_options(args: argparse.Namespace) -> Dict:
+    return dict(
+        catalog_size=args.catalog_size,
+        page_size=args.page_size,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        block_every=args.block_every,
+        block_length=args.block_length,
+        padding=args.padding,
+        image_variants=args.image_variants,
+        seed=args.seed,
+    )
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Serve AliExpress-shaped search and review responses locally")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    print(f"Serving on http://127.0.0.1:{args.port}")
+    serve(server_options(args), port=args.port)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,320 @@
+# Offline benchmarks for the spider's parsing hot paths and the item pipelines.
+#
+#   python -m benchmarks.run                       # all benchmarks, default sizes
+#   python -m benchmarks.run -b parse -b sqlite --sizes 1,1000,200000
+#   python -m benchmarks.run --json bench.json --baseline previous.json
+#
+# Every benchmark runs in a fresh process so its peak RSS is its own.
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Iterable, Iterator, List
+
+from benchmarks import fixtures
+
+DEFAULT_SIZES = "1,1000,100000"
+
+
+def _percentile(samples: List[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _measure(operations: Iterable[Callable[[], int]]) -> Dict[str, float]:
+    # Each operation returns how many units (pages, items, calls) it processed.
+    # Operations may be built lazily, so only the time spent inside them counts.
+    latencies = []
+    units = 0
+    for operation in operations:
+        op_started = time.perf_counter()
+        units += operation()
+        latencies.append(time.perf_counter() - op_started)
+    elapsed = sum(latencies)
+    return {
+        "units": units,
+        "seconds": elapsed,
+        "throughput": units / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+    }
+
+
+def _spider():
+    from aliexpress.spiders.aliexpress_spider import AliexpressSpider
+    return AliexpressSpider(query=fixtures.SEARCH_URL)
+
+
+def _pages(size: int) -> Iterator[bytes]:
+    # Recorded pages first, then synthetic ones generated on demand
+    recorded = fixtures.load_html_fixtures()
+    page_count = max(1, size // 60)
+    yield from recorded[:page_count]
+    for page in range(len(recorded) + 1, page_count + 1):
+        yield fixtures.make_search_page(page=page, total_results=page_count * 60)
+
+
+def bench_parse(size: int) -> Dict[str, float]:
+    from scrapy.http import HtmlResponse, Request
+    spider = _spider()
+    responses = (
+        HtmlResponse(url=fixtures.SEARCH_URL, body=body, encoding="utf-8", request=Request(fixtures.SEARCH_URL))
+        for body in _pages(size)
+    )
+
+    def operation(response):
+        def run():
+            for _ in spider.parse(response):
+                pass
+            return 1
+        return run
+
+    return _measure(operation(response) for response in responses)
+
+
+def bench_extract_fields(size: int) -> Dict[str, float]:
+    from scrapy.http import HtmlResponse, Request
+    spider = _spider()
+    response = HtmlResponse(url=fixtures.SEARCH_URL, body=b"", request=Request(fixtures.SEARCH_URL))
+    batches = (
+        [fixtures.make_record(index) for index in range(start, min(size, start + 60))]
+        for start in range(0, size, 60)
+    )
+
+    def operation(batch):
+        def run():
+            for _ in spider.extract_fields(batch, response):
+                pass
+            return len(batch)
+        return run
+
+    return _measure(operation(batch) for batch in batches)
+
+
+def bench_cleanup(size: int) -> Dict[str, float]:
+    from aliexpress.extractors import cleanup, get_number
+    records = [fixtures.make_record(index) for index in range(min(size, 10000))]
+    inputs = [(record["title"]["displayTitle"], record["trade"]["tradeDesc"]) for record in records]
+
+    def operation(title, trade):
+        def run():
+            cleanup(title)
+            get_number(trade)
+            return 1
+        return run
+
+    return _measure(operation(*inputs[index % len(inputs)]) for index in range(size))
+
+
+def bench_parse_reviews(size: int) -> Dict[str, float]:
+    from scrapy.http import Request, TextResponse
+    from aliexpress.spiders.aliexpress_spider import parse_reviews
+    recorded = fixtures.load_review_fixtures()
+    bodies = recorded or [fixtures.make_review_response(str(index)) for index in range(100)]
+    url = "https://feedback.aliexpress.com/pc/searchEvaluation.do?productId=1"
+    responses = [TextResponse(url=url, body=body, encoding="utf-8", request=Request(url)) for body in bodies]
+    products = fixtures.make_products(size)
+
+    def operation(product, response):
+        def run():
+            for _ in parse_reviews(response, product):
+                pass
+            return 1
+        return run
+
+    return _measure(operation(product, responses[index % len(responses)]) for index, product in enumerate(products))
+
+
+def bench_product_memory(size: int) -> Dict[str, float]:
+    # Products held while their review requests are pending: Product records
+    # from extract_fields against the dicts it used to build
+    import tracemalloc
+    from scrapy.http import HtmlResponse, Request
+    spider = _spider()
+    response = HtmlResponse(url=fixtures.SEARCH_URL, body=b"", request=Request(fixtures.SEARCH_URL))
+    records = [fixtures.make_record(index) for index in range(size)]
+    held = []
+
+    def operation(batch):
+        def run():
+            held.extend(request.cb_kwargs["product"] for request in spider.extract_fields(batch, response))
+            return len(batch)
+        return run
+
+    tracemalloc.start()
+    result = _measure(operation(records[start:start + 60]) for start in range(0, size, 60))
+    product_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    held.clear()
+
+    tracemalloc.start()
+    dicts = list(fixtures.make_product_dicts(size))
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    result["bytes_per_product"] = product_bytes / max(1, size)
+    result["bytes_per_dict"] = dict_bytes / max(1, len(dicts))
+    return result
+
+
+def _run_pipeline(pipeline, size: int) -> Dict[str, float]:
+    # The writers do their I/O on a thread, so process_item only times a queue
+    # put. The clock runs until close_spider has joined the writer thread after
+    # its last flush instead, and there are no per-item latencies to report.
+    from scrapy import Spider
+    spider = Spider(name="benchmark")
+    pipeline.open_spider(spider)
+    products = list(fixtures.make_products(size))
+    started = time.perf_counter()
+    for product in products:
+        pipeline.process_item(product, spider)
+    pipeline.close_spider(spider)
+    elapsed = time.perf_counter() - started
+    return {
+        "units": len(products),
+        "seconds": elapsed,
+        "throughput": len(products) / elapsed if elapsed else 0.0,
+        "p50_ms": None,
+        "p99_ms": None,
+    }
+
+
+def bench_sqlite(size: int) -> Dict[str, float]:
+    from aliexpress.pipelines import SQLiteWriter
+    workdir = tempfile.mkdtemp(prefix="bench-sqlite-")
+    try:
+        writer = SQLiteWriter(os.path.join(workdir, "products.db"), flush_interval=0)
+        return _run_pipeline(writer, size)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_json(size: int) -> Dict[str, float]:
+    from aliexpress.pipelines import JsonWriter
+    workdir = tempfile.mkdtemp(prefix="bench-json-")
+    try:
+        writer = JsonWriter(os.path.join(workdir, "products.json"))
+        return _run_pipeline(writer, size)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_parquet(size: int) -> Dict[str, float]:
+    from aliexpress.pipelines import ParquetWriter
+    workdir = tempfile.mkdtemp(prefix="bench-parquet-")
+    try:
+        writer = ParquetWriter(os.path.join(workdir, "products.parquet"))
+        return _run_pipeline(writer, size)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+BENCHMARKS: Dict[str, Callable[[int], Dict[str, float]]] = {
+    "parse": bench_parse,
+    "extract_fields": bench_extract_fields,
+    "product_memory": bench_product_memory,
+    "cleanup": bench_cleanup,
+    "parse_reviews": bench_parse_reviews,
+    "sqlite": bench_sqlite,
+    "json": bench_json,
+    "parquet": bench_parquet,
+}
+
+
+def _child(name: str, size: int, results) -> None:
+    logging.disable(logging.CRITICAL)
+    try:
+        result = BENCHMARKS[name](size)
+    except Exception as e:
+        results.put({"error": f"{type(e).__name__}: {e}"})
+        raise
+    # ru_maxrss is reported in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_mb"] = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    results.put(result)
+
+
+def run_benchmark(name: str, size: int) -> Dict[str, float]:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_child, args=(name, size, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def _format_ms(value) -> str:
+    # Writer benchmarks time the whole run only
+    return f"{'-':>10}" if value is None else f"{value:>10.3f}"
+
+
+def _check_regressions(results: List[Dict], baseline_path: str, tolerance: float) -> List[str]:
+    with open(baseline_path) as file:
+        baseline = {(entry["benchmark"], entry["size"]): entry for entry in json.load(file)}
+    regressions = []
+    for entry in results:
+        previous = baseline.get((entry["benchmark"], entry["size"]))
+        if previous and entry["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{entry['benchmark']}[{entry['size']}]: {entry['throughput']:.1f}/s "
+                f"vs {previous['throughput']:.1f}/s baseline"
+            )
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the AliExpress spider and pipelines")
+    parser.add_argument("-b", "--benchmark", action="append", choices=sorted(BENCHMARKS),
+                        help="benchmark to run (repeatable, default: all)")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help=f"comma separated product counts (default: {DEFAULT_SIZES})")
+    parser.add_argument("--json", dest="json_output", help="write results to this file")
+    parser.add_argument("--baseline", help="results file from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed throughput drop against the baseline (default: 0.10)")
+    args = parser.parse_args(argv)
+
+    names = args.benchmark or list(BENCHMARKS)
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    results = []
+
+    print(f"{'benchmark':<16}{'size':>10}{'units/s':>14}{'p50 ms':>10}{'p99 ms':>10}{'peak MB':>10}")
+    for name in names:
+        for size in sizes:
+            result = run_benchmark(name, size)
+            if "error" in result:
+                print(f"{name:<16}{size:>10}  failed: {result['error']}")
+                continue
+            result.update(benchmark=name, size=size)
+            results.append(result)
+            print(
+                f"{name:<16}{size:>10}{result['throughput']:>14.1f}"
+                f"{_format_ms(result['p50_ms'])}{_format_ms(result['p99_ms'])}{result['peak_rss_mb']:>10.1f}"
+            )
+            if "bytes_per_product" in result:
+                print(f"{'':<26}{result['bytes_per_product']:.0f} B per Product, "
+                      f"{result['bytes_per_dict']:.0f} B per dict")
+
+    if args.json_output:
+        with open(args.json_output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        regressions = _check_regressions(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())